@@ -1,41 +1,45 @@
-from flask import Flask, request, render_template, jsonify, send_from_directory, after_this_request
-from deezer_downloader.client import DeezerClient
-from deezer_downloader.config import DeezerConfig
-from deezer_downloader.exceptions import DeezerException
+from flask import Flask, Response, request, render_template, jsonify
+import json
 import re
 import threading
+import uuid
 import os
 import shutil
-import tempfile
+import time
+from urllib.parse import quote
 from datetime import datetime, timedelta
 from redis_manager import RedisManager
-from progress_tracker import FIELD_FINISHED, FIELD_ERROR, FIELD_ZIP_READY
+from job_queue import JobQueue, QueueFullError
+from progress_hub import ProgressHub, StreamLimitError
+from tasks import ENV, BASE_TEMP_DIR, DOWNLOADS_DIR, TRACK_STORE_DIR, redis_manager, download_queue, \
+    open_track_stream, resolve_sound_format, download_content_key, SHARED_DATA_DIR, DOWNLOAD_WORKERS
+from worker import start_workers
+from progress_tracker import FIELD_FINISHED, FIELD_ERROR, FIELD_ZIP_READY, FIELD_QUEUE_POSITION, FIELD_RUN
+from zip_stream import stream_zip
+from deezer_downloader.exceptions import DeezerException, Deezer403Exception, Deezer404Exception
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 
 # --- Environment Configuration ---
-ENV = os.environ.get('FLASK_ENV', 'development').lower()
-
-if ENV == 'development':
-    # In development, use a local directory (e.g., 'project_root/dl')
-    BASE_TEMP_DIR = os.path.join(app.root_path, 'dl')
-else:
-    # In production (or default), use the system's temporary directory
-    BASE_TEMP_DIR = os.path.join(tempfile.gettempdir(), 'deezer_dl_redis')
-
-DOWNLOADS_DIR = os.path.join(BASE_TEMP_DIR, 'downloads')
-ZIPS_DIR = os.path.join(BASE_TEMP_DIR, 'zips')
-
-# Ensure directories exist
-os.makedirs(DOWNLOADS_DIR, exist_ok=True)
-os.makedirs(ZIPS_DIR, exist_ok=True)
+# Download workers run inside this process too (0 leaves downloads to separate `python worker.py` processes)
+# Download tasks run inside the web process; by default all of them, unless workers share DATA_DIR with it
+EMBEDDED_WORKERS = int(os.environ.get('EMBEDDED_WORKERS', '0' if SHARED_DATA_DIR else str(DOWNLOAD_WORKERS)))
+# Seconds a client is told to wait before retrying when the queue is full
+QUEUE_RETRY_AFTER_SECONDS = int(os.environ.get('QUEUE_RETRY_AFTER_SECONDS', '30'))
+QUEUE_FULL_MESSAGE = 'The server is busy. Please try again in a moment.'
+# Seconds between keep-alive comments on an idle progress stream, which also refresh queue positions
+PROGRESS_KEEPALIVE_SECONDS = int(os.environ.get('PROGRESS_KEEPALIVE_SECONDS', '5'))
+# Progress streams open at once per process, past which clients are told to poll /progress instead
+MAX_PROGRESS_STREAMS = int(os.environ.get('MAX_PROGRESS_STREAMS', '500'))
+# Tracks passed through /stream_track at once per process, past which it answers 429: each holds a
+# connection to Deezer and a thread (or greenlet) for as long as the browser downloads it
+MAX_TRACK_STREAMS = int(os.environ.get('MAX_TRACK_STREAMS', '20'))
+# Most tasks whose progress can be requested at once from /progress/batch
+MAX_BATCH_TASKS = int(os.environ.get('MAX_BATCH_TASKS', '100'))
 
 app.logger.info(f"ENV: {ENV}, Base data directory: {BASE_TEMP_DIR}")
 app.logger.info(f"Downloads directory: {DOWNLOADS_DIR}")
-app.logger.info(f"Zips directory: {ZIPS_DIR}")
-
-# --- Redis Manager and Task Manager Initialization ---
-redis_manager = RedisManager(redis_url=os.environ.get('REDIS_URL'))
+app.logger.info(f"Track store directory: {TRACK_STORE_DIR}")
 
 
 def cleanup_old_files(directory, max_age_hours=24):
@@ -65,7 +69,6 @@ def cleanup_old_files(directory, max_age_hours=24):
 
 # General cleanup on startup (can be disabled if TaskManager's cleanup is sufficient)
 cleanup_old_files(DOWNLOADS_DIR, max_age_hours=1)
-cleanup_old_files(ZIPS_DIR, max_age_hours=1)
 
 # --- Helper Functions ---
 
@@ -79,6 +82,12 @@ def validate_arl_cookie(arl_cookie):
     return arl_cookie_trimmed, None
 
 
+def content_disposition(filename):
+    """Content-Disposition header of an attachment, with an ASCII fallback for non-ASCII file names."""
+    fallback = filename.encode('ascii', 'replace').decode('ascii').replace('"', '')
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
 def parse_deezer_url(url):
     """Parses a Deezer URL to extract content type and ID."""
     url_match = re.match(r'https?://(?:www\.)?deezer\.com/(?:\w+/)?(\w+)/(\d+)', url)
@@ -92,9 +101,13 @@ def parse_deezer_url(url):
 class TaskManager:
     """Manages download tasks using RedisManager and handles file system cleanup."""
 
-    def __init__(self, redis_manager_instance: RedisManager):
+    def __init__(self, redis_manager_instance: RedisManager, job_queue: JobQueue, progress_hub: ProgressHub):
         self.redis_manager = redis_manager_instance
+        self.job_queue = job_queue
+        self.progress_hub = progress_hub
         self.cleanup_interval_seconds = 3600
+        # Seconds between checks for new files of a task whose zip is being streamed
+        self.stream_poll_seconds = 1
         self._stop_cleanup_event = threading.Event()
         self._cleanup_thread = threading.Thread(target=self._cleanup_stale_task_files_periodically, daemon=True)
         self._cleanup_thread.start()
@@ -106,9 +119,79 @@ class TaskManager:
         app.logger.info(f"Task {task_id} created in Redis.")
         return task_id
 
+    def enqueue_download(self, arl_cookie: str, content_type: str, content_id: str) -> tuple:
+        """
+        Creates a task and queues it for a download worker, unless a task is already downloading the
+        same content in the sound format the account gets, in which case the request shares that task.
+        The account is looked up first, so that requests with an invalid ARL cookie never attach.
+
+        Returns:
+            Tuple of the task ID, its 1-based position in the queue (None if it left the queue) and the
+            ID of the request, which releases the task once it has downloaded the zip
+
+        Raises:
+            DeezerException: If the account cannot be looked up (Deezer403Exception if the ARL cookie is
+                not logged in)
+            QueueFullError: If the queue is full; the task is removed, or marked failed for the requests
+                that attached to it meanwhile
+        """
+        content_key = download_content_key(content_type, content_id, resolve_sound_format(arl_cookie))
+        requester_id = uuid.uuid4().hex
+        task_id = self.create_task_for_download()
+        shared_task_id = self.redis_manager.attach_or_claim_task(content_key, task_id, requester_id)
+        if shared_task_id != task_id:
+            self.redis_manager.remove_task(task_id)
+            app.logger.info(f"Attaching request for {content_type} {content_id} to task {shared_task_id}.")
+            return shared_task_id, self.job_queue.position(shared_task_id), requester_id
+        try:
+            position = self.job_queue.enqueue(task_id, {'arl_cookie': arl_cookie, 'content_type': content_type,
+                                                        'content_id': content_id})
+        except QueueFullError:
+            # Requests that attached in the meantime see the task fail; it is removed if none did
+            self.redis_manager.abandon_claimed_task(content_key, task_id, requester_id, QUEUE_FULL_MESSAGE)
+            raise
+        return task_id, position, requester_id
+
     def get_task_progress(self, task_id: str):
-        """Retrieves the progress for a given task ID from Redis."""
-        return self.redis_manager.get_task_progress(task_id)
+        """Retrieves the progress for a given task ID from Redis, with its live queue position."""
+        progress_data = self.redis_manager.get_task_progress(task_id)
+        if progress_data is not None:
+            progress_data[FIELD_QUEUE_POSITION] = self.job_queue.position(task_id)
+        return progress_data
+
+    def get_many_task_progress(self, task_ids: list) -> dict:
+        """Retrieves the progress of several tasks, with their live queue positions, in two Redis round trips."""
+        progress_by_task = self.redis_manager.get_many_task_progress(task_ids)
+        found_task_ids = [task_id for task_id, progress_data in progress_by_task.items() if progress_data is not None]
+        for task_id, position in self.job_queue.positions(found_task_ids).items():
+            progress_by_task[task_id][FIELD_QUEUE_POSITION] = position
+        return progress_by_task
+
+    def follow_task_progress(self, task_id: str):
+        """
+        Starts following the progress of a task, whose iterator yields its whole progress, with its
+        queue position, then each change to it, or None when nothing changed for
+        PROGRESS_KEEPALIVE_SECONDS. It yields nothing if the task is not found.
+
+        Returns:
+            Tuple of the subscription, to close once done, and the iterator
+
+        Raises:
+            StreamLimitError: If the process already follows MAX_PROGRESS_STREAMS progresses
+        """
+        subscription = self.progress_hub.subscribe(task_id, PROGRESS_KEEPALIVE_SECONDS)
+        return subscription, self._with_queue_positions(task_id, subscription)
+
+    def _with_queue_positions(self, task_id: str, updates):
+        position = None
+        for index, update in enumerate(updates):
+            if index == 0 or position is not None:
+                # Queue positions are not stored with the progress, they change as other tasks start
+                new_position = self.job_queue.position(task_id)
+                if index == 0 or new_position != position:
+                    update = dict(update or {}, **{FIELD_QUEUE_POSITION: new_position})
+                position = new_position
+            yield update
 
     def update_task_progress(self, task_id: str, **updates):
         """Updates the progress for a task in Redis."""
@@ -117,7 +200,6 @@ class TaskManager:
     def remove_task_data(self, task_id: str):
         """Removes a task's data from Redis and cleans up associated local files."""
         task_download_dir = os.path.join(DOWNLOADS_DIR, task_id)
-        zip_file_path = os.path.join(ZIPS_DIR, f"{task_id}.zip")
 
         if os.path.exists(task_download_dir):
             try:
@@ -126,19 +208,56 @@ class TaskManager:
             except Exception as e:
                 app.logger.error(f"Error removing download directory {task_download_dir}: {e}")
 
-        if os.path.exists(zip_file_path):
-            try:
-                os.remove(zip_file_path)
-                app.logger.info(f"Removed zip file: {zip_file_path}")
-            except Exception as e:
-                app.logger.error(f"Error removing zip file {zip_file_path}: {e}")
-
         removed_from_redis = self.redis_manager.remove_task(task_id)
         if removed_from_redis:
             app.logger.info(f"Task {task_id} removed from Redis.")
         else:
             app.logger.warning(f"Attempted to remove task {task_id} from Redis, but it was not found.")
 
+    def iter_task_files(self, task_id: str):
+        """
+        Yields the paths of a task's files as it finishes downloading them, until the task is finished.
+
+        If the task is run again, e.g. because its worker died, before any file was yielded, the files
+        of the new run are yielded instead.
+
+        Raises:
+            RuntimeError: If the task fails or expires before finishing, or is run again after some of
+                its files were yielded
+        """
+        task_download_dir = os.path.join(DOWNLOADS_DIR, task_id)
+        sent = 0
+        run = None
+        while True:
+            # The state and the files are read together, so that none recorded before the task finished
+            # is missed and all belong to the same run
+            progress_data, file_names = self.redis_manager.get_task_progress_and_files(task_id, sent)
+            if progress_data is None:
+                raise RuntimeError(f"Task {task_id} expired while its zip was being streamed")
+            if sent and progress_data[FIELD_RUN] != run:
+                # The files sent may be gone or downloaded again in another order: the zip cannot be completed
+                raise RuntimeError(f"Task {task_id} was run again while its zip was being streamed")
+            run = progress_data[FIELD_RUN]
+
+            for file_name in file_names:
+                yield os.path.join(task_download_dir, file_name)
+            sent += len(file_names)
+
+            if progress_data.get(FIELD_FINISHED):
+                if not progress_data.get(FIELD_ZIP_READY):
+                    raise RuntimeError(f"Task {task_id} failed while its zip was being streamed: "
+                                       f"{progress_data.get(FIELD_ERROR)}")
+                return
+            if not file_names:
+                time.sleep(self.stream_poll_seconds)
+
+    def release_task_data(self, task_id: str, requester_id: str):
+        """Drops a requester of a task, removing its data once no requester still needs it."""
+        if self.redis_manager.release_task(task_id, requester_id):
+            self.remove_task_data(task_id)
+        else:
+            app.logger.info(f"Keeping data of task {task_id}, other requests still have to download it.")
+
     def _cleanup_stale_task_files_periodically(self):
         """Periodically scans for and cleans up orphaned task files."""
         app.logger.info("Task file cleanup thread started.")
@@ -146,25 +265,14 @@ class TaskManager:
             try:
                 # Check DOWNLOADS_DIR for orphaned task directories
                 if os.path.exists(DOWNLOADS_DIR):
-                    for item_name in os.listdir(DOWNLOADS_DIR):
-                        item_path = os.path.join(DOWNLOADS_DIR, item_name)
-                        if os.path.isdir(item_path):
-                            # Assuming item_name is a task_id
-                            task_id = item_name
-                            if self.redis_manager.get_task_progress(task_id) is None:
-                                app.logger.info(
-                                    f"Cleanup thread: Found orphaned download dir for task {task_id}. Removing.")
-                                self.remove_task_data(task_id)
-
-                                # Check ZIPS_DIR for orphaned zip files
-                if os.path.exists(ZIPS_DIR):
-                    for item_name in os.listdir(ZIPS_DIR):
-                        if item_name.endswith('.zip'):
-                            task_id = item_name[:-4]
-                            if self.redis_manager.get_task_progress(task_id) is None:
-                                app.logger.info(
-                                    f"Cleanup thread: Found orphaned zip file for task {task_id}. Removing.")
-                                self.remove_task_data(task_id)
+                    # Assuming directory names are task IDs, looked up all at once
+                    task_ids = [item_name for item_name in os.listdir(DOWNLOADS_DIR)
+                                if os.path.isdir(os.path.join(DOWNLOADS_DIR, item_name))]
+                    for task_id, progress_data in self.redis_manager.get_many_task_progress(task_ids).items():
+                        if progress_data is None:
+                            app.logger.info(
+                                f"Cleanup thread: Found orphaned download dir for task {task_id}. Removing.")
+                            self.remove_task_data(task_id)
 
             except Exception as e:
                 app.logger.error(f"Error in cleanup thread: {e}")
@@ -183,85 +291,20 @@ class TaskManager:
             app.logger.info("Cleanup thread stopped successfully.")
 
 
-task_manager = TaskManager(redis_manager)
+task_manager = TaskManager(redis_manager, download_queue, ProgressHub(redis_manager, MAX_PROGRESS_STREAMS))
 
 # Graceful shutdown
 import atexit
 
 atexit.register(task_manager.stop_cleanup_thread)
 
-# --- Background Download Logic ---
-
-def _execute_download_in_background(arl_cookie, content_type_val, content_id_val, task_id):
-    """Target function for the download thread, uses Redis for progress."""
-    app.logger.info(f"Starting background download for task {task_id}: {content_type_val}/{content_id_val}")
-
-    task_specific_download_dir = os.path.join(DOWNLOADS_DIR, task_id)
-    try:
-        os.makedirs(task_specific_download_dir, exist_ok=True)
-    except Exception as e:
-        app.logger.error(f"Failed to create download directory {task_specific_download_dir} for task {task_id}: {e}")
-        task_manager.update_task_progress(task_id,
-                                          **{FIELD_ERROR: 'Failed to create download directory.', FIELD_FINISHED: True})
-        return
-
-    config = DeezerConfig(cookie_arl=arl_cookie, download_folder=task_specific_download_dir)
-    client = DeezerClient(config=config, redis_manager=task_manager.redis_manager, task_id=task_id)
-    client.initialize()
-
-    download_actions = {
-        'track': client.download_track,
-        'album': client.download_album,
-        'playlist': client.download_playlist,
-    }
-    action = download_actions.get(content_type_val)
-
-    try:
-        if not action:
-            err_msg = f'Unsupported content type in thread: {content_type_val}'
-            app.logger.error(err_msg)
-            task_manager.update_task_progress(task_id, **{FIELD_ERROR: err_msg, FIELD_FINISHED: True})
-            return
-
-        downloaded_file_paths = action(content_id_val)
-
-        if not downloaded_file_paths:
-            app.logger.info(
-                f"Task {task_id}: No files were downloaded by the client (e.g., empty playlist or all tracks failed).")
-            task_manager.update_task_progress(task_id,
-                                              **{FIELD_ERROR: 'No files were downloaded.', FIELD_FINISHED: True})
-            shutil.rmtree(task_specific_download_dir)
-            return
-
-        app.logger.info(f"Task {task_id}: Download client finished. {len(downloaded_file_paths)} items processed.")
-
-        zip_filename_base = task_id
-        zip_archive_path_base = os.path.join(ZIPS_DIR, zip_filename_base)
-
-        app.logger.info(
-            f"Task {task_id}: Attempting to create zip archive from {task_specific_download_dir} to {zip_archive_path_base}.zip")
-        shutil.make_archive(zip_archive_path_base, 'zip', root_dir=task_specific_download_dir)
-        app.logger.info(f"Task {task_id}: Successfully created zip archive at {zip_archive_path_base}.zip")
-
-        task_manager.update_task_progress(task_id, **{FIELD_ZIP_READY: True, FIELD_FINISHED: True})
-        app.logger.info(f"Task {task_id}: Progress updated - zip ready and finished.")
-
-    except DeezerException as e:
-        app.logger.error(f"DeezerException in background task {task_id}: {str(e)}")
-        task_manager.update_task_progress(task_id, **{FIELD_ERROR: str(e), FIELD_FINISHED: True})
-    except Exception as e:
-        app.logger.error(f"Unexpected exception in background task {task_id}: {str(e)}", exc_info=True)
-        task_manager.update_task_progress(task_id,
-                                          **{FIELD_ERROR: 'An unexpected server error occurred during processing.',
-                                             FIELD_FINISHED: True})
-    finally:
-        if os.path.exists(task_specific_download_dir):
-            try:
-                shutil.rmtree(task_specific_download_dir)
-                app.logger.info(f"Task {task_id}: Cleaned up source directory {task_specific_download_dir}")
-            except Exception as e:
-                app.logger.error(
-                    f"Task {task_id}: Error cleaning up source directory {task_specific_download_dir}: {e}")
+if EMBEDDED_WORKERS == 0 and not SHARED_DATA_DIR:
+    app.logger.warning("EMBEDDED_WORKERS=0 without DATA_DIR: download workers cannot start, as they would "
+                       "write tracks this process cannot read. Set DATA_DIR to a directory shared with them.")
+if EMBEDDED_WORKERS > 0:
+    embedded_workers_stop = threading.Event()
+    start_workers(EMBEDDED_WORKERS, embedded_workers_stop)
+    atexit.register(embedded_workers_stop.set)
 
 # --- Routes ---
 
@@ -290,18 +333,79 @@ def download():
         return jsonify({'error': f'Unsupported content type: {content_type}'}), 400
 
     try:
-        task_id = task_manager.create_task_for_download()
+        task_id, position, requester_id = task_manager.enqueue_download(arl_cookie, content_type, content_id)
+    except Deezer403Exception as e:
+        app.logger.info(f"Rejecting download request, the account could not be logged in to: {e}")
+        return jsonify({'error': 'Invalid ARL cookie: it does not log in to a Deezer account.'}), 401
+    except DeezerException as e:
+        app.logger.warning(f"Rejecting download request, the account could not be looked up: {e}")
+        return jsonify({'error': 'Could not reach Deezer. Please try again in a moment.'}), 502
+    except QueueFullError as e:
+        app.logger.warning(f"Rejecting download request, queue is full: {e}")
+        response = jsonify({'error': QUEUE_FULL_MESSAGE})
+        response.headers['Retry-After'] = str(QUEUE_RETRY_AFTER_SECONDS)
+        return response, 429
     except Exception as e:
         app.logger.error(f"Failed to create task in Redis: {e}")
         return jsonify({'error': 'Failed to initiate download task. Please try again.'}), 500
 
-    app.logger.info(f"Download request validated. Task ID: {task_id}. Starting background thread.")
-    thread = threading.Thread(target=_execute_download_in_background, args=(
-        arl_cookie, content_type, content_id, task_id
-    ))
-    thread.start()
+    app.logger.info(f"Download request validated. Task ID: {task_id}. Queued at position {position}.")
+
+    return jsonify({'success': True, 'task_id': task_id, 'requester_id': requester_id, 'queue_position': position})
+
+
+track_stream_slots = threading.BoundedSemaphore(MAX_TRACK_STREAMS)
+
+
+@app.route('/stream_track', methods=['POST'])
+def stream_track():
+    """
+    Sends a single track as it is downloaded and decrypted, without queuing a task or writing to disk.
+    Its Deezer requests share the rate limits of the download workers, and at most MAX_TRACK_STREAMS
+    tracks are sent at once.
+    """
+    app.logger.info("Received stream_track request")
+    arl_cookie, error_msg = validate_arl_cookie(request.form.get('arl_cookie', ''))
+    if error_msg:
+        return jsonify({'error': error_msg}), 400
+
+    content_type, content_id = parse_deezer_url(request.form.get('url', ''))
+    if content_type != 'track' or not content_id:
+        return jsonify({'error': 'Invalid Deezer track URL'}), 400
 
-    return jsonify({'success': True, 'task_id': task_id})
+    if not track_stream_slots.acquire(blocking=False):
+        app.logger.warning(f"Rejecting stream_track request, {MAX_TRACK_STREAMS} tracks already streaming")
+        response = jsonify({'error': QUEUE_FULL_MESSAGE})
+        response.headers['Retry-After'] = str(QUEUE_RETRY_AFTER_SECONDS)
+        return response, 429
+    try:
+        response = app.make_response(start_track_stream(arl_cookie, content_id))
+    except BaseException:
+        track_stream_slots.release()
+        raise
+    # The slot is held until the whole track was sent, or the browser went away
+    response.call_on_close(track_stream_slots.release)
+    return response
+
+
+def start_track_stream(arl_cookie, content_id):
+    """Response of /stream_track passing a track through, or the error it could not be started with."""
+    try:
+        file_name, size, chunks = open_track_stream(arl_cookie, content_id)
+    except Deezer404Exception as e:
+        return jsonify({'error': str(e)}), 404
+    except Deezer403Exception as e:
+        return jsonify({'error': str(e)}), 403
+    except DeezerException as e:
+        app.logger.error(f"Failed to start streaming track {content_id}: {e}")
+        return jsonify({'error': str(e)}), 502
+
+    headers = {'Content-Disposition': content_disposition(file_name)}
+    if size is not None:
+        headers['Content-Length'] = str(size)
+    app.logger.info(f"Streaming track {content_id} as {file_name}")
+    return Response(chunks, mimetype='audio/flac' if file_name.endswith('.flac') else 'audio/mpeg',
+                    headers=headers)
 
 
 @app.route('/progress', methods=['GET'])
@@ -310,16 +414,56 @@ def progress():
     progress_data = task_manager.get_task_progress(task_id)
 
     if progress_data is None:
-        zip_file_path = os.path.join(ZIPS_DIR, f"{task_id}.zip")
-        if os.path.exists(zip_file_path):
-            return jsonify({'error': 'Task data not found but zip exists. Please try downloading the zip.',
-                            'zip_potentially_available': True}), 404
         return jsonify({'error': 'Task not found or has expired.', 'finished': True,
                         'error': 'Task not found or has expired.'}), 404
 
     return jsonify(progress_data)
 
 
+@app.route('/progress/batch', methods=['POST'])
+def progress_batch():
+    """Progress of several tasks at once: takes {"task_ids": [...]}, returns {"tasks": {task_id: progress}}."""
+    payload = request.get_json(silent=True) or {}
+    task_ids = payload.get('task_ids')
+    if not isinstance(task_ids, list) or not all(isinstance(task_id, str) for task_id in task_ids):
+        return jsonify({'error': 'task_ids must be a list of task IDs.'}), 400
+    if len(task_ids) > MAX_BATCH_TASKS:
+        return jsonify({'error': f'At most {MAX_BATCH_TASKS} task IDs can be requested at once.'}), 400
+
+    # Tasks not found or expired are returned as null
+    return jsonify({'tasks': task_manager.get_many_task_progress(list(dict.fromkeys(task_ids)))})
+
+
+@app.route('/progress/stream/<task_id>', methods=['GET'])
+def progress_stream(task_id):
+    """Pushes the progress of a task as Server-Sent Events: its whole state, then each change until it finishes."""
+    if task_manager.get_task_progress(task_id) is None:
+        return jsonify({'error': 'Task not found or has expired.', 'finished': True}), 404
+
+    try:
+        subscription, updates = task_manager.follow_task_progress(task_id)
+    except StreamLimitError as e:
+        # The page polls /progress instead when its stream cannot be opened
+        app.logger.warning(f"Rejecting progress stream for task {task_id}: {e}")
+        return jsonify({'error': 'Too many progress streams open, poll /progress instead.'}), 503
+
+    def generate_events():
+        for update in updates:
+            if update is None:
+                # Keeps proxies from closing the idle connection
+                yield ": keep-alive\n\n"
+                continue
+            yield f"data: {json.dumps(update)}\n\n"
+            if update.get(FIELD_FINISHED):
+                return
+
+    response = Response(generate_events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also run when the client disconnects before the stream was started
+    response.call_on_close(subscription.close)
+    return response
+
+
 @app.route('/download_zip/<task_id>', methods=['GET'])
 def download_zip(task_id):
     app.logger.info(f"Received download_zip request for task_id: {task_id}")
@@ -328,35 +472,40 @@ def download_zip(task_id):
     if progress_data is None:
         return jsonify({'error': 'Task not found or has expired.'}), 404
 
-    if not progress_data.get(FIELD_ZIP_READY):
+    if progress_data.get(FIELD_FINISHED) and not progress_data.get(FIELD_ZIP_READY):
         err_msg = 'Zip file is not ready.'
         if progress_data.get(FIELD_ERROR):
             err_msg = f"Download failed: {progress_data.get(FIELD_ERROR)}"
-        elif not progress_data.get(FIELD_FINISHED):
-            err_msg = 'Download is still in progress.'
         return jsonify({'error': err_msg}), 400
 
-    zip_filename = f"{task_id}.zip"
-    zip_file_full_path = os.path.join(ZIPS_DIR, zip_filename)
-
-    if not os.path.exists(zip_file_full_path):
+    task_download_dir = os.path.join(DOWNLOADS_DIR, task_id)
+    if progress_data.get(FIELD_ZIP_READY) and not os.path.isdir(task_download_dir):
         app.logger.error(
-            f"Zip file {zip_file_full_path} not found on disk for task {task_id}, though Redis reported zip_ready.")
+            f"Download directory {task_download_dir} not found for task {task_id}, though Redis reported zip_ready.")
         task_manager.update_task_progress(task_id,
                                           **{FIELD_ERROR: 'Zip file missing on server.', FIELD_ZIP_READY: False})
         return jsonify({'error': 'Zip file not found on server. Please try the download again.'}), 404
 
-    @after_this_request
-    def cleanup_files_after_request(response):
-        app.logger.info(f"Cleaning up task data for {task_id} after zip download.")
+    # Given by /download; without it the download does not release the task, whose data then stays
+    # until it expires
+    requester_id = request.args.get('requester')
+
+    # The zip is built while it is sent: tracks already downloaded go out right away, later ones as the
+    # task finishes them, and the central directory once it is done
+    def generate_zip():
+        yield from stream_zip(task_manager.iter_task_files(task_id))
+        if not requester_id:
+            return
+        # Only once the whole zip was sent, so that a client that got disconnected can try again
+        app.logger.info(f"Releasing task {task_id} for requester {requester_id} after zip download.")
         try:
-            task_manager.remove_task_data(task_id)
+            task_manager.release_task_data(task_id, requester_id)
         except Exception as e:
             app.logger.error(f"Error during post-download cleanup for task {task_id}: {e}")
-        return response
 
-    app.logger.info(f"Sending zip file {zip_filename} for task {task_id}")
-    return send_from_directory(ZIPS_DIR, zip_filename, as_attachment=True)
+    app.logger.info(f"Streaming zip file for task {task_id}")
+    return Response(generate_zip(), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={task_id}.zip'})
 
 
 if __name__ == '__main__':
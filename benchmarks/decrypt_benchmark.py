@@ -0,0 +1,78 @@
+"""
+Compare DeezerCrypto.decrypt_file against the previous per-chunk implementation.
+
+Usage: python -m benchmarks.decrypt_benchmark [size_mb]
+"""
+import io
+import os
+import sys
+import time
+
+from Crypto.Cipher import Blowfish
+
+from deezer_downloader.crypto import DeezerCrypto
+
+
+class FakeResponse:
+    """Minimal stand-in for a streamed requests Response"""
+
+    def __init__(self, payload: bytes):
+        self.raw = io.BytesIO(payload)
+
+    def iter_content(self, chunk_size):
+        while True:
+            data = self.raw.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+def legacy_decrypt_file(file_handle, key: str, output_handle):
+    """The original implementation: one cipher per encrypted block and one write per block"""
+    block_size = 2048
+    block_index = 0
+
+    for data in file_handle.iter_content(block_size):
+        if not data:
+            break
+
+        if block_index % 3 == 0 and len(data) == block_size:
+            cipher = Blowfish.new(key.encode(), Blowfish.MODE_CBC, DeezerCrypto.IV)
+            data = cipher.decrypt(data)
+
+        output_handle.write(data)
+        block_index += 1
+
+
+def measure(decrypt, payload: bytes, key: str, rounds: int = 3):
+    best = None
+    output = None
+    for _ in range(rounds):
+        output = io.BytesIO()
+        start = time.perf_counter()
+        decrypt(FakeResponse(payload), key, output)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output.getvalue()
+
+
+def main():
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 40
+    # Odd size so the short, unencrypted final block is exercised
+    payload = os.urandom(int(size_mb * 1024 * 1024) + 1234)
+    key = DeezerCrypto.calc_blowfish_key("3135556")
+
+    legacy_time, legacy_output = measure(legacy_decrypt_file, payload, key)
+    new_time, new_output = measure(DeezerCrypto.decrypt_file, payload, key)
+
+    if legacy_output != new_output:
+        raise SystemExit("Output mismatch between implementations")
+
+    size = len(payload) / (1024 * 1024)
+    print(f"payload:  {size:.1f} MB")
+    print(f"legacy:   {size / legacy_time:8.1f} MB/s")
+    print(f"striped:  {size / new_time:8.1f} MB/s ({legacy_time / new_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
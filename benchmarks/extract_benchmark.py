@@ -0,0 +1,129 @@
+"""
+Compare AppStateExtractor against the previous ScriptExtractor + regex + json.loads parsing.
+
+Usage: python -m benchmarks.extract_benchmark [page.html ...]
+
+Pass pages saved from deezer.com (e.g. album or track pages fetched while logged in). Without
+arguments, the pages saved in benchmarks/pages/ are used, or a synthetic album page with 100
+tracks if there are none. Saved pages are not committed: their app state holds the tokens of
+the account that fetched them.
+"""
+import glob
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+from html.parser import HTMLParser
+
+from deezer_downloader.extractor import AppStateExtractor
+
+CHUNK_SIZE = 16 * 1024
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages")
+
+
+class ScriptExtractor(HTMLParser):
+    """The previous parser: collects every <script> body of the page"""
+
+    def __init__(self):
+        super().__init__()
+        self.scripts = []
+        self.current_tag = None
+
+    def handle_starttag(self, tag, attrs):
+        self.current_tag = tag.lower()
+
+    def handle_data(self, data):
+        if self.current_tag == "script":
+            self.scripts.append(data)
+
+    def handle_endtag(self, tag):
+        self.current_tag = None
+
+
+def legacy_extract(page: bytes, page_type: str):
+    text = page.decode("utf-8")
+    if "MD5_ORIGIN" not in text:
+        raise ValueError("Authentication required")
+
+    parser = ScriptExtractor()
+    parser.feed(text)
+    parser.close()
+
+    for script in parser.scripts:
+        regex = re.search(r'{"DATA":.*', script)
+        if regex:
+            data = json.loads(regex.group())
+            if data['DATA']['__TYPE__'] == page_type:
+                return data
+    return None
+
+
+def streaming_extract(page: bytes, page_type: str):
+    extractor = AppStateExtractor(page_type)
+    for start in range(0, len(page), CHUNK_SIZE):
+        state = extractor.feed(page[start:start + CHUNK_SIZE])
+        if state is not None:
+            return state
+    return None
+
+
+def synthetic_album_page(track_count: int = 100) -> bytes:
+    songs = [{
+        "SNG_ID": str(1000 + i), "SNG_TITLE": f"Track {i}", "ART_NAME": "Artist", "ALB_TITLE": "Album",
+        "MD5_ORIGIN": "0" * 32, "TRACK_TOKEN": "t" * 400, "TRACK_TOKEN_EXPIRE": 0,
+        "LYRICS": {"text": "la " * 300},
+    } for i in range(track_count)]
+    state = {"DATA": {"__TYPE__": "album", "ALB_TITLE": "Album"}, "SONGS": {"data": songs}}
+    filler = "".join(f"<script>var module{i} = '{'x' * 2000}';</script>\n" for i in range(150))
+    return (
+        "<!DOCTYPE html><html><head><title>Album</title>\n" + filler + "</head><body>"
+        + "<div>" * 50 + "content " * 5000 + "</div>" * 50
+        + f"<script>window.__DZR_APP_STATE__ = {json.dumps(state)}</script>\n"
+        + filler + "</body></html>"
+    ).encode("utf-8")
+
+
+def detect_page_type(page: bytes) -> str:
+    match = re.search(rb'"__TYPE__":"(\w+)"', page)
+    return match.group(1).decode() if match else "album"
+
+
+def measure(extract, page: bytes, page_type: str, rounds: int = 20):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        extract(page, page_type)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    result = extract(page, page_type)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def main():
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(PAGES_DIR, "*.html")))
+    if paths:
+        pages = [(path, open(path, "rb").read()) for path in paths]
+    else:
+        pages = [("synthetic album page", synthetic_album_page())]
+
+    for name, page in pages:
+        page_type = detect_page_type(page)
+        legacy_time, legacy_peak, legacy_result = measure(legacy_extract, page, page_type)
+        new_time, new_peak, new_result = measure(streaming_extract, page, page_type)
+
+        if legacy_result != new_result:
+            raise SystemExit(f"{name}: extracted states differ")
+
+        print(f"{name} ({len(page) / 1024:.0f} KB, {page_type})")
+        print(f"  legacy:    {legacy_time * 1000:7.2f} ms, peak {legacy_peak / 1024:8.0f} KB")
+        print(f"  streaming: {new_time * 1000:7.2f} ms, peak {new_peak / 1024:8.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
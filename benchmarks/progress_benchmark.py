@@ -0,0 +1,79 @@
+"""
+Compare RedisManager progress updates against the previous read-modify-write implementation.
+
+Runs against the Redis at REDIS_URL (default redis://localhost:6379/0), using throwaway tasks.
+
+Usage: python -m benchmarks.progress_benchmark [updates] [threads]
+"""
+import sys
+import threading
+import time
+
+from progress_tracker import FIELD_CURRENT
+from redis_manager import RedisManager
+
+
+def legacy_update(manager: RedisManager, task_id: str, **updates):
+    """The original implementation: HGETALL and parse, then rewrite every field and the expiry"""
+    progress = manager.get_task_progress(task_id)
+    if progress is None:
+        return False
+    progress.update(updates)
+    pipe = manager.redis.pipeline()
+    pipe.hset(manager._get_key(task_id), mapping={k: str(v) for k, v in progress.items()})
+    pipe.expire(manager._get_key(task_id), manager.expire_hours * 3600)
+    pipe.execute()
+    return True
+
+
+def legacy_track_done(manager: RedisManager, task_id: str):
+    """Completed-track update as the clients made it, from a count read back from Redis"""
+    progress = manager.get_task_progress(task_id)
+    legacy_update(manager, task_id, **{FIELD_CURRENT: progress[FIELD_CURRENT] + 1})
+
+
+def measure(update, manager: RedisManager, updates: int, threads: int):
+    """Run updates spread over threads on a fresh task; returns the rate and the final count"""
+    task_id = manager.create_task()
+    per_thread = updates // threads
+
+    def run():
+        for _ in range(per_thread):
+            update(manager, task_id)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    count = manager.get_task_progress(task_id)[FIELD_CURRENT]
+    manager.remove_task(task_id)
+    return per_thread * threads / elapsed, count
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    manager = RedisManager()
+    expected = updates // threads * threads
+
+    # Name, update, threads, whether it counts completed tracks
+    cases = [
+        ("legacy update", lambda m, t: legacy_update(m, t, starting=False), 1, False),
+        ("partial update", lambda m, t: m.update_task_progress(t, starting=False), 1, False),
+        ("legacy track done", legacy_track_done, threads, True),
+        ("increment", lambda m, t: m.increment_task_progress(t, FIELD_CURRENT), threads, True),
+    ]
+
+    print(f"updates: {expected}, threads counting tracks: {threads}")
+    for name, update, case_threads, counts_tracks in cases:
+        rate, count = measure(update, manager, updates, case_threads)
+        lost = f", {expected - count} completed tracks lost" if counts_tracks else ""
+        print(f"{name:18} {rate:9.0f} updates/s{lost}")
+
+
+if __name__ == "__main__":
+    main()
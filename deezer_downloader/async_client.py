@@ -0,0 +1,517 @@
+import asyncio
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, AsyncIterator, Iterable, Optional, Set, Tuple
+import aiohttp
+from .config import DeezerConfig
+from .crypto import DeezerCrypto
+from .client import DeezerClient
+from .sessions import DeezerSession
+from .transfer import PartFileDecryption
+from .track_urls import TrackUrls
+from .gw_api import GW_API_PATH, PlaylistPager, gw_api_params, gw_api_results
+from .extractor import AppStateExtractor
+from .exceptions import DeezerException, DeezerApiException, Deezer403Exception, Deezer404Exception
+from redis_manager import RedisManager
+from progress_tracker import FIELD_STARTING, FIELD_CURRENT, FIELD_TOTAL, FIELD_FAILED, FIELD_FAILED_PAGES, FIELD_ERROR
+from logging_config import logger
+
+
+class AsyncDeezerSession:
+    """
+    asyncio counterpart of DeezerSession, holding the user data of an account and an aiohttp
+    connection pool shared by every request of the account
+    """
+
+    WWW_URL = DeezerSession.WWW_URL
+    # After an authentication failure, do not initialize again if that was done this recently
+    REVALIDATE_INTERVAL_SECONDS = DeezerSession.REVALIDATE_INTERVAL_SECONDS
+
+    def __init__(self, config: DeezerConfig):
+        self.config = config
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.license_token: Optional[str] = None
+        # CSRF token (checkForm) required by gw-light API calls
+        self.api_token: Optional[str] = None
+        self.sound_format: str = "MP3_128"
+        self.initialized_at: Optional[float] = None
+        self._init_lock = asyncio.Lock()
+
+    async def open(self):
+        """Create the connection pool; must be called from the event loop it will be used on"""
+        if self.session is not None:
+            return
+        headers = DeezerSession.default_headers(self.config)
+        # aiohttp only decodes brotli when the optional Brotli package is installed
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session = aiohttp.ClientSession(
+            headers=headers,
+            cookies={'arl': self.config.cookie_arl, 'comeback': '1'},
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.config.cdn_pool_size),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.config.download_timeout,
+                                          sock_read=self.config.download_timeout)
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def request(self, method: str, url: str, **kwargs):
+        """Send a request over the pooled connections, for use as an async context manager"""
+        return self.session.request(method, url, **kwargs)
+
+    async def initialize_session(self):
+        """Initialize session with user data and quality settings"""
+        user_data = await self._get_user_data()
+        self.license_token = user_data['license_token']
+        self.api_token = user_data['api_token']
+        self.sound_format = DeezerSession.choose_sound_format(self.config.quality, user_data['web_sound_quality'])
+        self.initialized_at = time.time()
+
+    async def ensure_initialized(self, max_age_seconds: float):
+        """Initialize the session unless it was initialized less than max_age_seconds ago"""
+        async with self._init_lock:
+            if self.initialized_at is None or time.time() - self.initialized_at > max_age_seconds:
+                await self.initialize_session()
+
+    async def revalidate(self):
+        """Initialize the session again after an authentication failure, unless another task just did"""
+        async with self._init_lock:
+            if self.initialized_at is None or time.time() - self.initialized_at > self.REVALIDATE_INTERVAL_SECONDS:
+                logger.info("Revalidating Deezer session")
+                await self.initialize_session()
+
+    async def get_api_token(self, refresh: bool = False) -> str:
+        """Get the CSRF token for gw-light API calls, fetching it only if unknown or refresh is set"""
+        if refresh or not self.api_token:
+            self.api_token = (await self._get_user_data())['api_token']
+        return self.api_token
+
+    async def _get_user_data(self) -> Dict[str, Any]:
+        try:
+            async with self.request('GET', f"{self.WWW_URL}{GW_API_PATH}",
+                                    params=gw_api_params('deezer.getUserData', '')) as response:
+                response.raise_for_status()
+                return DeezerSession.parse_user_data(await response.json(content_type=None))
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+            raise DeezerApiException(f"Failed to get user data: {e}")
+
+
+class AsyncDeezerClient:
+    """
+    asyncio counterpart of DeezerClient
+
+    One event loop can run many clients, each keeping config.max_workers tracks in flight, while
+    metadata calls and CDN streams of all of them are multiplexed over aiohttp. Decryption and
+    file writes run in a thread pool so they never block the loop. Interrupted transfers resume
+    with Range requests like in DeezerClient.
+
+    Use as an async context manager, which opens and initializes the session and closes it on exit:
+
+        async with AsyncDeezerClient(config) as client:
+            paths = await client.download_album(album_id)
+    """
+
+    GET_URL_ENDPOINT = TrackUrls.GET_URL_ENDPOINT
+    # Tracks fetched per deezer.pagePlaylist call
+    PLAYLIST_PAGE_SIZE = DeezerClient.PLAYLIST_PAGE_SIZE
+    PAGES = DeezerClient.PAGES
+    # Bytes read at a time when scanning a page for its app state
+    PAGE_CHUNK_SIZE = DeezerClient.PAGE_CHUNK_SIZE
+
+    # Naming of output files and completeness checks of listing metadata are the threaded client's
+    _is_complete_track_info = DeezerClient._is_complete_track_info
+    _prepare_output_path = DeezerClient._prepare_output_path
+    _get_file_name = DeezerClient._get_file_name
+    _get_file_stem = DeezerClient._get_file_stem
+    _unique_file_stem = DeezerClient._unique_file_stem
+    _get_file_extension = DeezerClient._get_file_extension
+
+    def __init__(self, config: DeezerConfig, redis_manager: Optional[RedisManager] = None,
+                 task_id: Optional[str] = None, session: Optional[AsyncDeezerSession] = None,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        """
+        Args:
+            config: Client configuration
+            redis_manager: Progress of task_id is reported here when given
+            task_id: ID of the task the downloads belong to
+            session: Session to share with other clients of the same account; opened and closed
+                by this client when not given
+            executor: Thread pool to decrypt and write tracks in; one of config.max_workers
+                threads is created when not given
+        """
+        self.config = config
+        self.redis_manager = redis_manager
+        self.task_id = task_id
+        self.session = session or AsyncDeezerSession(config)
+        self._owns_session = session is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=max(1, config.max_workers))
+        self._owns_executor = executor is None
+        # Resolved track URLs; requests for them are built and parsed as in TrackUrlResolver
+        self.urls = TrackUrls()
+
+    async def __aenter__(self) -> "AsyncDeezerClient":
+        await self.initialize()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def initialize(self):
+        """Open the session and initialize it, unless it is shared and still fresh"""
+        await self.session.open()
+        await self.session.ensure_initialized(self.config.session_max_age)
+
+    async def close(self):
+        """Close the session and executor, unless they were given to the client"""
+        if self._owns_session:
+            await self.session.close()
+        if self._owns_executor:
+            self._executor.shutdown(wait=False)
+
+    async def download_track(self, track_id: str, output_path: Optional[str] = None,
+                             track_info: Optional[Dict[str, Any]] = None, file_stem: Optional[str] = None) -> str:
+        """
+        Download a single track by ID
+
+        Args:
+            track_id: Deezer track ID
+            output_path: Optional custom output path
+            track_info: Optional track metadata already known, e.g. from an album or playlist listing
+            file_stem: Optional file name without extension to use instead of 'Artist - Title'
+
+        Returns:
+            Path to downloaded file
+        """
+        listing_info = self._is_complete_track_info(track_info)
+        if not listing_info:
+            track_info = await self._get_track_info(track_id)
+
+        try:
+            source_info, url, sound_format = await self._resolve_track_url(track_info)
+        except DeezerApiException as e:
+            if not listing_info:
+                raise
+            logger.info(f"Listing data not usable for track {track_id} ({e}), fetching track page...")
+            track_info = await self._get_track_info(track_id)
+            source_info, url, sound_format = await self._resolve_track_url(track_info)
+
+        output_path = await self._run(self._prepare_output_path, track_info, sound_format, output_path, file_stem)
+        await self._download_and_decrypt_track(source_info, url, output_path)
+        return output_path
+
+    async def download_album(self, album_id: str) -> List[str]:
+        """
+        Download all tracks in an album
+
+        Returns:
+            List of paths to downloaded files
+        """
+        tracks = await self._get_album_tracks(album_id)
+        album_title = tracks[0]['ALB_TITLE'] if tracks else "Unknown Album"
+        await self._update_progress(**{FIELD_STARTING: False, FIELD_CURRENT: 0, FIELD_FAILED: 0,
+                                       FIELD_TOTAL: len(tracks), FIELD_ERROR: None})
+        logger.info(f"Downloading album '{album_title}' ({len(tracks)} tracks) for task {self.task_id}")
+
+        async def pages():
+            yield tracks
+
+        return await self._download_tracks(pages(), len(tracks))
+
+    async def download_playlist(self, playlist_id: str) -> List[str]:
+        """
+        Download all tracks in a playlist, starting on the first page while later ones are fetched
+
+        A later page that cannot be fetched is skipped and its tracks counted as failed.
+
+        Returns:
+            List of paths to downloaded files
+        """
+        pages = self._iter_playlist_pages(playlist_id)
+        playlist_name, total, first_page = await pages.__anext__()
+        await self._update_progress(**{FIELD_STARTING: False, FIELD_CURRENT: 0, FIELD_FAILED: 0,
+                                       FIELD_FAILED_PAGES: 0, FIELD_TOTAL: total, FIELD_ERROR: None})
+        logger.info(f"Downloading playlist '{playlist_name}' ({total} tracks) for task {self.task_id}")
+
+        async def tracks():
+            yield first_page
+            async for _, _, page in pages:
+                yield page
+
+        return await self._download_tracks(tracks(), total)
+
+    async def _download_tracks(self, pages: AsyncIterator[List[Dict[str, Any]]], total: int) -> List[str]:
+        """
+        Download tracks concurrently, up to config.max_workers at a time
+
+        A failing track is logged, counted as failed and skipped without affecting the others.
+        Tracks sharing an artist and title get numbered file names, as in DeezerClient.
+
+        Returns:
+            Paths of the downloaded files, in track order
+        """
+        slots = asyncio.Semaphore(max(1, self.config.max_workers))
+        file_stems: Set[str] = set()
+
+        async def download(index: int, track: Dict[str, Any], file_stem: str) -> Optional[str]:
+            async with slots:
+                path = None
+                try:
+                    logger.info(f"[{index}/{total}] Downloading: {track['SNG_TITLE']}")
+                    path = await self.download_track(str(track['SNG_ID']), track_info=track, file_stem=file_stem)
+                    return path
+                except DeezerException as e:
+                    logger.error(f"Failed to download track: {e}")
+                    return None
+                finally:
+                    await self._increment_progress(FIELD_CURRENT if path is not None else FIELD_FAILED)
+
+        tasks = []
+        async for page in pages:
+            # Resolve the CDN URLs of the whole page up front, in a few batched requests
+            await self._prefetch_urls(page)
+            for track in page:
+                file_stem = self._unique_file_stem(file_stems, track)
+                tasks.append(asyncio.create_task(download(len(tasks) + 1, track, file_stem)))
+
+        return [path for path in await asyncio.gather(*tasks) if path is not None]
+
+    async def _download_and_decrypt_track(self, track_info: Dict[str, Any], url: str, output_path: str):
+        """Download and decrypt a track, resuming an interrupted transfer with backoff"""
+        key = DeezerCrypto.calc_blowfish_key(track_info['SNG_ID'])
+        sink = await self._run(PartFileDecryption, key, output_path)
+
+        try:
+            url_refreshed = False
+            attempt = 0
+            while True:
+                offset = sink.offset
+                headers = dict(DeezerClient.TRACK_STREAM_HEADERS)
+                if offset:
+                    headers['Range'] = f"bytes={offset}-"
+                try:
+                    async with self.session.request('GET', url, headers=headers) as response:
+                        if response.status in (403, 410) and not url_refreshed:
+                            # The URL expired, resolve it again once
+                            url_refreshed = True
+                            self.urls.invalidate(track_info['SNG_ID'])
+                            url, _ = await self._resolve(track_info)
+                            continue
+                        response.raise_for_status()
+                        if offset and response.status != 206:
+                            # The server ignored the Range header and sent the whole track
+                            offset = 0
+                        content_length = response.content_length
+                        await self._write_stream(response, sink, offset)
+
+                    if content_length is not None and sink.size < offset + content_length:
+                        raise aiohttp.ClientPayloadError("Connection closed before the end of the track")
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    attempt = await self._wait_for_retry(attempt, e, f"Transfer of {output_path}", sink.offset)
+
+            await self._run(sink.finish)
+            logger.info(f"Successfully downloaded: {output_path}")
+        except Exception as e:
+            await self._run(sink.abort)
+            raise DeezerApiException(f"Download failed: {e!r}")
+
+    async def _write_stream(self, response: aiohttp.ClientResponse, sink: PartFileDecryption, offset: int):
+        """
+        Read a response body buffer by buffer, each decrypted and written by the executor
+
+        If the transfer breaks, the whole blocks received so far are still written, so a retry
+        can resume after them.
+        """
+        buffer_size = DeezerCrypto.DEFAULT_BUFFER_SIZE
+        while True:
+            buffer = bytearray()
+            try:
+                while len(buffer) < buffer_size:
+                    data = await response.content.read(buffer_size - len(buffer))
+                    if not data:
+                        break
+                    buffer += data
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                del buffer[len(buffer) - len(buffer) % DeezerCrypto.BLOCK_SIZE:]
+                if buffer:
+                    await self._run(sink.write_blocks, buffer, offset)
+                raise
+            if not buffer:
+                return
+
+            await self._run(sink.write_blocks, buffer, offset)
+            offset += len(buffer)
+            if len(buffer) < buffer_size:
+                return
+
+    async def _wait_for_retry(self, attempt: int, error: Exception, transfer: str, offset: int) -> int:
+        """
+        Back off before retrying an interrupted transfer, or re-raise error if it should not be retried
+
+        Returns:
+            Number of the retry about to be made
+        """
+        status = getattr(error, 'status', None)
+        if attempt >= self.config.download_retries or (status is not None and status < 500):
+            raise error
+        attempt += 1
+        delay = self.config.retry_backoff * 2 ** (attempt - 1)
+        logger.warning(f"{transfer} interrupted at {offset} bytes ({error!r}), "
+                       f"retrying in {delay:.1f}s ({attempt}/{self.config.download_retries})")
+        await asyncio.sleep(delay)
+        return attempt
+
+    async def _resolve_track_url(self, track_info: Dict[str, Any]) -> Tuple[Dict[str, Any], str, str]:
+        """
+        Get the download URL of a track, or of its fallback version if the track is not available
+
+        Returns:
+            Tuple of the track info the URL belongs to, the URL and its sound format
+        """
+        try:
+            url, sound_format = await self._resolve(track_info)
+        except Exception as e:
+            if "FALLBACK" in track_info:
+                logger.info("Track not available, trying fallback version...")
+                track_info = track_info["FALLBACK"]
+                url, sound_format = await self._resolve(track_info)
+            else:
+                raise DeezerApiException(f"Track not available: {e}")
+        return track_info, url, sound_format
+
+    async def _resolve(self, track_info: Dict[str, Any]) -> Tuple[str, str]:
+        """Get the URL and sound format of a track, resolving it if it is not cached or about to expire"""
+        track_id = str(track_info['SNG_ID'])
+        if self.urls.get(track_id) is None:
+            await self._resolve_batch([(track_id, track_info['TRACK_TOKEN'])])
+        return self.urls.lookup(track_info)
+
+    async def _prefetch_urls(self, tracks: Iterable[Dict[str, Any]]):
+        """Resolve the URLs of tracks and of their fallback versions in batched requests, sent concurrently"""
+        batches = self.urls.pending_batches(tracks)
+        results = await asyncio.gather(*(self._resolve_batch(batch) for batch in batches), return_exceptions=True)
+        for batch, result in zip(batches, results):
+            if isinstance(result, DeezerApiException):
+                # Tracks of a failed batch are resolved one by one when downloaded
+                logger.warning(f"Failed to prefetch {len(batch)} track URLs: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+
+    async def _resolve_batch(self, batch: List[Tuple[str, str]]):
+        """Resolve (track ID, track token) pairs with a single get_url request"""
+        data = await self._request_urls(batch)
+        if self.urls.license_rejected(data):
+            await self.session.revalidate()
+            data = await self._request_urls(batch)
+        self.urls.store(batch, data)
+
+    async def _request_urls(self, batch: List[Tuple[str, str]]) -> Dict[str, Any]:
+        body = TrackUrls.request_body(self.session.license_token, self.session.sound_format, batch)
+        try:
+            async with self.session.request('POST', self.GET_URL_ENDPOINT, json=body,
+                                            headers={'Content-Type': 'application/json'}) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise DeezerApiException(f"Failed to get track URL: {e}")
+
+    async def _get_track_info(self, track_id: str) -> Dict[str, Any]:
+        """Get track metadata from Deezer"""
+        return (await self._get_page_state('track', track_id))['DATA']
+
+    async def _get_album_tracks(self, album_id: str) -> List[Dict[str, Any]]:
+        """Get all tracks in an album"""
+        return (await self._get_page_state('album', album_id))['SONGS']['data']
+
+    async def _iter_playlist_pages(self, playlist_id: str) -> AsyncIterator[Tuple[str, int, List[Dict[str, Any]]]]:
+        """
+        Get the tracks of a playlist, page by page
+
+        Yields:
+            Tuples of the playlist title, its total number of tracks and the tracks of the page
+        """
+        # Extract numeric ID from URL if needed
+        playlist_id = re.search(r'\d+', playlist_id).group(0)
+
+        pager = PlaylistPager(playlist_id, self.PLAYLIST_PAGE_SIZE)
+        payload = pager.next_payload()
+        while payload is not None:
+            try:
+                results = await self._call_gw_api('deezer.pagePlaylist', payload, "Failed to get playlist")
+            except DeezerException as e:
+                if pager.total is None:
+                    raise
+                # Tracks of earlier pages are already downloading, keep them
+                skipped = pager.skip()
+                logger.error(f"Failed to get tracks {payload['start'] + 1}-{payload['start'] + skipped} "
+                             f"of playlist {playlist_id}, skipping them: {e}")
+                await self._increment_progress(FIELD_FAILED_PAGES)
+                await self._increment_progress(FIELD_FAILED, skipped)
+                payload = pager.next_payload()
+                continue
+
+            page = pager.add(results)
+            if page is None:
+                break
+            yield pager.title, pager.total, page
+            payload = pager.next_payload()
+
+    async def _call_gw_api(self, method: str, payload: Dict[str, Any], error_message: str) -> Dict[str, Any]:
+        """Call a gw-light API method and return its results"""
+        for refresh_token in (False, True):
+            params = gw_api_params(method, await self.session.get_api_token(refresh=refresh_token))
+            try:
+                async with self.session.request('POST', f"{self.session.WWW_URL}{GW_API_PATH}", params=params,
+                                                json=payload) as response:
+                    data = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                raise DeezerApiException(f"{error_message}: {e}")
+
+            results = gw_api_results(data, error_message, refresh_token)
+            # None when the cached CSRF token expired: fetch a new one and retry once
+            if results is not None:
+                return results
+
+    async def _get_page_state(self, kind: str, content_id: str) -> Dict[str, Any]:
+        """
+        Fetch the Deezer page of a track or album and extract its app state, parsing no further than needed
+
+        The rest of the page is still read, so that the connection can be reused.
+        """
+        page_type, not_found_message, missing_message = self.PAGES[kind]
+        url = f"{self.session.WWW_URL}/{self.config.market}/{kind}/{content_id}"
+        for revalidated in (False, True):
+            async with self.session.request('GET', url) as response:
+                extractor = AppStateExtractor(page_type)
+                state = None
+                async for chunk in response.content.iter_chunked(self.PAGE_CHUNK_SIZE):
+                    if state is None and response.status != 404:
+                        state = extractor.feed(chunk)
+                if response.status == 404:
+                    raise Deezer404Exception(not_found_message.format(content_id))
+
+            if extractor.authenticated:
+                break
+            if revalidated:
+                raise Deezer403Exception("Authentication required")
+            await self.session.revalidate()
+
+        if state is None:
+            raise DeezerApiException(missing_message)
+        return state
+
+    async def _update_progress(self, **fields):
+        if self.redis_manager is not None:
+            await self._run(self.redis_manager.update_task_progress, self.task_id, **fields)
+
+    async def _increment_progress(self, field: str, amount: int = 1):
+        if self.redis_manager is not None:
+            await self._run(self.redis_manager.increment_task_progress, self.task_id, field, amount)
+
+    async def _run(self, function, *args, **kwargs):
+        """Run a blocking call (file I/O, decryption, Redis) in the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: function(*args, **kwargs))
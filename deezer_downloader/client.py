@@ -1,108 +1,187 @@
 import os
 import re
-import json
+import time
 import requests
-from typing import List, Dict, Any, Optional, Tuple
-from html.parser import HTMLParser
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Set, Tuple
 from .sessions import DeezerSession
+from .session_pool import SessionPool
 from .config import DeezerConfig
-from .crypto import DeezerCrypto
+from .crypto import DeezerCrypto, StripeDecryptor
+from .decrypt_pool import SpooledDecryption
+from .transfer import PartFileDecryption, SegmentedDecryption, DecryptedSegment, RangeNotSupported
+from .track_urls import TrackUrlResolver
+from .gw_api import GW_API_PATH, PlaylistPager, gw_api_params, gw_api_results
+from .extractor import AppStateExtractor
+from .metadata_cache import MetadataCache
+from .track_store import TrackStore
 from .exceptions import DeezerException, DeezerApiException, Deezer403Exception, Deezer404Exception
 from redis_manager import RedisManager
-from progress_tracker import FIELD_STARTING, FIELD_CURRENT, FIELD_TOTAL, FIELD_FINISHED, FIELD_ERROR
+from progress_tracker import FIELD_STARTING, FIELD_CURRENT, FIELD_TOTAL, FIELD_FAILED, FIELD_FAILED_PAGES, FIELD_ERROR, \
+    ProgressAggregator
 from logging_config import logger
 
 
-class ScriptExtractor(HTMLParser):
-    """Extract <script> tag contents from HTML page"""
-
-    def __init__(self):
-        super().__init__()
-        self.scripts = []
-        self.current_tag = None
-
-    def handle_starttag(self, tag, attrs):
-        self.current_tag = tag.lower()
-
-    def handle_data(self, data):
-        if self.current_tag == "script":
-            self.scripts.append(data)
-
-    def handle_endtag(self, tag):
-        self.current_tag = None
-
-
 class DeezerClient:
-    def __init__(self, config: DeezerConfig, redis_manager: RedisManager, task_id: str):
+    # Track fields needed to name, resolve and decrypt a track without fetching its page
+    REQUIRED_TRACK_FIELDS = ('SNG_ID', 'SNG_TITLE', 'ART_NAME', 'TRACK_TOKEN')
+    # Listing tokens this close to expiring are refreshed from the track page
+    TOKEN_EXPIRY_MARGIN_SECONDS = 60
+    # Bytes read at a time when scanning a page for its app state
+    PAGE_CHUNK_SIZE = 16 * 1024
+    # Tracks fetched per deezer.pagePlaylist call
+    PLAYLIST_PAGE_SIZE = 200
+    # Page type of the app state, and messages of the errors raised when the page or its state is
+    # missing, per kind of page metadata is read from
+    PAGES = {
+        'track': ('song', "Track {} not found", "Could not find track information"),
+        'album': ('album', "Album {} not found", "Could not find album information"),
+    }
+    # Bytes read at a time when streaming a track without writing it to disk
+    STREAM_CHUNK_SIZE = 64 * 1024
+    # Track streams are requested as-is, so that their length and Range offsets are those of the
+    # encrypted track rather than of a compressed encoding of it
+    TRACK_STREAM_HEADERS = {'Accept-Encoding': 'identity'}
+
+    def __init__(self, config: DeezerConfig, redis_manager: RedisManager, task_id: str,
+                 metadata_cache: Optional[MetadataCache] = None, track_store: Optional[TrackStore] = None,
+                 session_pool: Optional[SessionPool] = None,
+                 on_track_downloaded: Optional[Callable[[str], None]] = None):
         self.config = config
-        self.session = DeezerSession(config)
+        self.session = session_pool.get(config) if session_pool else DeezerSession(config)
+        self.url_resolver = TrackUrlResolver(config, self.session)
         self.redis_manager = redis_manager
         self.task_id = task_id
+        self.metadata_cache = metadata_cache
+        self.track_store = track_store
+        # Called with the path of every track as soon as it is downloaded, from the downloading thread;
+        # it may take the file away, e.g. into an archive
+        self.on_track_downloaded = on_track_downloaded
+        # Bytes received by the task's transfers, with rate and ETA
+        self.progress = (ProgressAggregator(redis_manager, task_id, config.progress_interval)
+                         if redis_manager is not None and task_id else None)
 
     def initialize(self):
-        """Initialize the client session"""
-        self.session.initialize_session()
+        """Initialize the client session, unless it comes from a pool and is still fresh"""
+        self.session.ensure_initialized(self.config.session_max_age)
 
-    def download_track(self, track_id: str, output_path: Optional[str] = None) -> str:
+    def download_track(self, track_id: str, output_path: Optional[str] = None,
+                       track_info: Optional[Dict[str, Any]] = None, file_stem: Optional[str] = None) -> str:
         """
         Download a single track by ID
 
         Args:
             track_id: Deezer track ID
             output_path: Optional custom output path
+            track_info: Optional track metadata already known, e.g. from an album or playlist listing.
+                The track page is only fetched when it lacks required fields or its token expired.
+            file_stem: Optional file name without extension to use in the download folder instead of
+                'Artist - Title', e.g. to keep tracks sharing a title apart
 
         Returns:
             Path to downloaded file
         """
         # Progress update is handled by the calling method (download_playlist/download_album)
-        track_info = self._get_track_info(track_id)
+        listing_info = self._is_complete_track_info(track_info)
+        if not listing_info:
+            track_info = self._get_track_info(track_id)
+
+        if self.track_store:
+            stored = self.track_store.find(str(track_info['SNG_ID']), self.session.sound_format)
+            if stored:
+                stored_path, stored_format = stored
+                path = self._prepare_output_path(track_info, stored_format, output_path, file_stem)
+                if self.track_store.link(stored_path, path):
+                    logger.info(f"Served from track store: {path}")
+                    if self.progress is not None:
+                        size = os.path.getsize(path)
+                        self.progress.update(str(track_info['SNG_ID']), size, size)
+                    self._track_downloaded(path)
+                    return path
 
-        if not output_path:
-            # Clean filename of invalid characters
-            clean_title = re.sub(r'[<>:"/\\|?*]', '', track_info['SNG_TITLE'])
-            clean_artist_name = re.sub(r'[<>:"/\\|?*]', '', track_info['ART_NAME'])
-            filename = f"{clean_artist_name} - {clean_title}.{self._get_file_extension()}"
-            output_path = os.path.join(self.config.download_folder, filename)
+        try:
+            source_info, url, sound_format = self._resolve_track_url(track_info)
+        except DeezerApiException as e:
+            if not listing_info:
+                raise
+            # The track page may carry a fresher token or a FALLBACK version the listing lacks
+            logger.info(f"Listing data not usable for track {track_id} ({e}), fetching track page...")
+            track_info = self._get_track_info(track_id)
+            source_info, url, sound_format = self._resolve_track_url(track_info)
+
+        output_path = self._prepare_output_path(track_info, sound_format, output_path, file_stem)
+        if os.path.exists(output_path):
+            # Never write through a file that may be hardlinked into the track store
+            os.remove(output_path)
+        size = int(source_info.get(f'FILESIZE_{sound_format}') or 0)
+        if not (self.config.download_segments > 1 and size >= self.config.segment_min_size
+                and self._download_segmented(source_info, url, output_path, size)):
+            self._download_and_decrypt_track(source_info, url, output_path)
+
+        if self.track_store:
+            self.track_store.add(str(track_info['SNG_ID']), self.session.sound_format, sound_format, output_path)
+        self._track_downloaded(output_path)
+        return output_path
 
-        # Create output directory if it doesn't exist
-        os.makedirs(self.config.download_folder, exist_ok=True)
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    def stream_track(self, track_id: str) -> Tuple[str, Optional[int], Iterator[bytes]]:
+        """
+        Download and decrypt a single track without writing it to disk
 
-        self._download_and_decrypt_track(track_info, output_path)
-        return output_path
+        The track is decrypted chunk by chunk as it arrives, e.g. to pass it straight on to an HTTP
+        response. An interrupted transfer is retried with backoff, resuming with a Range request
+        right after the last byte received.
+
+        Args:
+            track_id: Deezer track ID
+
+        Returns:
+            Tuple of the track's file name, its size in bytes if known, and an iterator over its
+            decrypted content, which must be exhausted or closed to release the connection
+        """
+        track_info = self._get_track_info(track_id)
+        source_info, url, sound_format = self._resolve_track_url(track_info)
+        response = self._open_track_stream(source_info, url)
+        content_length = response.headers.get('Content-Length')
+        size = int(content_length) if content_length is not None else None
+        key = DeezerCrypto.calc_blowfish_key(source_info['SNG_ID'])
+        file_name = self._get_file_name(track_info, sound_format)
+        return file_name, size, self._iter_decrypted_track(response, url, key, size, file_name)
 
     def download_playlist(self, playlist_id: str) -> List[str]:
         """
         Download all tracks in a playlist
 
+        Tracks of the first page start downloading while later pages are still being fetched. A later
+        page that cannot be fetched is skipped: its tracks are counted as failed, and the task
+        finishes with the tracks of the other pages.
+
         Args:
             playlist_id: Deezer playlist ID
 
         Returns:
             List of paths to downloaded files
         """
-        playlist_name, tracks = self._get_playlist_tracks(playlist_id)
+        pages = self._iter_playlist_pages(playlist_id)
+        playlist_name, total, first_page = next(pages)
 
         self.redis_manager.update_task_progress(
             self.task_id,
-            **{FIELD_STARTING: False, FIELD_CURRENT: 0, FIELD_TOTAL: len(tracks), FIELD_ERROR: None}
+            **{FIELD_STARTING: False, FIELD_CURRENT: 0, FIELD_FAILED: 0, FIELD_FAILED_PAGES: 0, FIELD_TOTAL: total,
+               FIELD_ERROR: None}
         )
+        if self.progress is not None:
+            self.progress.expect(total)
 
-        downloaded_files = []
+        logger.info(f"Downloading playlist '{playlist_name}' ({total} tracks) for task {self.task_id}")
 
-        logger.info(f"Downloading playlist '{playlist_name}' ({len(tracks)} tracks) for task {self.task_id}")
+        def tracks():
+            yield first_page
+            for _, _, page in pages:
+                yield page
 
-        for i, track in enumerate(tracks, 1):
-            try:
-                logger.info(f"[{i}/{len(tracks)}] Downloading: {track['SNG_TITLE']}")
-                # download_track no longer updates progress directly for individual tracks within a playlist
-                path = self.download_track(str(track['SNG_ID']))
-                self.redis_manager.update_task_progress(self.task_id, **{FIELD_CURRENT: i})
-                downloaded_files.append(path)
-            except DeezerException as e:
-                logger.error(f"Failed to download track: {e}")
         # The overall 'finished' status (including zipping) is handled in app.py
-        return downloaded_files
+        return self._download_tracks(tracks(), total)
 
     def download_album(self, album_id: str) -> List[str]:
         """
@@ -119,164 +198,482 @@ class DeezerClient:
 
         self.redis_manager.update_task_progress(
             self.task_id,
-            **{FIELD_STARTING: False, FIELD_CURRENT: 0, FIELD_TOTAL: len(tracks), FIELD_ERROR: None}
+            **{FIELD_STARTING: False, FIELD_CURRENT: 0, FIELD_FAILED: 0, FIELD_TOTAL: len(tracks), FIELD_ERROR: None}
         )
-
-        downloaded_files = []
+        if self.progress is not None:
+            self.progress.expect(len(tracks))
 
         logger.info(f"Downloading album '{album_title}' ({len(tracks)} tracks) for task {self.task_id}")
 
-        for i, track in enumerate(tracks, 1):
+        # The overall 'finished' status (including zipping) is handled in app.py
+        return self._download_tracks([tracks], len(tracks))
+
+    def _download_tracks(self, pages: Iterable[List[Dict[str, Any]]], total: int) -> List[str]:
+        """
+        Download tracks in parallel, up to config.max_workers at a time
+
+        Tracks arrive in pages; each page is submitted as soon as it is available, so downloads
+        overlap with fetching the next page. A failing track is logged and skipped without
+        affecting the others. Progress counts tracks as they complete, in whatever order that
+        happens, with failed tracks counted apart from downloaded ones. Every track gets its own
+        file name before it is submitted, so tracks sharing an artist and title never write to
+        the same file.
+
+        Returns:
+            Paths of the downloaded files, in track order
+        """
+        def download(index: int, track: Dict[str, Any], file_stem: str) -> Optional[str]:
             try:
-                logger.info(f"[{i}/{len(tracks)}] Downloading: {track['SNG_TITLE']}")
-                # download_track no longer updates progress directly for individual tracks within an album
-                path = self.download_track(str(track['SNG_ID']))
-                self.redis_manager.update_task_progress(self.task_id, **{FIELD_CURRENT: i})
-                downloaded_files.append(path)
+                logger.info(f"[{index}/{total}] Downloading: {track['SNG_TITLE']}")
+                # download_track no longer updates progress directly for individual tracks within a collection
+                return self.download_track(str(track['SNG_ID']), track_info=track, file_stem=file_stem)
             except DeezerException as e:
                 logger.error(f"Failed to download track: {e}")
-        # The overall 'finished' status (including zipping) is handled in app.py
-        return downloaded_files
+                return None
+
+        futures = []
+        file_stems: Set[str] = set()
+        # The session may be pooled and shared with other tasks, so its counters are not the task's own
+        connection_stats = self.session.connection_stats()
+
+        def track_done(future):
+            downloaded = future.exception() is None and future.result() is not None
+            self.redis_manager.increment_task_progress(self.task_id, FIELD_CURRENT if downloaded else FIELD_FAILED)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.config.max_workers)) as executor:
+            for page in pages:
+                # Resolve the CDN URLs of the whole page up front, in a few batched requests
+                self.url_resolver.prefetch(page)
+                for track in page:
+                    future = executor.submit(download, len(futures) + 1, track,
+                                             self._unique_file_stem(file_stems, track))
+                    future.add_done_callback(track_done)
+                    futures.append(future)
+
+        if self.progress is not None:
+            # Bytes received since the last throttled write
+            self.progress.flush()
+        logger.info(f"Connection stats of the session during task {self.task_id}, "
+                    f"including concurrent tasks of the account: {self.session.connection_stats(connection_stats)}")
+
+        return [path for path in (future.result() for future in futures) if path is not None]
+
+    def _count_failed_page(self, tracks: int):
+        """Report a playlist page that could not be fetched, and its tracks as failed"""
+        self.redis_manager.increment_task_progress(self.task_id, FIELD_FAILED_PAGES)
+        self.redis_manager.increment_task_progress(self.task_id, FIELD_FAILED, tracks)
+
+    def _track_downloaded(self, path: str):
+        if self.on_track_downloaded is not None:
+            self.on_track_downloaded(path)
+
+    @classmethod
+    def _is_complete_track_info(cls, track_info: Optional[Dict[str, Any]]) -> bool:
+        """Check that track metadata has everything needed to download the track"""
+        if not track_info or any(not track_info.get(field) for field in cls.REQUIRED_TRACK_FIELDS):
+            return False
+        token_expiry = track_info.get('TRACK_TOKEN_EXPIRE')
+        if token_expiry and int(token_expiry) - cls.TOKEN_EXPIRY_MARGIN_SECONDS <= time.time():
+            return False
+        return True
+
+    def _prepare_output_path(self, track_info: Dict[str, Any], sound_format: str,
+                             output_path: Optional[str] = None, file_stem: Optional[str] = None) -> str:
+        """Build the default output path of a track if none is given, and create its directory"""
+        if not output_path:
+            file_name = f"{file_stem or self._get_file_stem(track_info)}.{self._get_file_extension(sound_format)}"
+            output_path = os.path.join(self.config.download_folder, file_name)
 
-    def _get_file_extension(self) -> str:
-        return "flac" if self.session.sound_format == "FLAC" else "mp3"
+        # Create output directory if it doesn't exist
+        os.makedirs(self.config.download_folder, exist_ok=True)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        return output_path
 
-    def _get_track_info(self, track_id: str) -> Dict[str, Any]:
-        """Get track metadata from Deezer"""
-        response = self.session.session.get(f"https://www.deezer.com/us/track/{track_id}")
+    def _get_file_name(self, track_info: Dict[str, Any], sound_format: str) -> str:
+        """File name of a track, e.g. 'Artist - Title.mp3'"""
+        return f"{self._get_file_stem(track_info)}.{self._get_file_extension(sound_format)}"
+
+    @staticmethod
+    def _get_file_stem(track_info: Dict[str, Any]) -> str:
+        """File name of a track without its extension, e.g. 'Artist - Title'"""
+        # Clean filename of invalid characters
+        clean_title = re.sub(r'[<>:"/\\|?*]', '', track_info['SNG_TITLE'])
+        clean_artist_name = re.sub(r'[<>:"/\\|?*]', '', track_info['ART_NAME'])
+        return f"{clean_artist_name} - {clean_title}"
+
+    @classmethod
+    def _unique_file_stem(cls, file_stems: Set[str], track_info: Dict[str, Any]) -> str:
+        """
+        File name of a track without its extension, numbered if file_stems already holds it, e.g.
+        'Artist - Interlude (2)'; the name is added to file_stems, ignoring case
+        """
+        file_stem = cls._get_file_stem(track_info)
+        unique_stem, number = file_stem, 1
+        while unique_stem.casefold() in file_stems:
+            number += 1
+            unique_stem = f"{file_stem} ({number})"
+        file_stems.add(unique_stem.casefold())
+        return unique_stem
 
-        if response.status_code == 404:
-            raise Deezer404Exception(f"Track {track_id} not found")
-        if "MD5_ORIGIN" not in response.text:
-            raise Deezer403Exception("Authentication required")
+    def _get_file_extension(self, sound_format: Optional[str] = None) -> str:
+        return "flac" if (sound_format or self.session.sound_format) == "FLAC" else "mp3"
 
-        parser = ScriptExtractor()
-        parser.feed(response.text)
-        parser.close()
+    def _get_track_info(self, track_id: str) -> Dict[str, Any]:
+        """Get track metadata from Deezer"""
+        def fetch():
+            return self._get_page_state('track', track_id)['DATA']
 
-        for script in parser.scripts:
-            regex = re.search(r'{"DATA":.*', script)
-            if regex:
-                data = json.loads(regex.group())
-                if data['DATA']['__TYPE__'] == 'song':
-                    return data['DATA']
+        return self._get_cached_metadata('track', track_id, fetch)
 
-        raise DeezerApiException("Could not find track information")
+    def _resolve_track_url(self, track_info: Dict[str, Any]) -> Tuple[Dict[str, Any], str, str]:
+        """
+        Get the download URL of a track, or of its fallback version if the track is not available
 
-    def _download_and_decrypt_track(self, track_info: Dict[str, Any], output_path: str):
-        """Download and decrypt a track"""
+        Returns:
+            Tuple of the track info the URL belongs to, the URL and its sound format
+        """
         try:
-            url = self._get_track_url(track_info['TRACK_TOKEN'])
+            url, sound_format = self.url_resolver.resolve(track_info)
         except Exception as e:
             if "FALLBACK" in track_info:
                 logger.info(f"Track not available, trying fallback version...")
                 track_info = track_info["FALLBACK"]
-                url = self._get_track_url(track_info['TRACK_TOKEN'])
+                url, sound_format = self.url_resolver.resolve(track_info)
             else:
                 raise DeezerApiException(f"Track not available: {e}")
+        return track_info, url, sound_format
+
+    def _download_and_decrypt_track(self, track_info: Dict[str, Any], url: str, output_path: str):
+        """
+        Download and decrypt a track
 
+        An interrupted transfer is retried with backoff, resuming with a Range request from the
+        data already in the part file instead of starting over.
+        """
         key = DeezerCrypto.calc_blowfish_key(track_info['SNG_ID'])
 
+        if self.config.decrypt_processes > 0:
+            sink = SpooledDecryption(key, output_path, self.config.decrypt_processes)
+        else:
+            sink = PartFileDecryption(key, output_path)
+
         try:
-            with self.session.session.get(url, stream=True) as response:
-                response.raise_for_status()
-                with open(output_path, "wb") as output_file:
-                    DeezerCrypto.decrypt_file(response, key, output_file)
+            url_refreshed = False
+            attempt = 0
+            while True:
+                offset = sink.offset
+                headers = dict(self.TRACK_STREAM_HEADERS)
+                if offset:
+                    headers['Range'] = f"bytes={offset}-"
+                try:
+                    with self.session.get(url, stream=True, headers=headers,
+                                          timeout=self.config.download_timeout) as response:
+                        if response.status_code in (403, 410) and not url_refreshed:
+                            # The URL expired, resolve it again once
+                            url_refreshed = True
+                            self.url_resolver.invalidate(track_info['SNG_ID'])
+                            url, _ = self.url_resolver.resolve(track_info)
+                            continue
+
+                        response.raise_for_status()
+                        if offset and response.status_code != 206:
+                            # The server ignored the Range header and sent the whole track
+                            offset = 0
+                        content_length = response.headers.get('Content-Length')
+                        if self.progress is not None and content_length is not None:
+                            self.progress.update(str(track_info['SNG_ID']), offset, offset + int(content_length))
+                        sink.write_from(response, offset, self._byte_progress(str(track_info['SNG_ID'])))
+
+                    if content_length is not None and sink.size < offset + int(content_length):
+                        raise requests.exceptions.ConnectionError("Connection closed before the end of the track")
+                    break
+                except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+                    attempt = self._wait_for_retry(attempt, e, f"Transfer of {output_path}", sink.offset)
+
+            sink.finish()
             logger.info(f"Successfully downloaded: {output_path}")
         except Exception as e:
+            sink.abort()
             raise DeezerApiException(f"Download failed: {e}")
 
-    def _get_track_url(self, track_token: str) -> str:
-        """Get the download URL for a track"""
+    def _open_track_stream(self, track_info: Dict[str, Any], url: str) -> requests.Response:
+        """Request the encrypted stream of a track, resolving its URL again once if it expired"""
         try:
-            response = requests.post(
-                "https://media.deezer.com/v1/get_url",
-                json={
-                    'license_token': self.session.license_token,
-                    'media': [{
-                        'type': "FULL",
-                        "formats": [
-                            {"cipher": "BF_CBC_STRIPE", "format": self.session.sound_format}
-                        ]
-                    }],
-                    'track_tokens': [track_token]
-                },
-                headers={
-                    'User-Agent': self.config.user_agent
-                }
-            )
+            response = self.session.get(url, stream=True, headers=self.TRACK_STREAM_HEADERS,
+                                        timeout=self.config.download_timeout)
+            if response.status_code in (403, 410):
+                response.close()
+                self.url_resolver.invalidate(track_info['SNG_ID'])
+                url, _ = self.url_resolver.resolve(track_info)
+                response = self.session.get(url, stream=True, headers=self.TRACK_STREAM_HEADERS,
+                                            timeout=self.config.download_timeout)
             response.raise_for_status()
-            data = response.json()
+        except requests.exceptions.RequestException as e:
+            raise DeezerApiException(f"Download failed: {e}")
+        return response
+
+    def _iter_decrypted_track(self, response: requests.Response, url: str, key: str, size: Optional[int],
+                              transfer: str) -> Iterator[bytes]:
+        """Decrypt a track stream as it arrives, resuming it from the last byte received when interrupted"""
+        decryptor = StripeDecryptor(key)
+        attempt = 0
+        try:
+            while True:
+                try:
+                    if response is None:
+                        response = self.session.get(url, stream=True,
+                                                    headers=dict(self.TRACK_STREAM_HEADERS,
+                                                                 Range=f"bytes={decryptor.received}-"),
+                                                    timeout=self.config.download_timeout)
+                        response.raise_for_status()
+                        if response.status_code != 206:
+                            # What was already sent cannot be taken back to start over
+                            raise DeezerApiException(f"Download failed: the server cannot resume {transfer}")
+                    for chunk in response.iter_content(self.STREAM_CHUNK_SIZE):
+                        data = decryptor.update(chunk)
+                        if data:
+                            yield data
+                    if size is not None and decryptor.received < size:
+                        raise requests.exceptions.ConnectionError("Connection closed before the end of the track")
+                    break
+                except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+                    if response is not None:
+                        response.close()
+                        response = None
+                    attempt = self._wait_for_retry(attempt, e, f"Stream of {transfer}", decryptor.received)
+
+            tail = decryptor.finish()
+            if tail:
+                yield tail
+            logger.info(f"Successfully streamed: {transfer}")
+        finally:
+            if response is not None:
+                response.close()
+
+    def _download_segmented(self, track_info: Dict[str, Any], url: str, output_path: str, size: int) -> bool:
+        """
+        Download and decrypt a track as config.download_segments byte ranges over parallel connections
 
-            if not data.get('data') or 'errors' in data['data'][0]:
-                raise DeezerApiException(
-                    f"Failed to get download URL: {data['data'][0]['errors'][0]['message']}"
-                )
+        Args:
+            size: Size of the track stream, from the FILESIZE_<format> field of the track
 
-            return data['data'][0]['media'][0]['sources'][0]['url']
+        Returns:
+            False if the CDN did not serve the ranges as expected (or rejected the URL), in which
+            case nothing was written and the track should be downloaded over a single connection
+        """
+        key = DeezerCrypto.calc_blowfish_key(track_info['SNG_ID'])
+        transfer = SegmentedDecryption(key, output_path, size, self.config.download_segments)
+        # Reports the bytes of all segments, whichever of them received some
+        on_progress = None if self.progress is None else (
+            lambda _: self.progress.update(str(track_info['SNG_ID']), sum(s.received for s in transfer.segments), size))
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(transfer.segments)) as executor:
+                futures = [executor.submit(self._download_segment, url, segment, size, on_progress)
+                           for segment in transfer.segments]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    transfer.cancel()
+                    raise
+            transfer.finish()
+        except (RangeNotSupported, requests.exceptions.HTTPError) as e:
+            transfer.abort()
+            status = getattr(e.response, 'status_code', None) if isinstance(e, requests.exceptions.HTTPError) else None
+            if status is not None and status >= 500:
+                raise DeezerApiException(f"Download failed: {e}")
+            logger.info(f"Segmented download of {output_path} not possible ({e}), using a single connection")
+            return False
         except Exception as e:
-            raise DeezerApiException(f"Failed to get track URL: {e}")
+            transfer.abort()
+            raise DeezerApiException(f"Download failed: {e}")
+
+        logger.info(f"Successfully downloaded in {len(transfer.segments)} segments: {output_path}")
+        return True
+
+    def _download_segment(self, url: str, segment: DecryptedSegment, size: int,
+                          on_progress: Optional[Callable[[int], None]] = None):
+        """Download one segment of a segmented transfer, resuming it with backoff when interrupted"""
+        attempt = 0
+        while not segment.complete:
+            offset = segment.offset
+            try:
+                headers = dict(self.TRACK_STREAM_HEADERS, Range=f"bytes={offset}-{segment.end - 1}")
+                with self.session.get(url, stream=True, headers=headers,
+                                      timeout=self.config.download_timeout) as response:
+                    response.raise_for_status()
+                    content_range = response.headers.get('Content-Range', '')
+                    if response.status_code != 206 or content_range != f"bytes {offset}-{segment.end - 1}/{size}":
+                        raise RangeNotSupported(f"got {response.status_code} '{content_range}' "
+                                                f"for bytes {offset}-{segment.end - 1}/{size}")
+                    segment.write_from(response, offset, on_progress)
+
+                if not segment.complete:
+                    raise requests.exceptions.ConnectionError("Connection closed before the end of the segment")
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+                attempt = self._wait_for_retry(attempt, e, f"Segment {segment.start}-{segment.end}", segment.offset)
+
+    def _byte_progress(self, transfer: str) -> Optional[Callable[[int], None]]:
+        """Callback reporting the bytes a transfer has received so far, None if the task has no progress"""
+        if self.progress is None:
+            return None
+        return lambda done: self.progress.update(transfer, done)
+
+    def _wait_for_retry(self, attempt: int, error: Exception, transfer: str, offset: int) -> int:
+        """
+        Back off before retrying an interrupted transfer, or re-raise error if it should not be retried
 
-    def _get_playlist_tracks(self, playlist_id: str) -> Tuple[str, List[Dict[str, Any]]]:
-        """Get all tracks in a playlist"""
+        Returns:
+            Number of the retry about to be made
+        """
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+        if attempt >= self.config.download_retries or (status is not None and status < 500):
+            raise error
+        attempt += 1
+        delay = self.config.retry_backoff * 2 ** (attempt - 1)
+        logger.warning(f"{transfer} interrupted at {offset} bytes ({error}), "
+                       f"retrying in {delay:.1f}s ({attempt}/{self.config.download_retries})")
+        time.sleep(delay)
+        return attempt
+
+    def _iter_playlist_pages(self, playlist_id: str) -> Iterator[Tuple[str, int, List[Dict[str, Any]]]]:
+        """
+        Get the tracks of a playlist, page by page
+
+        Yields:
+            Tuples of the playlist title, its total number of tracks and the tracks of the page
+        """
         # Extract numeric ID from URL if needed
         playlist_id = re.search(r'\d+', playlist_id).group(0)
 
-        # Get CSRF token
-        response = self.session.session.post(
-            "https://www.deezer.com/ajax/gw-light.php",
-            params={
-                'method': 'deezer.getUserData',
-                'input': '3',
-                'api_version': '1.0',
-                'api_token': ''
-            }
-        )
-        csrf_token = response.json()['results']['checkForm']
-
-        # Get playlist data
-        response = self.session.session.post(
-            "https://www.deezer.com/ajax/gw-light.php",
-            params={
-                'method': 'deezer.pagePlaylist',
-                'input': '3',
-                'api_version': '1.0',
-                'api_token': csrf_token
-            },
-            json={
-                'playlist_id': int(playlist_id),
-                'start': 0,
-                'tab': 0,
-                'header': True,
-                'lang': 'en',
-                'nb': 500
-            }
-        )
-
-        data = response.json()
-        if data.get('error'):
-            raise DeezerApiException(f"Failed to get playlist: {data['error']}")
+        cached = self._lookup_cached_metadata('playlist', playlist_id)
+        if cached is not None:
+            yield cached['TITLE'], len(cached['SONGS']), cached['SONGS']
+            return
 
-        return data['results']['DATA']['TITLE'], data['results']['SONGS']['data']
+        pager = PlaylistPager(playlist_id, self.PLAYLIST_PAGE_SIZE)
+        songs = []
+        payload = pager.next_payload()
+        while payload is not None:
+            try:
+                results = self._call_gw_api('deezer.pagePlaylist', payload, "Failed to get playlist")
+            except (DeezerException, requests.exceptions.RequestException) as e:
+                if pager.total is None:
+                    raise
+                # Tracks of earlier pages are already downloading, keep them
+                skipped = pager.skip()
+                logger.error(f"Failed to get tracks {payload['start'] + 1}-{payload['start'] + skipped} "
+                             f"of playlist {playlist_id}, skipping them: {e}")
+                self._count_failed_page(skipped)
+                payload = pager.next_payload()
+                continue
+
+            page = pager.add(results)
+            if page is None:
+                break
+            songs.extend(page)
+            yield pager.title, pager.total, page
+            payload = pager.next_payload()
+
+        if self.metadata_cache is not None and not pager.failed_pages:
+            self.metadata_cache.set('playlist', playlist_id, self.config.market, self.config.arl_digest,
+                                    {'TITLE': pager.title, 'SONGS': songs})
 
     def _get_album_tracks(self, album_id: str) -> List[Dict[str, Any]]:
         """Get all tracks in an album"""
-        response = self.session.session.get(f"https://www.deezer.com/us/album/{album_id}")
+        def fetch():
+            return self._get_page_state('album', album_id)['SONGS']['data']
+
+        return self._get_cached_metadata('album', album_id, fetch)
+
+    def _get_track_tokens(self, track_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Get fresh tokens of several tracks, keyed by SNG_ID, with a single request"""
+        data = self._call_gw_api('song.getListData', {'sng_ids': [int(track_id) for track_id in track_ids]},
+                                 "Failed to get track tokens")
+        tokens = {}
+        for track in MetadataCache.iter_tracks(data.get('data', [])):
+            if track.get('TRACK_TOKEN'):
+                tokens[str(track['SNG_ID'])] = {field: track[field] for field in MetadataCache.VOLATILE_FIELDS
+                                                if field in track}
+        return tokens
+
+    def _get_cached_metadata(self, content_type: str, content_id: str, fetch):
+        """Look metadata up in the metadata cache, calling fetch and caching its result on a miss"""
+        value = self._lookup_cached_metadata(content_type, content_id)
+        if value is None:
+            value = fetch()
+            if self.metadata_cache is not None:
+                self.metadata_cache.set(content_type, content_id, self.config.market, self.config.arl_digest, value)
+        return value
+
+    def _lookup_cached_metadata(self, content_type: str, content_id: str):
+        """
+        Look metadata up in the metadata cache, returning None on a miss
 
-        if response.status_code == 404:
-            raise Deezer404Exception(f"Album {album_id} not found")
-        if "MD5_ORIGIN" not in response.text:
-            raise Deezer403Exception("Authentication required")
+        Tracks of a cached entry without a usable token for this account get fresh tokens from a
+        single song.getListData request instead of a page fetch each.
+        """
+        if self.metadata_cache is None:
+            return None
 
-        parser = ScriptExtractor()
-        parser.feed(response.text)
-        parser.close()
+        scope = self.config.arl_digest
+        value = self.metadata_cache.get(content_type, content_id, self.config.market, scope)
+        if value is None:
+            return None
 
-        for script in parser.scripts:
-            regex = re.search(r'{"DATA":.*', script)
-            if regex:
-                data = json.loads(regex.group())
-                if data['DATA']['__TYPE__'] == 'album':
-                    return data['SONGS']['data']
+        missing = MetadataCache.missing_tokens(value)
+        if missing:
+            try:
+                tokens = self._get_track_tokens(missing)
+            except (DeezerException, KeyError, ValueError) as e:
+                # Tracks left without a token fall back to their track page when downloaded
+                logger.warning(f"Failed to refresh tokens of cached {content_type} {content_id}: {e}")
+                tokens = {}
+            MetadataCache.fill_tokens(value, tokens)
+            self.metadata_cache.set_tokens(scope, tokens)
+        return value
+
+    def _call_gw_api(self, method: str, payload: Dict[str, Any], error_message: str) -> Dict[str, Any]:
+        """Call a gw-light API method and return its results"""
+        for refresh_token in (False, True):
+            response = self.session.post(
+                f"{self.session.WWW_URL}{GW_API_PATH}",
+                params=gw_api_params(method, self.session.get_api_token(refresh=refresh_token)),
+                json=payload
+            )
+
+            results = gw_api_results(response.json(), error_message, refresh_token)
+            # None when the cached CSRF token expired: fetch a new one and retry once
+            if results is not None:
+                return results
 
-        raise DeezerApiException("Could not find album information")
+    def _get_page_state(self, kind: str, content_id: str) -> Dict[str, Any]:
+        """
+        Fetch the Deezer page of a track or album and extract its app state, parsing no further than needed
+
+        The rest of the page is still read, since urllib3 only returns a connection whose response
+        was read to the end to the pool.
+        """
+        page_type, not_found_message, missing_message = self.PAGES[kind]
+        url = f"{self.session.WWW_URL}/{self.config.market}/{kind}/{content_id}"
+        for revalidated in (False, True):
+            with self.session.get(url, stream=True) as response:
+                extractor = AppStateExtractor(page_type)
+                state = None
+                for chunk in response.iter_content(self.PAGE_CHUNK_SIZE):
+                    if state is None and response.status_code != 404:
+                        state = extractor.feed(chunk)
+                if response.status_code == 404:
+                    raise Deezer404Exception(not_found_message.format(content_id))
+
+            if extractor.authenticated:
+                break
+            if revalidated:
+                raise Deezer403Exception("Authentication required")
+            # A pooled session may have been logged out since it was initialized
+            self.session.revalidate()
+
+        if state is None:
+            raise DeezerApiException(missing_message)
+        return state
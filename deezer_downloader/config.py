@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from typing import Optional
+import hashlib
 import os
 
 @dataclass
@@ -11,3 +12,35 @@ class DeezerConfig:
     user_id: Optional[str] = None
     user_agent: str = "Mozilla/5.0 (X11; Linux i686; rv:135.0) Gecko/20100101 Firefox/135.0"
     download_folder: str = os.path.join(os.path.expanduser('~'), 'Downloads', 'deezer-downloads')
+    # Number of tracks of an album or playlist downloaded in parallel
+    max_workers: int = 4
+    # Number of processes decrypting spooled tracks; 0 decrypts in-line while downloading
+    decrypt_processes: int = 0
+    # Retries of an interrupted track transfer, each resuming where the previous one stopped
+    download_retries: int = 3
+    # Seconds to wait before the first retry, doubled for each following one
+    retry_backoff: float = 1.0
+    # Seconds without receiving data before a transfer is considered interrupted
+    download_timeout: float = 30
+    # Connections a single track is downloaded over, as parallel byte ranges; 1 disables segmenting.
+    # Each connection counts against cdn_pool_size, together with the other tracks downloading.
+    download_segments: int = 1
+    # Tracks smaller than this are always downloaded over a single connection
+    segment_min_size: int = 8 * 1024 * 1024
+    # Seconds between writes of a task's byte-level progress to Redis, however often transfers report
+    progress_interval: float = 0.5
+    # Retries of a request Deezer answered with 429 or a 5xx, when a rate limiter is in use
+    rate_limit_retries: int = 4
+    # Storefront used in www.deezer.com page URLs
+    market: str = 'us'
+    # Maximum connections kept open per host to www.deezer.com, media.deezer.com and each audio CDN host
+    www_pool_size: int = 10
+    media_pool_size: int = 4
+    cdn_pool_size: int = 16
+    # Seconds a pooled session's user data (license token, sound format, CSRF token) is reused
+    session_max_age: int = 3600
+
+    @property
+    def arl_digest(self) -> str:
+        """Non-reversible identifier of the account, used to key per-user caches"""
+        return hashlib.sha256(self.cookie_arl.encode()).hexdigest()[:16]
@@ -1,10 +1,20 @@
 from Crypto.Hash import MD5
 from Crypto.Cipher import Blowfish
 from binascii import a2b_hex, b2a_hex
-import struct
+from typing import Callable, Optional, Tuple
 
 
 class DeezerCrypto:
+    BLOCK_SIZE = 2048
+    # Every third block of a BF_CBC_STRIPE stream is encrypted, so a stripe spans three blocks
+    STRIPE_SIZE = BLOCK_SIZE * 3
+    IV = a2b_hex("0001020304050607")
+    # Read 128 stripes (768 KiB) per iteration when decrypting a stream
+    DEFAULT_BUFFER_SIZE = STRIPE_SIZE * 128
+    # Most bytes asked of the stream per read: urllib3 drops what a read received when the
+    # connection breaks during it, so this bounds what an interrupted transfer fetches again
+    READ_SIZE = 16 * 1024
+
     @staticmethod
     def md5hex(data: bytes) -> bytes:
         h = MD5.new()
@@ -20,24 +30,148 @@ class DeezerCrypto:
 
     @staticmethod
     def decrypt_chunk(data: bytes, key: str) -> bytes:
-        iv = a2b_hex("0001020304050607")
-        cipher = Blowfish.new(key.encode(), Blowfish.MODE_CBC, iv)
+        cipher = Blowfish.new(key.encode(), Blowfish.MODE_CBC, DeezerCrypto.IV)
         return cipher.decrypt(data)
 
     @staticmethod
-    def decrypt_file(file_handle, key: str, output_handle):
-        block_size = 2048
-        block_index = 0
+    def decrypt_stripes(buffer, key: str, block_index: int = 0):
+        """
+        Decrypt, in place, the encrypted blocks of a BF_CBC_STRIPE buffer.
+
+        Args:
+            buffer: Writable buffer (bytearray, memoryview, mmap) starting on a block boundary
+            key: Blowfish key from calc_blowfish_key
+            block_index: Index of the first block of the buffer within the whole stream
+
+        A trailing partial block is left untouched, matching the stream format where the short
+        final block is never encrypted.
+        """
+        view = memoryview(buffer)
+        block_size = DeezerCrypto.BLOCK_SIZE
+        whole_length = len(view) - len(view) % block_size
+
+        # Offset of the first encrypted block, given the phase of the buffer in the stream
+        offsets = range((-block_index % 3) * block_size, whole_length, DeezerCrypto.STRIPE_SIZE)
+        if not offsets:
+            return
+
+        # Every encrypted block is its own CBC stream starting from IV. Decrypting them back to back
+        # with a single cipher is correct except for the first 8 bytes of each block, which get
+        # xored with the tail of the previous ciphertext block instead of IV, so those are patched.
+        ciphertext = b"".join([view[offset:offset + block_size] for offset in offsets])
+        plaintext = DeezerCrypto.decrypt_chunk(ciphertext, key)
+        iv = int.from_bytes(DeezerCrypto.IV, "big")
+
+        for i, offset in enumerate(offsets):
+            start = i * block_size
+            view[offset:offset + block_size] = plaintext[start:start + block_size]
+            if i:
+                head = (int.from_bytes(plaintext[start:start + 8], "big")
+                        ^ int.from_bytes(ciphertext[start - 8:start], "big") ^ iv)
+                view[offset:offset + 8] = head.to_bytes(8, "big")
+
+    @staticmethod
+    def decrypt_file(file_handle, key: str, output_handle, block_index: int = 0,
+                     buffer_size: int = DEFAULT_BUFFER_SIZE, on_progress: Optional[Callable[[int], None]] = None):
+        """
+        Decrypt a BF_CBC_STRIPE stream into output_handle.
+
+        Args:
+            file_handle: requests Response opened with stream=True, or any binary file object
+            key: Blowfish key from calc_blowfish_key
+            output_handle: Binary file object the plaintext is written to
+            block_index: Index in the whole stream of the first block read from file_handle
+            buffer_size: Bytes read per iteration, rounded down to a whole number of blocks
+            on_progress: Called with the number of bytes written so far after each write
+
+        Returns:
+            Number of bytes written
+
+        If reading from file_handle fails, the whole blocks received before the failure are still
+        decrypted and written before the error is raised, so that a retry can resume after them.
+        """
+        source = getattr(file_handle, "raw", file_handle)
+        if hasattr(source, "decode_content"):
+            # Match iter_content, which decodes any Content-Encoding applied by the server
+            source.decode_content = True
+
+        buffer_size = max(buffer_size - buffer_size % DeezerCrypto.BLOCK_SIZE, DeezerCrypto.BLOCK_SIZE)
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        written = 0
 
-        for data in file_handle.iter_content(block_size):
-            if not data:
+        while True:
+            length, error = DeezerCrypto._read_into(source, view)
+            if error is not None:
+                # A partial block cannot be decrypted yet, the retry fetches it again
+                length -= length % DeezerCrypto.BLOCK_SIZE
+
+            if length:
+                DeezerCrypto.decrypt_stripes(view[:length], key, block_index)
+                output_handle.write(view[:length])
+                written += length
+                block_index += length // DeezerCrypto.BLOCK_SIZE
+                if on_progress is not None:
+                    on_progress(written)
+
+            if error is not None:
+                raise error
+            if length < buffer_size:
                 break
 
-            is_encrypted = ((block_index % 3) == 0)
-            is_whole_block = len(data) == block_size
+        return written
+
+    @staticmethod
+    def _read_into(source, view: memoryview) -> Tuple[int, Optional[Exception]]:
+        """
+        Fill view from source, stopping short only at end of stream or when a read fails
+
+        Returns:
+            Tuple of the number of bytes read into view and the error the reads stopped on, if any
+        """
+        filled = 0
+        while filled < len(view):
+            try:
+                count = source.readinto(view[filled:filled + DeezerCrypto.READ_SIZE])
+            except Exception as e:
+                return filled, e
+            if not count:
+                break
+            filled += count
+        return filled, None
+
+
+class StripeDecryptor:
+    """
+    Incremental BF_CBC_STRIPE decryption of a stream fed in chunks of any size
+
+    Blocks are decrypted and returned as soon as they are complete; the start of a block still
+    being received is held back until the next chunk, or finish() at the end of the stream.
+    """
+
+    def __init__(self, key: str, block_index: int = 0):
+        self.key = key
+        self.block_index = block_index
+        # Stream position following the last byte fed, where a resumed transfer should continue
+        self.received = block_index * DeezerCrypto.BLOCK_SIZE
+        self._pending = bytearray()
+
+    def update(self, data) -> bytes:
+        """Feed the next bytes of the stream, returning the plaintext of the blocks they complete"""
+        self._pending += data
+        self.received += len(data)
+        whole_length = len(self._pending) - len(self._pending) % DeezerCrypto.BLOCK_SIZE
+        if not whole_length:
+            return b""
 
-            if is_encrypted and is_whole_block:
-                data = DeezerCrypto.decrypt_chunk(data, key)
+        blocks = self._pending[:whole_length]
+        del self._pending[:whole_length]
+        DeezerCrypto.decrypt_stripes(blocks, self.key, self.block_index)
+        self.block_index += whole_length // DeezerCrypto.BLOCK_SIZE
+        return bytes(blocks)
 
-            output_handle.write(data)
-            block_index += 1
+    def finish(self) -> bytes:
+        """Return the short final block of the stream, which is never encrypted"""
+        tail = bytes(self._pending)
+        self._pending.clear()
+        return tail
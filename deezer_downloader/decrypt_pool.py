@@ -0,0 +1,132 @@
+import math
+import mmap
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+from .crypto import DeezerCrypto
+
+# Segments must start on a stripe boundary to keep the block phase, and on an allocation
+# granularity boundary so they can be mapped directly
+SEGMENT_ALIGNMENT = math.lcm(DeezerCrypto.STRIPE_SIZE, mmap.ALLOCATIONGRANULARITY)
+SEGMENT_SIZE = SEGMENT_ALIGNMENT * max(1, (3 * 1024 * 1024) // SEGMENT_ALIGNMENT)
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def start_executor(max_workers: int) -> ProcessPoolExecutor:
+    """
+    Create the process-wide decryption pool, if not done yet
+
+    Call it once at startup, e.g. before a worker starts its download threads. Pool processes are
+    started from a clean forkserver (spawned where forkserver is not available), never forked from
+    this process: a fork taken while another thread holds a lock (logging, the Redis or HTTP
+    connection pools) would leave that lock held forever in the child.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+        return _executor
+
+
+def get_executor(max_workers: int) -> ProcessPoolExecutor:
+    """Return the process-wide decryption pool, starting it with max_workers if start_executor was not called"""
+    return _executor or start_executor(max_workers)
+
+
+def _decrypt_segment(path: str, key: str, offset: int, length: int):
+    """Decrypt one segment of a spooled file in place (runs in a pool process)"""
+    with open(path, "r+b") as spool_file:
+        with mmap.mmap(spool_file.fileno(), length, offset=offset) as segment:
+            DeezerCrypto.decrypt_stripes(segment, key, offset // DeezerCrypto.BLOCK_SIZE)
+
+
+class SpooledDecryption:
+    """
+    Spool an encrypted stream to disk and decrypt it in a process pool
+
+    Segments are handed to the pool as soon as they are on disk, so decryption of the start of
+    the track overlaps with the download of the rest. The spool file (<output_path>.part) is
+    decrypted in place and renamed to output_path by finish. A download interrupted midway can
+    be resumed from offset, since the spool holds the encrypted bytes received so far.
+    """
+
+    def __init__(self, key: str, output_path: str, max_workers: int):
+        self.key = key
+        self.output_path = output_path
+        self.part_path = f"{output_path}.part"
+        self._executor = get_executor(max_workers)
+        self._spool_file = open(self.part_path, "wb")
+        self._futures = []
+        self._written = 0
+        self._submitted = 0
+
+    @property
+    def offset(self) -> int:
+        """Stream position to resume the download from"""
+        return self._written
+
+    @property
+    def size(self) -> int:
+        """Bytes of the stream received so far"""
+        return self._written
+
+    def write_from(self, response, offset: int, on_progress: Optional[Callable[[int], None]] = None):
+        """
+        Spool a response body starting at stream position offset
+
+        Args:
+            response: requests Response opened with stream=True
+            offset: Either self.offset to resume, or 0 to start over
+            on_progress: Called with the bytes of the stream received so far as they are written
+        """
+        if offset != self._written:
+            self._restart()
+
+        for data in response.iter_content(DeezerCrypto.DEFAULT_BUFFER_SIZE):
+            self._spool_file.write(data)
+            self._written += len(data)
+            if on_progress is not None:
+                on_progress(self._written)
+
+            if self._written - self._submitted >= SEGMENT_SIZE:
+                self._spool_file.flush()
+                while self._written - self._submitted >= SEGMENT_SIZE:
+                    self._submit(SEGMENT_SIZE)
+
+    def finish(self):
+        """Decrypt the rest of the spool, wait for every segment and move the result to output_path"""
+        self._spool_file.close()
+        if self._written > self._submitted:
+            self._submit(self._written - self._submitted)
+
+        for future in self._futures:
+            future.result()
+        os.replace(self.part_path, self.output_path)
+
+    def abort(self):
+        """Stop pending segments and remove the spool file"""
+        for future in self._futures:
+            future.cancel()
+        self._spool_file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def _submit(self, length: int):
+        self._futures.append(self._executor.submit(_decrypt_segment, self.part_path, self.key, self._submitted, length))
+        self._submitted += length
+
+    def _restart(self):
+        """Discard everything spooled so far, once segments already handed out are done with the file"""
+        for future in self._futures:
+            if not future.cancel():
+                future.exception()
+        self._futures = []
+        self._spool_file.seek(0)
+        self._spool_file.truncate()
+        self._written = 0
+        self._submitted = 0
@@ -0,0 +1,70 @@
+import json
+from typing import Dict, Any, Optional
+
+
+class AppStateExtractor:
+    """
+    Extract the {"DATA": ...} app state embedded in a Deezer page, from the page bytes as they arrive
+
+    Only the app state script is buffered and decoded; everything before it is dropped as soon as
+    it has been scanned, and callers can stop reading once feed returns the state.
+    """
+
+    MARKER = b'{"DATA":'
+    SCRIPT_END = b'</script>'
+
+    def __init__(self, page_type: str):
+        self.page_type = page_type
+        # True once an app state containing MD5_ORIGIN was seen, i.e. the session is logged in
+        self.authenticated = False
+        self._buffer = bytearray()
+        self._in_state = False
+        self._scanned = 0
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, chunk: bytes) -> Optional[Dict[str, Any]]:
+        """
+        Consume the next chunk of the page
+
+        Returns:
+            The app state once one of the expected page type is complete, None until then
+        """
+        self._buffer += chunk
+
+        while True:
+            if not self._in_state:
+                start = self._buffer.find(self.MARKER)
+                if start < 0:
+                    # Keep just enough to match a marker split across chunks
+                    del self._buffer[:max(0, len(self._buffer) - len(self.MARKER) + 1)]
+                    return None
+                del self._buffer[:start]
+                self._in_state = True
+                self._scanned = 0
+
+            end = self._buffer.find(self.SCRIPT_END, self._scanned)
+            if end < 0:
+                self._scanned = max(0, len(self._buffer) - len(self.SCRIPT_END) + 1)
+                return None
+
+            state = self._decode(end)
+            del self._buffer[:end + len(self.SCRIPT_END)]
+            self._in_state = False
+            if state is not None:
+                return state
+
+    def _decode(self, end: int) -> Optional[Dict[str, Any]]:
+        if self._buffer.find(b'MD5_ORIGIN', 0, end) >= 0:
+            self.authenticated = True
+
+        script = memoryview(self._buffer)[:end]
+        try:
+            state, _ = self._decoder.raw_decode(str(script, 'utf-8'))
+        except ValueError:
+            return None
+        finally:
+            script.release()
+
+        if isinstance(state.get('DATA'), dict) and state['DATA'].get('__TYPE__') == self.page_type:
+            return state
+        return None
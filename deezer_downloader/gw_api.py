@@ -0,0 +1,103 @@
+from typing import List, Dict, Any, Optional
+from .exceptions import DeezerApiException
+
+# Path of the gw-light API on the Deezer website
+GW_API_PATH = "/ajax/gw-light.php"
+
+
+def gw_api_params(method: str, api_token: str) -> Dict[str, str]:
+    """Query parameters of a gw-light API call"""
+    return {
+        'method': method,
+        'input': '3',
+        'api_version': '1.0',
+        'api_token': api_token
+    }
+
+
+def gw_api_results(data: Dict[str, Any], error_message: str, token_refreshed: bool) -> Optional[Dict[str, Any]]:
+    """
+    Results of a gw-light API response
+
+    Args:
+        data: The decoded JSON response
+        error_message: Start of the message of the exception raised if the call failed
+        token_refreshed: Whether the call was made with a CSRF token fetched again for it
+
+    Returns:
+        The results, or None if the CSRF token expired and the call should be made again with a
+        fresh one
+
+    Raises:
+        DeezerApiException: If the call failed
+    """
+    error = data.get('error')
+    if error and not token_refreshed and 'VALID_TOKEN_REQUIRED' in error:
+        return None
+    if error:
+        raise DeezerApiException(f"{error_message}: {error}")
+    return data['results']
+
+
+class PlaylistPager:
+    """
+    Paging through the tracks of a playlist with deezer.pagePlaylist calls: the payload of each
+    call and what its results hold, without the I/O
+    """
+
+    def __init__(self, playlist_id: str, page_size: int):
+        self.playlist_id = int(playlist_id)
+        self.page_size = page_size
+        self.title: Optional[str] = None
+        # Number of tracks of the playlist, known once the first page is in
+        self.total: Optional[int] = None
+        self.fetched = 0
+        # Pages skipped because their call failed
+        self.failed_pages = 0
+        self._exhausted = False
+
+    def next_payload(self) -> Optional[Dict[str, Any]]:
+        """Payload of the call for the next page, None once every page was fetched"""
+        if self._exhausted or (self.total is not None and self.fetched >= self.total):
+            return None
+        return {
+            'playlist_id': self.playlist_id,
+            'start': self.fetched,
+            'tab': 0,
+            'header': self.total is None,
+            'lang': 'en',
+            'nb': self.page_size
+        }
+
+    def add(self, results: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        """
+        Take in the results of the call for the next page
+
+        Returns:
+            The tracks of the page, or None if a page after the first one came back empty
+        """
+        page = results['SONGS']['data']
+        first = self.total is None
+        if first:
+            self.title = results['DATA']['TITLE']
+            self.total = int(results['SONGS'].get('total', len(page)))
+
+        self.fetched += len(page)
+        if not page:
+            # Fewer tracks than announced, e.g. some were removed while paging
+            self._exhausted = True
+            return page if first else None
+        return page
+
+    def skip(self) -> int:
+        """
+        Skip the page the last payload asked for, because its call failed; the first page cannot be
+        skipped, as it holds the number of tracks
+
+        Returns:
+            Number of tracks of the skipped page
+        """
+        skipped = min(self.page_size, self.total - self.fetched)
+        self.fetched += skipped
+        self.failed_pages += 1
+        return skipped
@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import redis
+from redis_manager import RedisManager
+from logging_config import logger
+
+
+class MetadataCache:
+    """
+    Cache of track, album and playlist metadata shared by all tasks
+
+    Entries live in the Redis used by RedisManager, with an in-process LRU in front of it so
+    repeated lookups within a worker never leave the process. Track tokens expire and are tied to
+    the account that fetched them, so they are stripped from the shared metadata and cached per
+    account (scope) until their own expiry.
+    """
+
+    # Seconds metadata stays cached, per content type
+    TTL_SECONDS = {
+        'track': 24 * 3600,
+        'album': 6 * 3600,
+        'playlist': 10 * 60,
+    }
+    VOLATILE_FIELDS = ('TRACK_TOKEN', 'TRACK_TOKEN_EXPIRE')
+    # Tokens this close to expiring are treated as missing
+    TOKEN_EXPIRY_MARGIN_SECONDS = 60
+
+    def __init__(self, redis_manager: Optional[RedisManager], max_entries: int = 2048):
+        self.redis = redis_manager.redis if redis_manager else None
+        self.namespace = f"{redis_manager.namespace if redis_manager else 'dz-dl/'}meta/"
+        self.max_entries = max_entries
+        self._local: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, content_type: str, content_id: str, market: str, scope: str) -> Optional[Any]:
+        """
+        Get cached metadata, with the tokens of its tracks cached for scope filled in
+
+        Tracks whose token expired or was fetched by another account are returned without
+        TRACK_TOKEN; see missing_tokens.
+        """
+        key = self._metadata_key(content_type, content_id, market)
+        payload = self._get(key)
+        if payload is None:
+            return None
+
+        value = json.loads(payload)
+        tracks = list(self.iter_tracks(value))
+        if tracks:
+            tokens = self._get_many([self._token_key(scope, str(track['SNG_ID'])) for track in tracks])
+            for track, token in zip(tracks, tokens):
+                if token is not None:
+                    track.update(json.loads(token))
+        return value
+
+    def set(self, content_type: str, content_id: str, market: str, scope: str, value: Any):
+        """Cache metadata, storing the tokens of its tracks separately for scope"""
+        stable = json.loads(json.dumps(value))
+        tokens = {}
+        for track in self.iter_tracks(stable):
+            volatile = {field: track.pop(field) for field in self.VOLATILE_FIELDS if field in track}
+            if volatile.get('TRACK_TOKEN'):
+                tokens[str(track['SNG_ID'])] = volatile
+
+        key = self._metadata_key(content_type, content_id, market)
+        self._set(key, json.dumps(stable, separators=(',', ':')), self.TTL_SECONDS[content_type])
+        self.set_tokens(scope, tokens)
+
+    def set_tokens(self, scope: str, tokens: Dict[str, Dict[str, Any]]):
+        """Cache track tokens of scope, keyed by SNG_ID, until they expire"""
+        now = time.time()
+        for track_id, volatile in tokens.items():
+            expiry = int(volatile.get('TRACK_TOKEN_EXPIRE') or 0)
+            ttl = int(expiry - now - self.TOKEN_EXPIRY_MARGIN_SECONDS)
+            if ttl > 0:
+                self._set(self._token_key(scope, track_id), json.dumps(volatile, separators=(',', ':')), ttl)
+
+    @classmethod
+    def missing_tokens(cls, value: Any) -> List[str]:
+        """SNG_IDs of the tracks in value that have no token"""
+        return [str(track['SNG_ID']) for track in cls.iter_tracks(value) if not track.get('TRACK_TOKEN')]
+
+    @classmethod
+    def fill_tokens(cls, value: Any, tokens: Dict[str, Dict[str, Any]]):
+        """Set the tokens of the tracks in value from a mapping of SNG_ID to token fields"""
+        for track in cls.iter_tracks(value):
+            volatile = tokens.get(str(track['SNG_ID']))
+            if volatile:
+                track.update(volatile)
+
+    @classmethod
+    def iter_tracks(cls, value: Any) -> Iterator[Dict[str, Any]]:
+        """Yield every track (dict with SNG_ID) in value, including FALLBACK versions"""
+        if isinstance(value, list):
+            for item in value:
+                yield from cls.iter_tracks(item)
+        elif isinstance(value, dict):
+            if 'SNG_ID' in value:
+                yield value
+            for item in value.values():
+                if isinstance(item, (dict, list)):
+                    yield from cls.iter_tracks(item)
+
+    def _metadata_key(self, content_type: str, content_id: str, market: str) -> str:
+        return f"{self.namespace}{content_type}/{market}/{content_id}"
+
+    def _token_key(self, scope: str, track_id: str) -> str:
+        return f"{self.namespace}token/{scope}/{track_id}"
+
+    def _get(self, key: str) -> Optional[str]:
+        return self._get_many([key])[0]
+
+    def _get_many(self, keys: List[str]) -> List[Optional[str]]:
+        now = time.time()
+        results: List[Optional[str]] = [None] * len(keys)
+        remote = []
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = self._local.get(key)
+                if entry and entry[1] > now:
+                    self._local.move_to_end(key)
+                    results[i] = entry[0]
+                else:
+                    remote.append(i)
+
+        if remote and self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for i in remote:
+                    pipe.get(keys[i])
+                    pipe.ttl(keys[i])
+                replies = pipe.execute()
+            except redis.RedisError as e:
+                logger.warning(f"Metadata cache unavailable: {e}")
+                return results
+
+            for n, i in enumerate(remote):
+                payload, ttl = replies[2 * n], replies[2 * n + 1]
+                if payload is not None:
+                    results[i] = payload
+                    self._remember(keys[i], payload, now + max(ttl, 1))
+
+        return results
+
+    def _set(self, key: str, payload: str, ttl: int):
+        self._remember(key, payload, time.time() + ttl)
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(key, payload, ex=ttl)
+        except redis.RedisError as e:
+            logger.warning(f"Metadata cache unavailable: {e}")
+
+    def _remember(self, key: str, payload: str, expires_at: float):
+        with self._lock:
+            self._local[key] = (payload, expires_at)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
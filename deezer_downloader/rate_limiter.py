@@ -0,0 +1,141 @@
+import random
+import time
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import urlsplit
+import redis
+from redis_manager import RedisManager
+from logging_config import logger
+
+
+class EndpointLimit(NamedTuple):
+    # Requests per second allowed when Deezer is not pushing back
+    rate: float
+    # Requests that may be sent at once after a quiet period
+    burst: int
+
+
+# Refill a bucket for the time elapsed since it was last used, letting a lowered rate recover
+# linearly towards its maximum at the same time. Uses the Redis clock so all hosts agree.
+_REFILL = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local max_rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'rate', 'ts', 'penalized')
+local rate = tonumber(bucket[2]) or max_rate
+local tokens = tonumber(bucket[1]) or burst
+local elapsed = math.max(0, now - (tonumber(bucket[3]) or now))
+rate = math.min(max_rate, rate + max_rate * tonumber(ARGV[3]) * elapsed)
+tokens = math.min(burst, tokens + rate * elapsed)
+"""
+
+# Reserve a token and return how long to wait until it is due, as a string since Lua numbers
+# are truncated to integers in replies
+_ACQUIRE = _REFILL + """
+tokens = tokens - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'rate', rate, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(math.max(0, -tokens / rate))
+"""
+
+# Cut the rate after Deezer pushed back, at most once per cooldown so a burst of rejected
+# requests counts as one signal, and drop the tokens saved up for bursts
+_PENALIZE = _REFILL + """
+if now - (tonumber(bucket[4]) or 0) >= tonumber(ARGV[6]) then
+    rate = math.max(max_rate * tonumber(ARGV[5]), rate * tonumber(ARGV[4]))
+    redis.call('HSET', KEYS[1], 'penalized', now)
+end
+tokens = math.min(tokens, 0)
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'rate', rate, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits per class of Deezer endpoint, shared by all processes through Redis
+
+    Every request reserves a token from the bucket of its endpoint class and waits until the token
+    is due. When Deezer answers with 429 or a 5xx, the rate of that class is halved for everyone
+    (AIMD); it then recovers linearly to its maximum over RECOVERY_SECONDS. If Redis is
+    unavailable, requests are not limited.
+    """
+
+    LIMITS: Dict[str, EndpointLimit] = {
+        'gw': EndpointLimit(rate=10, burst=20),
+        'get_url': EndpointLimit(rate=10, burst=20),
+        'page': EndpointLimit(rate=5, burst=10),
+    }
+    # Factor applied to the rate on each push back, and the lowest fraction of the maximum it can reach
+    DECREASE_FACTOR = 0.5
+    MIN_RATE_FRACTION = 0.05
+    # Seconds over which a rate at zero would climb back to its maximum
+    RECOVERY_SECONDS = 60
+    # Push backs within this many seconds of the previous one do not lower the rate again
+    PENALTY_COOLDOWN_SECONDS = 2
+    # Base and cap of the exponential backoff between retries of a rejected request
+    BACKOFF_BASE_SECONDS = 0.5
+    BACKOFF_MAX_SECONDS = 30
+
+    def __init__(self, redis_manager: Optional[RedisManager], limits: Optional[Dict[str, EndpointLimit]] = None):
+        self.redis = redis_manager.redis if redis_manager else None
+        self.namespace = f"{redis_manager.namespace if redis_manager else 'dz-dl/'}ratelimit/"
+        self.limits = {**self.LIMITS, **(limits or {})}
+        if self.redis is not None:
+            self._acquire = self.redis.register_script(_ACQUIRE)
+            self._penalize = self.redis.register_script(_PENALIZE)
+
+    @staticmethod
+    def classify(url: str) -> Optional[str]:
+        """Endpoint class of a request URL, or None for requests that are not limited (audio CDN)"""
+        parts = urlsplit(url)
+        if parts.hostname == 'www.deezer.com':
+            return 'gw' if parts.path.startswith('/ajax/gw-light.php') else 'page'
+        if parts.hostname == 'media.deezer.com':
+            return 'get_url'
+        return None
+
+    def acquire(self, endpoint: str):
+        """Wait until a request to endpoint may be sent"""
+        if self.redis is None:
+            return
+        limit = self.limits[endpoint]
+        try:
+            wait = float(self._call(self._acquire, endpoint, limit))
+        except redis.RedisError as e:
+            logger.warning(f"Rate limiter unavailable: {e}")
+            return
+        if wait > 0:
+            time.sleep(wait)
+
+    def penalize(self, endpoint: str):
+        """Lower the rate of endpoint after Deezer rejected a request with 429 or a 5xx"""
+        if self.redis is None:
+            return
+        limit = self.limits[endpoint]
+        try:
+            rate = float(self._call(self._penalize, endpoint, limit, self.DECREASE_FACTOR, self.MIN_RATE_FRACTION,
+                                    self.PENALTY_COOLDOWN_SECONDS))
+        except redis.RedisError as e:
+            logger.warning(f"Rate limiter unavailable: {e}")
+            return
+        logger.warning(f"Deezer is throttling {endpoint} requests, rate now {rate:.2f}/s")
+
+    def backoff_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Seconds to wait before retry number attempt (from 0) of a rejected request
+
+        Full jitter spreads the retries of concurrent tasks apart; a Retry-After header, when
+        present, is the minimum.
+        """
+        delay = random.uniform(0, min(self.BACKOFF_MAX_SECONDS, self.BACKOFF_BASE_SECONDS * 2 ** (attempt + 1)))
+        try:
+            return max(delay, float(retry_after)) if retry_after else delay
+        except ValueError:
+            # Retry-After may also be an HTTP date, which is not worth parsing here
+            return delay
+
+    def _call(self, script, endpoint: str, limit: EndpointLimit, *args):
+        return script(keys=[f"{self.namespace}{endpoint}"],
+                      args=[limit.rate, limit.burst, 1 / self.RECOVERY_SECONDS, *args])
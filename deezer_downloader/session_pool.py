@@ -0,0 +1,36 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+from .sessions import DeezerSession
+from .config import DeezerConfig
+from .rate_limiter import RateLimiter
+
+
+class SessionPool:
+    """
+    Process-wide pool of DeezerSessions, keyed by account and quality
+
+    Tasks of the same account share one session, so they reuse its open connections and its
+    license token, sound format and CSRF token instead of fetching user data again.
+    """
+
+    def __init__(self, max_sessions: int = 256, rate_limiter: Optional[RateLimiter] = None):
+        self.max_sessions = max_sessions
+        # Shared by every session, since Deezer throttles by client rather than by account
+        self.rate_limiter = rate_limiter
+        self._sessions: OrderedDict[Tuple[str, str], DeezerSession] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, config: DeezerConfig) -> DeezerSession:
+        """Get the session of config's account, creating it if needed; it may not be initialized yet"""
+        key = (config.arl_digest, config.quality)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = DeezerSession(config, self.rate_limiter)
+                self._sessions[key] = session
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_sessions:
+                # Tasks still holding an evicted session keep using it; it is just no longer shared
+                self._sessions.popitem(last=False)
+            return session
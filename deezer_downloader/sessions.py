@@ -1,25 +1,119 @@
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Optional, Dict, Any
 from .config import DeezerConfig
-from .exceptions import DeezerApiException
+from .rate_limiter import RateLimiter
+from .exceptions import DeezerApiException, Deezer403Exception
+from .gw_api import GW_API_PATH, gw_api_params
 from logging_config import logger
 
 
 class DeezerSession:
-    def __init__(self, config: DeezerConfig):
+    WWW_URL = "https://www.deezer.com"
+    # After an authentication failure, do not initialize again if that was done this recently
+    REVALIDATE_INTERVAL_SECONDS = 10
+    # Audio CDN hosts whose connection pools are kept at the same time
+    CDN_HOSTS = 8
+
+    def __init__(self, config: DeezerConfig, rate_limiter: Optional[RateLimiter] = None):
         self.config = config
+        self.rate_limiter = rate_limiter
         self.session = self._create_session()
         self.license_token: Optional[str] = None
+        # CSRF token (checkForm) required by gw-light API calls
+        self.api_token: Optional[str] = None
         self.sound_format: str = "MP3_128"
+        self.initialized_at: Optional[float] = None
+        self._init_lock = threading.Lock()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Send a request over the pooled connections of this session
+
+        Requests to rate limited endpoints wait for their turn, and are retried with jittered
+        backoff up to config.rate_limit_retries times when Deezer answers with 429 or a 5xx.
+        """
+        endpoint = self.rate_limiter.classify(url) if self.rate_limiter else None
+        if endpoint is None:
+            return self.session.request(method, url, **kwargs)
+
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(endpoint)
+            response = self.session.request(method, url, **kwargs)
+            if (response.status_code != 429 and response.status_code < 500) or attempt >= self.config.rate_limit_retries:
+                return response
+
+            self.rate_limiter.penalize(endpoint)
+            delay = self.rate_limiter.backoff_delay(attempt, response.headers.get('Retry-After'))
+            response.close()
+            attempt += 1
+            logger.warning(f"{endpoint} request answered with {response.status_code}, "
+                           f"retrying in {delay:.1f}s ({attempt}/{self.config.rate_limit_retries})")
+            time.sleep(delay)
+
+    def connection_stats(self, since: Optional[Dict[str, Dict[str, int]]] = None) -> Dict[str, Dict[str, int]]:
+        """
+        Connections opened and requests sent per host, showing how often connections are reused
+
+        The counters cover the whole life of the session, which a session pool shares between tasks;
+        pass an earlier result as since to count only what happened after it.
+        """
+        stats: Dict[str, Dict[str, int]] = {}
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = stats.setdefault(pool.host, {'connections': 0, 'requests': 0})
+                host['connections'] += pool.num_connections
+                host['requests'] += pool.num_requests
+
+        if since is not None:
+            for name, host in stats.items():
+                earlier = since.get(name, {})
+                # Pools of idle CDN hosts may have been evicted and recreated since, restarting their counters
+                for counter in ('connections', 'requests'):
+                    host[counter] = max(0, host[counter] - earlier.get(counter, 0))
+            stats = {name: host for name, host in stats.items() if host['requests']}
+
+        for host in stats.values():
+            host['reused'] = max(0, host['requests'] - host['connections'])
+        return stats
 
     def _create_session(self) -> requests.Session:
         session = requests.Session()
-        session.headers.update({
+        # Separate connection pools for the website/API, URL resolution and the audio CDN hosts,
+        # each sized for the number of requests expected to run concurrently against it
+        session.mount('https://', HTTPAdapter(pool_connections=self.CDN_HOSTS, pool_maxsize=self.config.cdn_pool_size))
+        session.mount('https://www.deezer.com', HTTPAdapter(pool_connections=1, pool_maxsize=self.config.www_pool_size))
+        session.mount('https://media.deezer.com',
+                      HTTPAdapter(pool_connections=1, pool_maxsize=self.config.media_pool_size))
+        session.headers.update(self.default_headers(self.config))
+        session.cookies.update({
+            'arl': self.config.cookie_arl,
+            'comeback': '1'
+        })
+        return session
+
+    @staticmethod
+    def default_headers(config: DeezerConfig) -> Dict[str, str]:
+        """Headers sent with every request, matching those of the Deezer web player"""
+        return {
             'Pragma': 'no-cache',
             'Origin': 'https://www.deezer.com',
             'Accept-Encoding': 'gzip, deflate, br',
             'Accept-Language': 'en-US,en;q=0.9',
-            'User-Agent': self.config.user_agent,
+            'User-Agent': config.user_agent,
             'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
             'Accept': '*/*',
             'Cache-Control': 'no-cache',
@@ -27,47 +121,70 @@ class DeezerSession:
             'Connection': 'keep-alive',
             'Referer': 'https://www.deezer.com/login',
             'DNT': '1',
-        })
-        session.cookies.update({
-            'arl': self.config.cookie_arl,
-            'comeback': '1'
-        })
-        return session
+        }
 
     def initialize_session(self):
         """Initialize session with user data and quality settings"""
         user_data = self._get_user_data()
         self.license_token = user_data['license_token']
-        self._set_sound_quality(self.config.quality, user_data['web_sound_quality'])
+        self.api_token = user_data['api_token']
+        self.sound_format = self.choose_sound_format(self.config.quality, user_data['web_sound_quality'])
+        self.initialized_at = time.time()
+
+    def ensure_initialized(self, max_age_seconds: float):
+        """Initialize the session unless it was initialized less than max_age_seconds ago"""
+        with self._init_lock:
+            if self.initialized_at is None or time.time() - self.initialized_at > max_age_seconds:
+                self.initialize_session()
+
+    def revalidate(self):
+        """Initialize the session again after an authentication failure, unless another thread just did"""
+        with self._init_lock:
+            if self.initialized_at is None or time.time() - self.initialized_at > self.REVALIDATE_INTERVAL_SECONDS:
+                logger.info("Revalidating Deezer session")
+                self.initialize_session()
+
+    def get_api_token(self, refresh: bool = False) -> str:
+        """Get the CSRF token for gw-light API calls, fetching it only if unknown or refresh is set"""
+        if refresh or not self.api_token:
+            self.api_token = self._get_user_data()['api_token']
+        return self.api_token
 
     def _get_user_data(self) -> Dict[str, Any]:
         try:
-            response = self.session.get(
-                'https://www.deezer.com/ajax/gw-light.php',
-                params={
-                    'method': 'deezer.getUserData',
-                    'input': '3',
-                    'api_version': '1.0',
-                    'api_token': ''
-                }
-            )
+            response = self.get(f"{self.WWW_URL}{GW_API_PATH}", params=gw_api_params('deezer.getUserData', ''))
             response.raise_for_status()
-            data = response.json()['results']
-            return {
-                'license_token': data['USER']['OPTIONS']['license_token'],
-                'web_sound_quality': data['USER']['OPTIONS']['web_sound_quality']
-            }
+            return self.parse_user_data(response.json())
         except (requests.exceptions.RequestException, KeyError) as e:
             raise DeezerApiException(f"Failed to get user data: {e}")
 
-    def _set_sound_quality(self, quality_config: str, web_sound_quality: Dict[str, bool]):
+    @staticmethod
+    def parse_user_data(data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Pick the tokens and sound quality options out of a deezer.getUserData response
+
+        Raises:
+            Deezer403Exception: If the ARL cookie is not logged in to an account
+        """
+        results = data['results']
+        if not results['USER'].get('USER_ID'):
+            raise Deezer403Exception("Not logged in to Deezer, check the ARL cookie")
+        return {
+            'api_token': results['checkForm'],
+            'license_token': results['USER']['OPTIONS']['license_token'],
+            'web_sound_quality': results['USER']['OPTIONS']['web_sound_quality']
+        }
+
+    @staticmethod
+    def choose_sound_format(quality_config: str, web_sound_quality: Dict[str, bool]) -> str:
+        """Best sound format for the configured quality that the account is allowed to stream"""
         flac_supported = web_sound_quality.get('lossless', False)
 
         if flac_supported and quality_config == "flac":
-            self.sound_format = "FLAC"
+            return "FLAC"
         elif flac_supported:
-            self.sound_format = "MP3_320"
+            return "MP3_320"
         else:
             if quality_config == "flac":
                 logger.info("WARNING: FLAC quality requested but not supported. Falling back to MP3")
-            self.sound_format = "MP3_128"
+            return "MP3_128"
@@ -0,0 +1,112 @@
+import os
+import shutil
+import threading
+import uuid
+from typing import Optional, Tuple
+from logging_config import logger
+
+
+class TrackStore:
+    """
+    On-disk store of decrypted tracks, keyed by SNG_ID and requested sound format
+
+    Tracks are added atomically once decrypted and handed out as hardlinks (or copies when the
+    store is on another filesystem). The store is kept under max_bytes by evicting the least
+    recently used tracks; a track's mtime is bumped whenever it is handed out. Several processes
+    can share the same directory.
+    """
+
+    SOUND_FORMATS = ('FLAC', 'MP3_320', 'MP3_128')
+    # Evict down to this fraction of max_bytes so eviction does not run on every add
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._size = self._scan_size()
+
+    def find(self, track_id: str, sound_format: str) -> Optional[Tuple[str, str]]:
+        """
+        Look up a track downloaded with the requested sound_format
+
+        Returns:
+            Tuple of the stored file path and the sound format it actually has, or None
+        """
+        for stored_format in self.SOUND_FORMATS:
+            path = self._path(track_id, sound_format, stored_format)
+            if os.path.exists(path):
+                return path, stored_format
+        return None
+
+    def link(self, stored_path: str, output_path: str) -> bool:
+        """Place a stored track at output_path, returning False if it was evicted meanwhile"""
+        try:
+            try:
+                os.link(stored_path, output_path)
+            except FileExistsError:
+                os.remove(output_path)
+                os.link(stored_path, output_path)
+            except OSError:
+                shutil.copyfile(stored_path, output_path)
+        except FileNotFoundError:
+            return False
+
+        try:
+            os.utime(stored_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def add(self, track_id: str, sound_format: str, stored_format: str, source_path: str):
+        """Store a decrypted track, replacing any previous copy"""
+        path = self._path(track_id, sound_format, stored_format)
+        temp_path = os.path.join(self.root, f".{uuid.uuid4().hex}.tmp")
+        try:
+            try:
+                os.link(source_path, temp_path)
+            except OSError:
+                shutil.copyfile(source_path, temp_path)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to add track {track_id} to the track store: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        with self._lock:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _path(self, track_id: str, sound_format: str, stored_format: str) -> str:
+        return os.path.join(self.root, f"{track_id}.{sound_format}.{stored_format}")
+
+    def _scan_size(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(self.root) if entry.is_file())
+
+    def _evict(self):
+        """Remove least recently used tracks until the store is below its target size"""
+        entries = []
+        for entry in os.scandir(self.root):
+            try:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+
+        # Other processes add and evict too, so start from what is actually on disk
+        self._size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * self.EVICTION_TARGET
+        for _, size, path in sorted(entries):
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                self._size -= size
+        logger.info(f"Track store evicted down to {self._size} bytes")
@@ -0,0 +1,176 @@
+import threading
+import time
+import requests
+from typing import List, Dict, Any, Iterable, NamedTuple, Optional, Tuple
+from .sessions import DeezerSession
+from .config import DeezerConfig
+from .exceptions import DeezerApiException
+from logging_config import logger
+
+
+class ResolvedUrl(NamedTuple):
+    url: Optional[str]
+    sound_format: Optional[str]
+    expires_at: float
+    error: Optional[str] = None
+
+
+class TrackUrls:
+    """
+    CDN URLs of tracks resolved through media.deezer.com/v1/get_url: which tracks still need
+    resolving, the get_url requests for them and what their responses hold, without the I/O.
+    Shared by TrackUrlResolver and the asyncio client, which send the requests.
+    """
+
+    GET_URL_ENDPOINT = "https://media.deezer.com/v1/get_url"
+    # Tokens sent per get_url request
+    BATCH_SIZE = 50
+    # Formats tried in order for each requested sound format, so the server picks the best
+    # available one and format fallback costs no extra round trip
+    FORMAT_FALLBACKS = {
+        'FLAC': ['FLAC', 'MP3_320', 'MP3_128'],
+        'MP3_320': ['MP3_320', 'MP3_128'],
+        'MP3_128': ['MP3_128'],
+    }
+    # Resolve again when a URL is this close to expiring
+    EXPIRY_MARGIN_SECONDS = 60
+    # Lifetime assumed for URLs and errors when the response carries no expiry
+    DEFAULT_TTL_SECONDS = 600
+
+    def __init__(self):
+        self._resolved: Dict[str, ResolvedUrl] = {}
+        self._lock = threading.Lock()
+
+    def pending_batches(self, tracks: Iterable[Dict[str, Any]]) -> List[List[Tuple[str, str]]]:
+        """(track ID, track token) pairs of tracks and their fallback versions not resolved yet, in batches"""
+        pending: Dict[str, str] = {}
+        for track in tracks:
+            for info in (track, track.get('FALLBACK')):
+                if info and info.get('TRACK_TOKEN') and self.get(str(info['SNG_ID'])) is None:
+                    pending[str(info['SNG_ID'])] = info['TRACK_TOKEN']
+
+        items = list(pending.items())
+        return [items[start:start + self.BATCH_SIZE] for start in range(0, len(items), self.BATCH_SIZE)]
+
+    def lookup(self, track_info: Dict[str, Any]) -> Tuple[str, str]:
+        """
+        Get the resolved URL of a track
+
+        Returns:
+            Tuple of the URL and the sound format it serves
+
+        Raises:
+            DeezerApiException: If the track was not resolved, or get_url returned an error for it
+        """
+        resolved = self.get(str(track_info['SNG_ID']))
+        if resolved is None or resolved.error:
+            error = resolved.error if resolved else "no URL returned"
+            raise DeezerApiException(f"Failed to get download URL: {error}")
+        return resolved.url, resolved.sound_format
+
+    def get(self, track_id: str) -> Optional[ResolvedUrl]:
+        """Resolved URL of a track, None if unknown or about to expire"""
+        with self._lock:
+            resolved = self._resolved.get(track_id)
+        if resolved and resolved.expires_at - self.EXPIRY_MARGIN_SECONDS > time.time():
+            return resolved
+        return None
+
+    def invalidate(self, track_id: str):
+        """Forget the URL of a track, e.g. after the CDN rejected it"""
+        with self._lock:
+            self._resolved.pop(str(track_id), None)
+
+    @classmethod
+    def request_body(cls, license_token: str, sound_format: str, batch: List[Tuple[str, str]]) -> Dict[str, Any]:
+        """JSON body of the get_url request resolving a batch of (track ID, track token) pairs"""
+        formats = cls.FORMAT_FALLBACKS.get(sound_format, [sound_format])
+        return {
+            'license_token': license_token,
+            'media': [{
+                'type': "FULL",
+                "formats": [{"cipher": "BF_CBC_STRIPE", "format": fmt} for fmt in formats]
+            }],
+            'track_tokens': [track_token for _, track_token in batch]
+        }
+
+    @staticmethod
+    def license_rejected(data: Dict[str, Any]) -> bool:
+        """Whether a get_url response failed as a whole, meaning the license token was rejected"""
+        return not data.get('data') and bool(data.get('errors'))
+
+    def store(self, batch: List[Tuple[str, str]], data: Dict[str, Any]):
+        """Record the results of the get_url response to a batch"""
+        entries = data.get('data') or []
+        if len(entries) != len(batch):
+            raise DeezerApiException(f"Failed to get track URL: expected {len(batch)} results, got {len(entries)}")
+
+        default_expiry = time.time() + self.DEFAULT_TTL_SECONDS
+        with self._lock:
+            for (track_id, _), entry in zip(batch, entries):
+                self._resolved[track_id] = self.parse_entry(entry, default_expiry)
+
+    @staticmethod
+    def parse_entry(entry: Dict[str, Any], default_expiry: float) -> ResolvedUrl:
+        """Turn the get_url result of one track into a ResolvedUrl"""
+        if entry.get('errors'):
+            return ResolvedUrl(None, None, default_expiry, entry['errors'][0].get('message', 'unknown error'))
+
+        for media in entry.get('media') or []:
+            if media.get('sources'):
+                return ResolvedUrl(media['sources'][0]['url'], media['format'], media.get('exp') or default_expiry)
+
+        return ResolvedUrl(None, None, default_expiry, "track not available in the requested formats")
+
+
+class TrackUrlResolver(TrackUrls):
+    """Resolves CDN URLs of tracks through media.deezer.com/v1/get_url, many tracks per request"""
+
+    def __init__(self, config: DeezerConfig, session: DeezerSession):
+        super().__init__()
+        self.config = config
+        self.session = session
+
+    def prefetch(self, tracks: Iterable[Dict[str, Any]]):
+        """Resolve the URLs of tracks and of their fallback versions in batched requests"""
+        for batch in self.pending_batches(tracks):
+            try:
+                self._resolve_batch(batch)
+            except DeezerApiException as e:
+                # Tracks of a failed batch are resolved one by one when downloaded
+                logger.warning(f"Failed to prefetch {len(batch)} track URLs: {e}")
+
+    def resolve(self, track_info: Dict[str, Any]) -> Tuple[str, str]:
+        """
+        Get the download URL of a track, resolving it if it is not cached or about to expire
+
+        Returns:
+            Tuple of the URL and the sound format it serves
+        """
+        track_id = str(track_info['SNG_ID'])
+        if self.get(track_id) is None:
+            self._resolve_batch([(track_id, track_info['TRACK_TOKEN'])])
+        return self.lookup(track_info)
+
+    def _resolve_batch(self, batch: List[Tuple[str, str]]):
+        """Resolve (track ID, track token) pairs with a single get_url request"""
+        data = self._request_urls(batch)
+        if self.license_rejected(data):
+            # e.g. a pooled session expired
+            self.session.revalidate()
+            data = self._request_urls(batch)
+        self.store(batch, data)
+
+    def _request_urls(self, batch: List[Tuple[str, str]]) -> Dict[str, Any]:
+        try:
+            response = self.session.post(
+                self.GET_URL_ENDPOINT,
+                json=self.request_body(self.session.license_token, self.session.sound_format, batch),
+                headers={
+                    'Content-Type': 'application/json'
+                }
+            )
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise DeezerApiException(f"Failed to get track URL: {e}")
@@ -0,0 +1,171 @@
+import os
+from typing import Callable, Optional
+from .crypto import DeezerCrypto
+
+
+class PartFileDecryption:
+    """
+    Decrypt a stream into <output_path>.part as it downloads
+
+    The part file only ever holds whole decrypted blocks until the final short block, so an
+    interrupted download can resume from offset with a Range request on the 2048-byte block grid,
+    keeping the every-third-block decryption in phase.
+    """
+
+    def __init__(self, key: str, output_path: str):
+        self.key = key
+        self.output_path = output_path
+        self.part_path = f"{output_path}.part"
+        self._part_file = open(self.part_path, "wb")
+
+    @property
+    def offset(self) -> int:
+        """Stream position to resume the download from"""
+        size = self._part_file.tell()
+        return size - size % DeezerCrypto.BLOCK_SIZE
+
+    @property
+    def size(self) -> int:
+        """Bytes of the stream received so far"""
+        return self._part_file.tell()
+
+    def write_from(self, response, offset: int, on_progress: Optional[Callable[[int], None]] = None):
+        """
+        Decrypt a response body starting at stream position offset
+
+        Args:
+            response: requests Response opened with stream=True
+            offset: A block-aligned position no greater than self.offset, 0 to start over
+            on_progress: Called with the bytes of the stream received so far as they are written
+        """
+        self._part_file.seek(offset)
+        self._part_file.truncate()
+        DeezerCrypto.decrypt_file(response, self.key, self._part_file,
+                                  block_index=offset // DeezerCrypto.BLOCK_SIZE,
+                                  on_progress=(lambda written: on_progress(offset + written)) if on_progress else None)
+
+    def write_blocks(self, buffer: bytearray, offset: int):
+        """
+        Decrypt, in place, a buffer holding the stream from position offset and write it there
+
+        Args:
+            buffer: Whole blocks of the stream, except for the last buffer which may end on the
+                short final block
+            offset: A block-aligned position no greater than self.size
+        """
+        DeezerCrypto.decrypt_stripes(buffer, self.key, offset // DeezerCrypto.BLOCK_SIZE)
+        self._part_file.seek(offset)
+        self._part_file.truncate()
+        self._part_file.write(buffer)
+
+    def finish(self):
+        """Move the complete part file to output_path"""
+        self._part_file.close()
+        os.replace(self.part_path, self.output_path)
+
+    def abort(self):
+        """Remove the part file"""
+        self._part_file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+class RangeNotSupported(Exception):
+    """The CDN did not answer a Range request with the expected partial content"""
+    pass
+
+
+class SegmentedDecryption:
+    """
+    Decrypt a stream downloaded as several byte ranges in parallel into <output_path>.part
+
+    The part file is preallocated to the size of the stream and split into segments starting on
+    STRIPE_SIZE boundaries, so each segment begins in the same decryption phase as the stream.
+    Segments are decrypted independently and written at their offsets, from any thread.
+    """
+
+    def __init__(self, key: str, output_path: str, size: int, segment_count: int):
+        self.key = key
+        self.output_path = output_path
+        self.part_path = f"{output_path}.part"
+        self.size = size
+        self.cancelled = False
+        self._fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._preallocate()
+
+        stripes = -(-size // DeezerCrypto.STRIPE_SIZE)
+        segment_size = -(-stripes // max(1, min(segment_count, stripes))) * DeezerCrypto.STRIPE_SIZE
+        self.segments = [DecryptedSegment(self, start, min(start + segment_size, size))
+                         for start in range(0, size, segment_size)]
+
+    def cancel(self):
+        """Make segments still downloading stop at their next write"""
+        self.cancelled = True
+
+    def finish(self):
+        """Move the complete part file to output_path"""
+        os.close(self._fd)
+        os.replace(self.part_path, self.output_path)
+
+    def abort(self):
+        """Remove the part file; segments must no longer be downloading"""
+        os.close(self._fd)
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def pwrite(self, data, position: int):
+        """Write data at position of the part file"""
+        view = memoryview(data)
+        while view:
+            count = os.pwrite(self._fd, view, position)
+            view = view[count:]
+            position += count
+
+    def _preallocate(self):
+        try:
+            os.posix_fallocate(self._fd, 0, self.size)
+        except (AttributeError, OSError):
+            # Not available on this platform or filesystem, a sparse file will do
+            os.ftruncate(self._fd, self.size)
+
+
+class DecryptedSegment:
+    """Byte range [start, end) of a SegmentedDecryption"""
+
+    def __init__(self, transfer: SegmentedDecryption, start: int, end: int):
+        self.transfer = transfer
+        self.start = start
+        self.end = end
+        self.received = 0
+
+    @property
+    def offset(self) -> int:
+        """Stream position to resume the download of the segment from"""
+        return self.start + self.received - self.received % DeezerCrypto.BLOCK_SIZE
+
+    @property
+    def complete(self) -> bool:
+        return self.start + self.received >= self.end
+
+    def write_from(self, response, offset: int, on_progress: Optional[Callable[[int], None]] = None):
+        """
+        Decrypt a response body holding the segment from stream position offset
+
+        Args:
+            response: requests Response to a Range request starting at offset
+            offset: A block-aligned position within the segment, no greater than self.offset
+            on_progress: Called with the bytes of the segment received so far as they are written
+        """
+        self.received = offset - self.start
+        DeezerCrypto.decrypt_file(response, self.transfer.key, self,
+                                  block_index=offset // DeezerCrypto.BLOCK_SIZE,
+                                  on_progress=(lambda _: on_progress(self.received)) if on_progress else None)
+
+    def write(self, data):
+        """Called by decrypt_file with the decrypted data following what was received so far"""
+        if self.transfer.cancelled:
+            raise InterruptedError("Segmented transfer cancelled")
+        if self.start + self.received + len(data) > self.end:
+            raise RangeNotSupported("Received more data than the segment holds")
+        self.transfer.pwrite(data, self.start + self.received)
+        self.received += len(data)
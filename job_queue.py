@@ -0,0 +1,197 @@
+import json
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import redis
+from redis_manager import RedisManager
+from logging_config import logger
+
+
+class QueueFullError(Exception):
+    """The download queue already holds its maximum number of waiting jobs"""
+    pass
+
+
+# Queue a job unless max_queued jobs are already waiting; returns its 1-based position, or 0 if full
+_ENQUEUE = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+return redis.call('RPUSH', KEYS[1], ARGV[4])
+"""
+
+# Move the next waiting job to the processing set, invisible to other workers until its deadline
+_RESERVE = """
+local job_id = redis.call('LPOP', KEYS[1])
+if not job_id then
+    return nil
+end
+local time = redis.call('TIME')
+redis.call('ZADD', KEYS[2], tonumber(time[1]) + tonumber(ARGV[1]), job_id)
+return {job_id, redis.call('GET', ARGV[2] .. job_id)}
+"""
+
+# Push back the deadline of a job still being processed; does nothing if it was already re-delivered
+_EXTEND = """
+local time = redis.call('TIME')
+return redis.call('ZADD', KEYS[1], 'XX', 'CH', tonumber(time[1]) + tonumber(ARGV[1]), ARGV[2])
+"""
+
+# Put jobs whose worker stopped heartbeating back at the front of the queue, giving up on (and
+# returning) those delivered max_deliveries times already
+_REQUEUE_EXPIRED = """
+local time = redis.call('TIME')
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', time[1])
+local dead = {}
+for _, job_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], job_id)
+    if redis.call('HINCRBY', KEYS[3], job_id, 1) >= tonumber(ARGV[1]) then
+        redis.call('HDEL', KEYS[3], job_id)
+        redis.call('DEL', ARGV[2] .. job_id)
+        table.insert(dead, job_id)
+    else
+        redis.call('LPUSH', KEYS[2], job_id)
+    end
+end
+return dead
+"""
+
+
+class JobQueue:
+    """
+    Reliable queue of download jobs in Redis, shared by the web app and any number of workers
+
+    Waiting jobs are kept in a list, so their position is known. A worker reserving a job moves it
+    to a processing set with a deadline (the visibility timeout) that it keeps pushing back while
+    the job runs. Jobs of a worker that crashed or was killed pass their deadline and are put back
+    at the front of the queue by requeue_expired, up to MAX_DELIVERIES times.
+    """
+
+    # Seconds a reserved job stays invisible to other workers without a heartbeat
+    VISIBILITY_TIMEOUT_SECONDS = 120
+    HEARTBEAT_SECONDS = 30
+    # Deliveries of a job before it is given up on, in case it is what crashes its workers
+    MAX_DELIVERIES = 3
+    # Seconds an idle worker waits before looking for a job again
+    POLL_SECONDS = 1
+    # Seconds the payload of a job (which holds the ARL cookie) is kept if it is never processed
+    PAYLOAD_TTL_SECONDS = 24 * 3600
+
+    def __init__(self, redis_manager: RedisManager, max_queued: int, name: str = 'downloads'):
+        self.redis = redis_manager.redis
+        self.max_queued = max_queued
+        prefix = f"{redis_manager.namespace}jobs/{name}/"
+        self.pending_key = f"{prefix}pending"
+        self.processing_key = f"{prefix}processing"
+        self.deliveries_key = f"{prefix}deliveries"
+        self.payload_prefix = f"{prefix}job/"
+        self._enqueue = self.redis.register_script(_ENQUEUE)
+        self._reserve = self.redis.register_script(_RESERVE)
+        self._extend = self.redis.register_script(_EXTEND)
+        self._requeue_expired = self.redis.register_script(_REQUEUE_EXPIRED)
+
+    def enqueue(self, job_id: str, payload: Dict[str, Any]) -> int:
+        """
+        Queue a job for the next free worker
+
+        Returns:
+            1-based position of the job in the queue
+
+        Raises:
+            QueueFullError: If max_queued jobs are already waiting
+        """
+        position = self._enqueue(keys=[self.pending_key, self.payload_prefix + job_id],
+                                 args=[self.max_queued, json.dumps(payload), self.PAYLOAD_TTL_SECONDS, job_id])
+        if not position:
+            raise QueueFullError(f"{self.max_queued} jobs already queued")
+        return position
+
+    def position(self, job_id: str) -> Optional[int]:
+        """1-based position of a waiting job, or None if it is not (or no longer) queued"""
+        index = self.redis.lpos(self.pending_key, job_id)
+        return None if index is None else index + 1
+
+    def positions(self, job_ids: List[str]) -> Dict[str, Optional[int]]:
+        """Positions of several jobs, as returned by position, in a single round trip"""
+        pipe = self.redis.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.lpos(self.pending_key, job_id)
+        return {job_id: None if index is None else index + 1 for job_id, index in zip(job_ids, pipe.execute())}
+
+    def __len__(self) -> int:
+        return self.redis.llen(self.pending_key)
+
+    def reserve(self) -> Optional[Tuple[str, Optional[Dict[str, Any]]]]:
+        """
+        Take the next waiting job, if any
+
+        Returns:
+            Tuple of the job ID and its payload (None if the payload expired), or None
+        """
+        job = self._reserve(keys=[self.pending_key, self.processing_key],
+                            args=[self.VISIBILITY_TIMEOUT_SECONDS, self.payload_prefix])
+        if not job:
+            return None
+        job_id, payload = job
+        return job_id, json.loads(payload) if payload else None
+
+    def extend(self, job_id: str):
+        """Heartbeat of a reserved job, keeping it from being re-delivered"""
+        self._extend(keys=[self.processing_key], args=[self.VISIBILITY_TIMEOUT_SECONDS, job_id])
+
+    def complete(self, job_id: str):
+        """Remove a job once processed, whether it succeeded or not"""
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.processing_key, job_id)
+        pipe.hdel(self.deliveries_key, job_id)
+        pipe.delete(self.payload_prefix + job_id)
+        pipe.execute()
+
+    def requeue_expired(self) -> List[str]:
+        """
+        Re-deliver jobs whose worker stopped heartbeating
+
+        Returns:
+            IDs of the jobs given up on after MAX_DELIVERIES deliveries
+        """
+        return self._requeue_expired(keys=[self.processing_key, self.pending_key, self.deliveries_key],
+                                     args=[self.MAX_DELIVERIES, self.payload_prefix])
+
+    def work(self, handler: Callable[[str, Dict[str, Any]], None], stop_event: threading.Event):
+        """Process jobs with handler(job_id, payload), one at a time, until stop_event is set"""
+        while not stop_event.is_set():
+            try:
+                job = self.reserve()
+            except redis.RedisError as e:
+                logger.warning(f"Job queue unavailable: {e}")
+                job = None
+            if job is None:
+                stop_event.wait(self.POLL_SECONDS)
+                continue
+
+            job_id, payload = job
+            heartbeat_stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, heartbeat_stop), daemon=True)
+            heartbeat.start()
+            try:
+                if payload is None:
+                    logger.warning(f"Dropping job {job_id}, its payload expired")
+                else:
+                    handler(job_id, payload)
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}", exc_info=True)
+            finally:
+                heartbeat_stop.set()
+                heartbeat.join()
+                try:
+                    self.complete(job_id)
+                except redis.RedisError as e:
+                    # The job will be re-delivered once its deadline passes
+                    logger.warning(f"Failed to complete job {job_id}: {e}")
+
+    def _heartbeat(self, job_id: str, stop_event: threading.Event):
+        while not stop_event.wait(self.HEARTBEAT_SECONDS):
+            try:
+                self.extend(job_id)
+            except redis.RedisError as e:
+                logger.warning(f"Failed to extend job {job_id}: {e}")
@@ -0,0 +1,154 @@
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Set
+from redis_manager import RedisManager
+from logging_config import logger
+
+
+class StreamLimitError(Exception):
+    """The process already serves its maximum number of progress streams"""
+    pass
+
+
+# Put in the updates of every subscription once the listener is subscribed again after it was not,
+# e.g. after losing its connection: updates published meanwhile were missed, so the whole progress
+# is read again
+_RESYNC = object()
+
+
+class ProgressSubscription:
+    """
+    Progress of one task followed through a ProgressHub: iterating yields its whole progress first,
+    then the fields changed by each update as it is made, or None after timeout seconds without any
+    update. Yields nothing if the task is not found. Close it to stop following the task.
+    """
+
+    def __init__(self, hub: 'ProgressHub', task_id: str, timeout: float):
+        self.hub = hub
+        self.task_id = task_id
+        self.timeout = timeout
+        self.updates: queue.Queue = queue.Queue()
+
+    def __iter__(self) -> Iterator[Optional[Dict[str, Any]]]:
+        progress = self.hub.redis_manager.get_task_progress(self.task_id)
+        if progress is None:
+            return
+        yield progress
+        while True:
+            try:
+                update = self.updates.get(timeout=self.timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if update is _RESYNC:
+                update = self.hub.redis_manager.get_task_progress(self.task_id)
+                if update is None:
+                    return
+            yield update
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class ProgressHub:
+    """
+    Fans the progress updates of all tasks out to the progress streams open in this process
+
+    A single listener thread holds the only Redis pub/sub connection of the process, subscribed to
+    the event channels of all tasks, and hands each update to the subscriptions of its task. A
+    stream thus costs a queue rather than a connection (and, on a gevent worker, a greenlet rather
+    than a thread), and at most max_streams streams are served at once.
+    """
+
+    # Seconds subscribe waits for the listener to be subscribed, after which updates made before
+    # it is are caught up with once it is
+    SUBSCRIBE_TIMEOUT_SECONDS = 5
+    # Seconds the listener waits before reconnecting after losing its connection
+    RECONNECT_SECONDS = 1
+
+    def __init__(self, redis_manager: RedisManager, max_streams: int):
+        self.redis_manager = redis_manager
+        self.max_streams = max_streams
+        self._subscriptions: Dict[str, Set[ProgressSubscription]] = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._subscribed = threading.Event()
+        # Set when subscriptions may have missed updates while the listener was not subscribed
+        self._resync = False
+        self._listener: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def subscribe(self, task_id: str, timeout: float) -> ProgressSubscription:
+        """
+        Start following the progress of a task, see ProgressSubscription
+
+        Raises:
+            StreamLimitError: If max_streams subscriptions are already open
+        """
+        subscription = ProgressSubscription(self, task_id, timeout)
+        with self._lock:
+            if self._count >= self.max_streams:
+                raise StreamLimitError(f"{self.max_streams} progress streams already open")
+            self._subscriptions.setdefault(task_id, set()).add(subscription)
+            self._count += 1
+            # Started on first use, in the process (e.g. the gunicorn worker) that serves the streams
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True, name='progress-hub')
+                self._listener.start()
+        # The progress is read after the listener is subscribed, so that no update made in between is missed
+        if not self._subscribed.wait(self.SUBSCRIBE_TIMEOUT_SECONDS):
+            self._resync = True
+        return subscription
+
+    def unsubscribe(self, subscription: ProgressSubscription):
+        """Stop following a task; does nothing if the subscription was already closed"""
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.task_id)
+            if not subscriptions or subscription not in subscriptions:
+                return
+            subscriptions.remove(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.task_id]
+            self._count -= 1
+
+    def _listen(self):
+        """Body of the listener thread: dispatches the published updates until the process exits"""
+        pattern = self.redis_manager.get_events_pattern()
+        while True:
+            pubsub = self.redis_manager.redis.pubsub()
+            try:
+                pubsub.psubscribe(pattern)
+                for message in pubsub.listen():
+                    if message['type'] == 'psubscribe':
+                        self._on_subscribed()
+                    elif message['type'] == 'pmessage':
+                        task_id, update = self.redis_manager.parse_progress_event(message['channel'],
+                                                                                  message['data'])
+                        self._dispatch(task_id, update)
+            except Exception as e:
+                logger.error(f"Progress listener lost its Redis connection, reconnecting: {e}")
+                self._resync = True
+            finally:
+                self._subscribed.clear()
+                pubsub.close()
+            time.sleep(self.RECONNECT_SECONDS)
+
+    def _on_subscribed(self):
+        self._subscribed.set()
+        if not self._resync:
+            return
+        self._resync = False
+        with self._lock:
+            subscriptions = [subscription for subscriptions in self._subscriptions.values()
+                             for subscription in subscriptions]
+        for subscription in subscriptions:
+            subscription.updates.put(_RESYNC)
+
+    def _dispatch(self, task_id: str, update: Dict[str, Any]):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(task_id, ()))
+        for subscription in subscriptions:
+            subscription.updates.put(update)
@@ -3,15 +3,27 @@
 # Defines the structure and initial state for a download task's progress.
 # This structure is serialized to Redis and used by the frontend.
 
+import threading
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
 def get_initial_progress_state():
     """Returns the initial dictionary representing a task's progress."""
     return {
         'starting': True,  # Indicates the download process is initializing
-        'current': 0,  # Number of items processed so far
+        'current': 0,  # Number of items downloaded so far
+        'failed': 0,  # Number of items that could not be downloaded
+        'failed_pages': 0,  # Number of playlist pages that could not be fetched, their items counted as failed
         'total': 0,  # Total number of items to process
         'finished': False,  # True if the download and processing (e.g., zipping) are complete
         'error': None,  # Stores an error message if one occurred
-        'zip_ready': False  # True if the zip file has been created and is ready for download
+        'zip_ready': False,  # True if the zip file has been created and is ready for download
+        'queue_position': None,  # 1-based position while waiting for a download worker, None once started
+        'bytes_done': 0,  # Bytes of tracks received so far
+        'bytes_total': 0,  # Size of the tracks started so far, from their Content-Length
+        'rate': 0,  # Bytes received per second, smoothed
+        'eta': None,  # Estimated seconds until all tracks are received, None while unknown
+        'run': 0  # Number of times the task was started, more than 1 once its job was re-delivered
     }
 
 
@@ -19,6 +31,77 @@ def get_initial_progress_state():
 FIELD_STARTING = 'starting'
 FIELD_CURRENT = 'current'
 FIELD_TOTAL = 'total'
+FIELD_FAILED = 'failed'
+FIELD_FAILED_PAGES = 'failed_pages'
 FIELD_FINISHED = 'finished'
 FIELD_ERROR = 'error'
 FIELD_ZIP_READY = 'zip_ready'
+FIELD_QUEUE_POSITION = 'queue_position'
+FIELD_BYTES_DONE = 'bytes_done'
+FIELD_BYTES_TOTAL = 'bytes_total'
+FIELD_RATE = 'rate'
+FIELD_ETA = 'eta'
+FIELD_RUN = 'run'
+
+
+class ProgressAggregator:
+    """
+    Byte-level progress of a task's transfers, coalesced in memory and written to Redis at most
+    once per interval, however often the transfers report
+
+    Each transfer (e.g. a track) reports the bytes it has received so far, so a transfer resumed
+    from an earlier position is not counted twice. Writes are made by the reporting thread when due.
+    """
+
+    # Weight of the latest measurement in the smoothed rate
+    RATE_SMOOTHING = 0.3
+
+    def __init__(self, redis_manager, task_id: str, interval: float = 0.5):
+        self.redis_manager = redis_manager
+        self.task_id = task_id
+        self.interval = interval
+        self.expected_transfers = 0
+        # Bytes received and expected (None while unknown) per transfer
+        self._transfers: Dict[Hashable, Tuple[int, Optional[int]]] = {}
+        self._rate = 0.0
+        self._last_flush: Optional[Tuple[float, int]] = None
+        self._lock = threading.Lock()
+
+    def expect(self, transfers: int):
+        """Number of transfers the task will make, to estimate the size of those not started yet"""
+        self.expected_transfers = transfers
+
+    def update(self, transfer: Hashable, done: int, total: Optional[int] = None):
+        """Report the bytes a transfer has received so far and, once known, its size"""
+        with self._lock:
+            previous_total = self._transfers.get(transfer, (0, None))[1]
+            self._transfers[transfer] = (done, total if total is not None else previous_total)
+            if self._last_flush is None or time.monotonic() - self._last_flush[0] >= self.interval:
+                self._flush()
+
+    def flush(self):
+        """Write the current progress to Redis"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # Called with the lock held, so that writes reach Redis in order
+        now = time.monotonic()
+        done = sum(transfer_done for transfer_done, _ in self._transfers.values())
+        totals = [total for _, total in self._transfers.values() if total is not None]
+        if self._last_flush is not None and now > self._last_flush[0]:
+            rate = max(done - self._last_flush[1], 0) / (now - self._last_flush[0])
+            self._rate = rate if not self._rate else (self.RATE_SMOOTHING * rate
+                                                      + (1 - self.RATE_SMOOTHING) * self._rate)
+        self._last_flush = (now, done)
+
+        total = sum(totals)
+        eta = None
+        if totals and self._rate > 0:
+            # Transfers not started yet are assumed to be as large as the average one so far
+            unstarted = max(self.expected_transfers - len(self._transfers), 0)
+            estimated_total = total + unstarted * total / len(totals)
+            eta = max(round((estimated_total - done) / self._rate), 0)
+
+        self.redis_manager.update_task_progress(self.task_id, **{
+            FIELD_BYTES_DONE: done, FIELD_BYTES_TOTAL: total, FIELD_RATE: round(self._rate), FIELD_ETA: eta})
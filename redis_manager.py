@@ -1,10 +1,81 @@
+import json
 import os
 import redis
 import uuid
 from datetime import timedelta
-from typing import Optional, Dict, Any
-from progress_tracker import get_initial_progress_state, FIELD_CURRENT, FIELD_TOTAL, FIELD_STARTING, FIELD_FINISHED, \
-    FIELD_ZIP_READY, FIELD_ERROR
+from typing import Optional, Dict, Any, List, Tuple
+from progress_tracker import get_initial_progress_state, FIELD_CURRENT, FIELD_TOTAL, FIELD_FAILED, FIELD_FAILED_PAGES, \
+    FIELD_STARTING, FIELD_FINISHED, FIELD_ZIP_READY, FIELD_ERROR, FIELD_QUEUE_POSITION, FIELD_BYTES_DONE, FIELD_BYTES_TOTAL, FIELD_RATE, FIELD_ETA, \
+    FIELD_RUN
+
+# Apply a partial progress update in one step, unless the task expired: set the given fields, increment
+# one if named, refresh the expiry and publish the changed fields to listeners of the task; returns the
+# incremented value (1 if none), or nil if expired
+_UPDATE_PROGRESS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local changes = {}
+if #ARGV > 3 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+    for i = 4, #ARGV, 2 do
+        changes[ARGV[i]] = ARGV[i + 1]
+    end
+end
+local result = 1
+if ARGV[2] ~= '' then
+    result = redis.call('HINCRBY', KEYS[1], ARGV[2], ARGV[3])
+    changes[ARGV[2]] = tostring(result)
+end
+if tonumber(ARGV[1]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+redis.call('PUBLISH', KEYS[2], cjson.encode(changes))
+return result
+"""
+
+# Attach a requester to the task downloading the same content, unless it failed or its files are already
+# gone, or else make the candidate task the one doing it, with the requester as its only one; returns the
+# ID of the task to use
+_ATTACH_OR_CLAIM = """
+local task_id = redis.call('GET', KEYS[1])
+if task_id then
+    local progress_key = ARGV[3] .. task_id
+    local failed = redis.call('HGET', progress_key, ARGV[5]) == 'True'
+        and redis.call('HGET', progress_key, ARGV[4]) ~= 'None'
+    if not failed and redis.call('SCARD', progress_key .. '/refs') > 0 then
+        redis.call('SADD', progress_key .. '/refs', ARGV[6])
+        redis.call('EXPIRE', progress_key .. '/refs', ARGV[2])
+        return task_id
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('DEL', ARGV[3] .. ARGV[1] .. '/refs')
+redis.call('SADD', ARGV[3] .. ARGV[1] .. '/refs', ARGV[6])
+redis.call('EXPIRE', ARGV[3] .. ARGV[1] .. '/refs', ARGV[2])
+return ARGV[1]
+"""
+
+# Give up a task claimed for some content before it could be queued: unmap the content so no request
+# attaches to it any more and drop the claiming requester; requests that attached in the meantime see
+# the task fail with the given error, otherwise it is removed. Returns 1 if it was removed
+_ABANDON_CLAIM = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+redis.call('SREM', KEYS[4], ARGV[6])
+if redis.call('SCARD', KEYS[4]) == 0 then
+    redis.call('DEL', KEYS[2], KEYS[4], KEYS[5])
+    return 1
+end
+redis.call('HSET', KEYS[2], ARGV[2], 'False', ARGV[3], 'True', ARGV[4], ARGV[5])
+local changes = {}
+changes[ARGV[2]] = 'False'
+changes[ARGV[3]] = 'True'
+changes[ARGV[4]] = ARGV[5]
+redis.call('PUBLISH', KEYS[3], cjson.encode(changes))
+return 0
+"""
 
 
 class RedisManager:
@@ -26,10 +97,26 @@ class RedisManager:
         self.redis = redis.Redis.from_url(redis_url, decode_responses=True, **connection_kwargs)
         self.namespace = 'dz-dl/'  # Updated namespace
         self.expire_hours = expire_hours
+        self._update_progress = self.redis.register_script(_UPDATE_PROGRESS)
+        self._attach_or_claim = self.redis.register_script(_ATTACH_OR_CLAIM)
+        self._abandon_claim = self.redis.register_script(_ABANDON_CLAIM)
 
     def _get_key(self, task_id: str) -> str:
         return f"{self.namespace}{task_id}"
 
+    def _get_files_key(self, task_id: str) -> str:
+        return f"{self.namespace}{task_id}/files"
+
+    def _get_events_channel(self, task_id: str) -> str:
+        return f"{self.namespace}{task_id}/events"
+
+    def _get_refs_key(self, task_id: str) -> str:
+        # Set of the requesters of a task that have not downloaded its files yet
+        return f"{self.namespace}{task_id}/refs"
+
+    def _get_inflight_key(self, content_key: str) -> str:
+        return f"{self.namespace}inflight/{content_key}"
+
     def create_task(self) -> str:
         """Creates a new task, stores its initial progress in Redis, and returns its ID."""
         task_id = str(uuid.uuid4())
@@ -40,19 +127,42 @@ class RedisManager:
     def get_task_progress(self, task_id: str) -> Optional[Dict[str, Any]]:
         """Retrieves the progress dictionary for a given task ID from Redis."""
         key = self._get_key(task_id)
-        raw_data = self.redis.hgetall(key)
+        return self._build_progress(self.redis.hgetall(key))
+
+    def get_many_task_progress(self, task_ids: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Retrieves the progress dictionaries of several tasks in a single round trip, None for those not found."""
+        pipe = self.redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(self._get_key(task_id))
+        return {task_id: self._build_progress(raw_data) for task_id, raw_data in zip(task_ids, pipe.execute())}
 
+    def _build_progress(self, raw_data: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """Builds a progress dictionary from the Redis hash of a task, None if the task was not found."""
         if not raw_data:
             return None
 
         # Initialize with default structure for safety, then populate
         progress: Dict[str, Any] = get_initial_progress_state()
+        progress.update(self._parse_progress_fields(raw_data))
+        return progress
+
+    def get_events_pattern(self) -> str:
+        """Pattern matching the channels the progress updates of all tasks are published on."""
+        return self._get_events_channel('*')
 
-        # Convert string values from Redis to appropriate Python types
-        if FIELD_CURRENT in raw_data:
-            progress[FIELD_CURRENT] = int(raw_data[FIELD_CURRENT])
-        if FIELD_TOTAL in raw_data:
-            progress[FIELD_TOTAL] = int(raw_data[FIELD_TOTAL])
+    def parse_progress_event(self, channel: str, data: str) -> Tuple[str, Dict[str, Any]]:
+        """Returns the task ID and the changed progress fields of an update published on channel."""
+        task_id = channel[len(self.namespace):-len('/events')]
+        return task_id, self._parse_progress_fields(json.loads(data))
+
+    @staticmethod
+    def _parse_progress_fields(raw_data: Dict[str, str]) -> Dict[str, Any]:
+        """Converts the progress fields present in raw_data from their Redis strings to Python types."""
+        progress: Dict[str, Any] = {}
+        for int_field in [FIELD_CURRENT, FIELD_TOTAL, FIELD_FAILED, FIELD_FAILED_PAGES, FIELD_BYTES_DONE,
+                          FIELD_BYTES_TOTAL, FIELD_RATE, FIELD_RUN]:
+            if int_field in raw_data:
+                progress[int_field] = int(raw_data[int_field])
 
         for bool_field in [FIELD_STARTING, FIELD_FINISHED, FIELD_ZIP_READY]:
             if bool_field in raw_data:
@@ -60,36 +170,151 @@ class RedisManager:
 
         if FIELD_ERROR in raw_data:
             progress[FIELD_ERROR] = None if raw_data[FIELD_ERROR] == 'None' else raw_data[FIELD_ERROR]
+        if FIELD_QUEUE_POSITION in raw_data:
+            position = raw_data[FIELD_QUEUE_POSITION]
+            progress[FIELD_QUEUE_POSITION] = None if position == 'None' else int(position)
+        if FIELD_ETA in raw_data:
+            progress[FIELD_ETA] = None if raw_data[FIELD_ETA] == 'None' else int(raw_data[FIELD_ETA])
 
         return progress
 
     def update_task_progress(self, task_id: str, **updates: Any) -> bool:
-        """Updates the progress dictionary for a task in Redis."""
-        current_progress = self.get_task_progress(task_id)
-        if current_progress is None:
-            # Task not found or expired
-            return False
+        """
+        Writes the given progress fields of a task, leaving the others as they are, and publishes
+        them on the events channel of the task (see get_events_pattern).
+
+        Returns:
+            False if the task was not found or expired, in which case nothing is written
+        """
+        return self._apply_progress_update(task_id, updates) is not None
 
-        current_progress.update(updates)
-        self._set_task_progress_in_redis(task_id, current_progress)
-        return True
+    def increment_task_progress(self, task_id: str, field: str = FIELD_CURRENT, amount: int = 1,
+                                **updates: Any) -> Optional[int]:
+        """
+        Increments a counter of a task's progress, e.g. the number of completed tracks, so that
+        concurrent updates never overwrite each other, and writes any other given fields with it.
+
+        Returns:
+            The new value of the counter, or None if the task was not found or expired
+        """
+        return self._apply_progress_update(task_id, updates, field, amount)
+
+    def _apply_progress_update(self, task_id: str, updates: Dict[str, Any], increment_field: str = '',
+                               amount: int = 0) -> Optional[int]:
+        """Applies a partial update in a single round trip, see _UPDATE_PROGRESS."""
+        fields = [item for field, value in updates.items() for item in (field, str(value))]
+        return self._update_progress(keys=[self._get_key(task_id), self._get_events_channel(task_id)],
+                                     args=[self._expire_seconds(), increment_field, amount, *fields])
 
     def _set_task_progress_in_redis(self, task_id: str, progress_data: Dict[str, Any]):
         """Serializes progress data to strings and stores it in a Redis hash."""
         key = self._get_key(task_id)
-        # Convert all values to strings for Redis hmset
+        # Convert all values to strings for the Redis hash
         redis_data = {k: str(v) for k, v in progress_data.items()}
 
-        # Use a pipeline for atomicity of hmset and expire
+        # Use a pipeline for atomicity of hset and expire
+        pipe = self.redis.pipeline()
+        pipe.hset(key, mapping=redis_data)
+        if self.expire_hours > 0:
+            pipe.expire(key, self._expire_seconds())
+        pipe.execute()
+
+    def _expire_seconds(self) -> int:
+        """Lifetime of a task's keys, 0 if they never expire."""
+        return int(timedelta(hours=self.expire_hours).total_seconds()) if self.expire_hours > 0 else 0
+
+    def add_task_file(self, task_id: str, file_name: str):
+        """Records a file a task finished downloading, relative to its download directory."""
+        key = self._get_files_key(task_id)
         pipe = self.redis.pipeline()
-        pipe.hmset(key, redis_data)
+        pipe.rpush(key, file_name)
         if self.expire_hours > 0:
-            pipe.expire(key, int(timedelta(hours=self.expire_hours).total_seconds()))
+            pipe.expire(key, self._expire_seconds())
         pipe.execute()
 
+    def get_task_progress_and_files(self, task_id: str,
+                                    start: int = 0) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+        """
+        Returns the progress of a task (None if not found) and the files it finished downloading, in
+        order, skipping the first start ones; both read in one transaction, so the files belong to
+        the run the progress names.
+        """
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self._get_key(task_id))
+        pipe.lrange(self._get_files_key(task_id), start, -1)
+        raw_data, file_names = pipe.execute()
+        return self._build_progress(raw_data), file_names
+
+    def clear_task_files(self, task_id: str):
+        """Forgets the files recorded for a task."""
+        self.redis.delete(self._get_files_key(task_id))
+
+    def start_task_run(self, task_id: str) -> Optional[int]:
+        """
+        Starts a run of a task, e.g. again after its worker died: forgets the files recorded by earlier
+        runs and increments the run counter in one transaction, so that a zip being streamed can tell
+        its files apart from those of the new run.
+
+        Returns:
+            Number of the run, None if the task was not found or expired
+        """
+        pipe = self.redis.pipeline()
+        pipe.delete(self._get_files_key(task_id))
+        self._update_progress(keys=[self._get_key(task_id), self._get_events_channel(task_id)],
+                              args=[self._expire_seconds(), FIELD_RUN, 1], client=pipe)
+        return pipe.execute()[1]
+
+    def attach_or_claim_task(self, content_key: str, task_id: str, requester_id: str) -> str:
+        """
+        Single-flight lookup of the task downloading some content.
+
+        Args:
+            content_key: Identifies the content, e.g. its type, ID and sound format
+            task_id: New task to download the content with if no usable task does already
+            requester_id: Identifies the request, which releases the task with it (see release_task)
+
+        Returns:
+            ID of the task the requester should follow: an existing one, which the requester was
+            added to, or task_id, now registered for content_key with the requester as its only one
+        """
+        ttl = self._expire_seconds() or 24 * 3600
+        return self._attach_or_claim(keys=[self._get_inflight_key(content_key)],
+                                     args=[task_id, ttl, self.namespace, FIELD_ERROR, FIELD_FINISHED, requester_id])
+
+    def abandon_claimed_task(self, content_key: str, task_id: str, requester_id: str, error: str) -> bool:
+        """
+        Gives up a task claimed with attach_or_claim_task that could not be started, e.g. because the
+        queue is full, in one step with respect to requests attaching to it.
+
+        Returns:
+            True if the task was removed, False if other requests had attached to it, which then
+            find it failed with error
+        """
+        keys = [self._get_inflight_key(content_key), self._get_key(task_id), self._get_events_channel(task_id),
+                self._get_refs_key(task_id), self._get_files_key(task_id)]
+        return self._abandon_claim(keys=keys, args=[task_id, FIELD_STARTING, FIELD_FINISHED, FIELD_ERROR, error,
+                                                    requester_id]) == 1
+
+    def release_task(self, task_id: str, requester_id: str) -> bool:
+        """
+        Drops a requester of a task, once it has downloaded its files. Releasing a requester again,
+        e.g. after downloading the files twice, does nothing.
+
+        Returns:
+            True if that was the last requester, after which the task can no longer be attached to
+            and its data should be removed
+        """
+        pipe = self.redis.pipeline()
+        pipe.srem(self._get_refs_key(task_id), requester_id)
+        pipe.scard(self._get_refs_key(task_id))
+        removed, remaining = pipe.execute()
+        return bool(removed) and remaining == 0
+
     def remove_task(self, task_id: str) -> bool:
         """Removes a task and its progress data from Redis."""
         key = self._get_key(task_id)
+        self.clear_task_files(task_id)
+        self.redis.delete(self._get_refs_key(task_id))
         deleted_count = self.redis.delete(key)
         return deleted_count > 0
 
@@ -7,6 +7,8 @@ document.addEventListener('DOMContentLoaded', (event) => {
 
 let currentInterval = null;
 let currentTaskId = null;
+// Given by /download, releases the task once this page has downloaded its zip
+let currentRequesterId = null;
 
 function startDownload() {
   const url = document.getElementById('url').value;
@@ -31,12 +33,19 @@ function startDownload() {
     return;
   }
 
+  progressDiv.textContent = 'Downloading...';
   progressDiv.style.display = 'block';
 
   const formData = new FormData();
   formData.append('url', url);
   formData.append('arl_cookie', arlCookie);
 
+  if (/deezer\.com\/(?:\w+\/)?track\/\d+/.test(url)) {
+    // Single tracks are passed straight through, without a task or a zip
+    streamTrack(formData);
+    return;
+  }
+
   fetch('/download', {
     method: 'POST',
     body: formData
@@ -47,7 +56,8 @@ function startDownload() {
       showSnackbar(`Error: ${data.error}`);
       progressDiv.style.display = 'none';
     } else if (data.success && data.task_id) {
-      pollProgress(data.task_id);
+      currentRequesterId = data.requester_id;
+      followProgress(data.task_id);
     } else {
       showSnackbar('An unknown error occurred.');
       progressDiv.style.display = 'none';
@@ -59,45 +69,81 @@ function startDownload() {
   });
 }
 
+function streamTrack(formData) {
+  const progressDiv = document.querySelector('.progress');
+
+  // Submitted as a form, so that the browser saves the track to disk as it arrives instead of
+  // holding all of it in memory. The track itself is saved as a download; only an error response
+  // is loaded into the hidden frame.
+  let frame = document.getElementById('stream-track-frame');
+  if (!frame) {
+    frame = document.createElement('iframe');
+    frame.id = frame.name = 'stream-track-frame';
+    frame.style.display = 'none';
+    document.body.appendChild(frame);
+  }
+  frame.onload = () => {
+    let message = 'The track could not be downloaded.';
+    try {
+      message = JSON.parse(frame.contentDocument.body.textContent).error || message;
+    } catch (error) {
+      // Not a JSON error, keep the generic message
+    }
+    showSnackbar(`Error: ${message}`);
+  };
+
+  const form = document.createElement('form');
+  form.method = 'POST';
+  form.action = '/stream_track';
+  form.target = frame.name;
+  for (const [name, value] of formData.entries()) {
+    const input = document.createElement('input');
+    input.type = 'hidden';
+    input.name = name;
+    input.value = value;
+    form.appendChild(input);
+  }
+  document.body.appendChild(form);
+  form.submit();
+  form.remove();
+
+  // The browser shows the progress of the download from here
+  progressDiv.style.display = 'none';
+  showSnackbar('Download started.');
+}
+
+function followProgress(taskId) {
+  if (!window.EventSource) {
+    pollProgress(taskId);
+    return;
+  }
+
+  // The server pushes the whole progress first, then only the fields that changed
+  const progress = {};
+  const source = new EventSource(`/progress/stream/${taskId}`);
+  const stop = () => source.close();
+
+  source.onmessage = event => {
+    Object.assign(progress, JSON.parse(event.data));
+    showProgress(taskId, progress, stop);
+  };
+  source.onerror = () => {
+    // EventSource reconnects by itself after a dropped connection, but gives up if the stream
+    // cannot be opened at all (e.g. a proxy that does not allow it, or a 503 from a server with too
+    // many streams open), so poll instead
+    if (source.readyState === EventSource.CLOSED) {
+      pollProgress(taskId);
+    }
+  };
+}
+
 function pollProgress(taskId) {
   const progressDiv = document.querySelector('.progress');
-  const finishedDiv = document.querySelector('.finished');
-  const downloadReadyDiv = document.querySelector('.download-ready');
-  const downloadButton = document.querySelector('.download-button');
 
   const interval = setInterval(() => {
     fetch(`/progress?task_id=${taskId}`)
       .then(response => response.json())
-      .then(data => {
-        if (data.error && data.finished) {
-          showSnackbar(data.error);
-          progressDiv.style.display = 'none';
-          clearInterval(interval);
-          return;
-        }
-
-        if (data.finished) {
-          progressDiv.style.display = 'none';
-          clearInterval(interval);
-
-          if (data.zip_ready) {
-            // Zip is ready, show download button
-            finishedDiv.style.display = 'none';
-            downloadReadyDiv.style.display = 'block';
-            downloadButton.onclick = () => {
-              window.open(`/download_zip/${taskId}`, '_blank');
-            };
-          } else if (data.error) {
-            // Handle case where it finished with an error but no zip
-            showSnackbar(`Error: ${data.error}`);
-          } else {
-            // Finished successfully but no zip (should not happen with new flow)
-            finishedDiv.style.display = 'block';
-          }
-        } else if (!data.starting) {
-          progressDiv.textContent = `Downloading... ${data.current} / ${data.total}`;
-        }
-      })
+      .then(data => showProgress(taskId, data, () => clearInterval(interval)))
       .catch(error => {
         showSnackbar(`Polling failed: ${error}`);
         progressDiv.style.display = 'none';
@@ -106,6 +152,75 @@ function pollProgress(taskId) {
   }, 2000);
 }
 
+function showProgress(taskId, data, stop) {
+  const progressDiv = document.querySelector('.progress');
+  const finishedDiv = document.querySelector('.finished');
+  const downloadReadyDiv = document.querySelector('.download-ready');
+
+  if (data.error && data.finished) {
+    showSnackbar(data.error);
+    progressDiv.style.display = 'none';
+    downloadReadyDiv.style.display = 'none';
+    stop();
+    return;
+  }
+
+  if (data.finished) {
+    progressDiv.style.display = 'none';
+    stop();
+
+    if (data.zip_ready) {
+      // Zip is ready, show download button
+      finishedDiv.style.display = 'none';
+      showDownloadButton(taskId, stop);
+    } else if (data.error) {
+      // Handle case where it finished with an error but no zip
+      showSnackbar(`Error: ${data.error}`);
+    } else {
+      // Finished successfully but no zip (should not happen with new flow)
+      finishedDiv.style.display = 'block';
+    }
+  } else if (data.queue_position) {
+    progressDiv.textContent = `Queued... position ${data.queue_position}`;
+  } else if (!data.starting) {
+    const failed = data.failed ? `, ${data.failed} failed` : '';
+    progressDiv.textContent = `Downloading... ${data.current} / ${data.total}${failed}${formatTransfer(data)}`;
+    // The zip streams tracks as they finish, so it can be downloaded before the task is done
+    showDownloadButton(taskId, stop);
+  }
+}
+
+function formatTransfer(data) {
+  if (!data.bytes_total) {
+    return '';
+  }
+  const megabytes = bytes => (bytes / (1024 * 1024)).toFixed(1);
+  let text = ` (${megabytes(data.bytes_done)} of ${megabytes(data.bytes_total)} MB`;
+  if (data.rate) {
+    text += `, ${megabytes(data.rate)} MB/s`;
+  }
+  if (data.eta !== null && data.eta !== undefined) {
+    const seconds = String(data.eta % 60).padStart(2, '0');
+    text += `, ${Math.floor(data.eta / 60)}:${seconds} left`;
+  }
+  return `${text})`;
+}
+
+function showDownloadButton(taskId, stop) {
+  const progressDiv = document.querySelector('.progress');
+  const downloadReadyDiv = document.querySelector('.download-ready');
+  const downloadButton = document.querySelector('.download-button');
+
+  downloadReadyDiv.style.display = 'block';
+  downloadButton.onclick = () => {
+    // The task is removed once its zip has been downloaded, so stop following it
+    stop();
+    progressDiv.style.display = 'none';
+    downloadReadyDiv.style.display = 'none';
+    window.open(`/download_zip/${taskId}?requester=${encodeURIComponent(currentRequesterId)}`, '_blank');
+  };
+}
+
 function showSnackbar(message) {
   const snackbar = document.getElementById('snackbar');
   snackbar.textContent = message;
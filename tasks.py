@@ -0,0 +1,202 @@
+# tasks.py
+
+# Execution of download tasks and the state shared by the processes running them. Imported by the
+# web app (app.py), which queues tasks, and by download workers (worker.py), which run them.
+
+import os
+import shutil
+import tempfile
+from deezer_downloader.client import DeezerClient
+from deezer_downloader.config import DeezerConfig
+from deezer_downloader.exceptions import DeezerException
+from deezer_downloader.metadata_cache import MetadataCache
+from deezer_downloader.track_store import TrackStore
+from deezer_downloader.session_pool import SessionPool
+from deezer_downloader.rate_limiter import RateLimiter
+from redis_manager import RedisManager
+from job_queue import JobQueue
+from progress_tracker import FIELD_FINISHED, FIELD_ERROR, FIELD_ZIP_READY
+from logging_config import logger
+
+# --- Environment Configuration ---
+ENV = os.environ.get('FLASK_ENV', 'development').lower()
+
+# Worker processes apart from the web app (worker.py) write the tracks the web app zips, so both must be
+# given this directory (e.g. a network volume); without it, downloads run inside the web process
+SHARED_DATA_DIR = bool(os.environ.get('DATA_DIR'))
+
+if SHARED_DATA_DIR:
+    BASE_TEMP_DIR = os.environ['DATA_DIR']
+elif ENV == 'development':
+    # In development, use a local directory (e.g., 'project_root/dl')
+    BASE_TEMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dl')
+else:
+    # In production (or default), use the system's temporary directory
+    BASE_TEMP_DIR = os.path.join(tempfile.gettempdir(), 'deezer_dl_redis')
+
+DOWNLOADS_DIR = os.path.join(BASE_TEMP_DIR, 'downloads')
+TRACK_STORE_DIR = os.path.join(BASE_TEMP_DIR, 'tracks')
+# Disk budget of the decrypted track store shared by all tasks (0 disables it)
+TRACK_STORE_MAX_BYTES = int(os.environ.get('TRACK_STORE_MAX_BYTES', str(2 * 1024 ** 3)))
+
+# Processes used to decrypt tracks outside the request threads (0 decrypts in-line)
+DECRYPT_PROCESSES = int(os.environ.get('DECRYPT_PROCESSES', '0'))
+# Tracks of an album or playlist downloaded in parallel by each task
+TRACK_WORKERS = int(os.environ.get('TRACK_WORKERS', '4'))
+# Parallel connections a single-track task downloads its track over (1 disables segmenting);
+# albums and playlists already spread their connections over several tracks
+TRACK_SEGMENTS = int(os.environ.get('TRACK_SEGMENTS', '1'))
+# Download tasks run at the same time by each worker process
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '4'))
+# Tasks allowed to wait for a worker, across all workers
+MAX_QUEUED_TASKS = int(os.environ.get('MAX_QUEUED_TASKS', '20'))
+
+# Ensure directories exist
+os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+
+# --- Shared State ---
+redis_manager = RedisManager(redis_url=os.environ.get('REDIS_URL'))
+# Download tasks waiting for, or being run by, a worker
+download_queue = JobQueue(redis_manager, MAX_QUEUED_TASKS)
+# Track, album and playlist metadata shared by every task of this process and, through Redis, of all workers
+metadata_cache = MetadataCache(redis_manager)
+track_store = TrackStore(TRACK_STORE_DIR, TRACK_STORE_MAX_BYTES) if TRACK_STORE_MAX_BYTES > 0 else None
+# Request rates to Deezer endpoints, shared by all workers through Redis
+rate_limiter = RateLimiter(redis_manager)
+# Warmed Deezer sessions reused by all tasks of the same account
+session_pool = SessionPool(rate_limiter=rate_limiter)
+
+
+# --- Background Download Logic ---
+
+def execute_download(arl_cookie, content_type_val, content_id_val, task_id):
+    """
+    Runs a download task, uses Redis for progress.
+
+    Every finished track is recorded in Redis, so /download_zip can stream it to the client while the
+    rest of the task is still downloading. Tracks are left in the task's download directory until the
+    zip has been downloaded; it is removed right away if the task fails.
+    """
+    logger.info(f"Starting background download for task {task_id}: {content_type_val}/{content_id_val}")
+
+    task_specific_download_dir = os.path.join(DOWNLOADS_DIR, task_id)
+    try:
+        # Before removing the files of an earlier run, so zips streaming them stop rather than skip tracks
+        redis_manager.start_task_run(task_id)
+        if os.path.exists(task_specific_download_dir):
+            # Left over by a worker that died while running this task
+            shutil.rmtree(task_specific_download_dir)
+        os.makedirs(task_specific_download_dir, exist_ok=True)
+    except Exception as e:
+        logger.error(f"Failed to create download directory {task_specific_download_dir} for task {task_id}: {e}")
+        redis_manager.update_task_progress(task_id,
+                                           **{FIELD_ERROR: 'Failed to create download directory.', FIELD_FINISHED: True})
+        return
+
+    def record_track(path):
+        redis_manager.add_task_file(task_id, os.path.relpath(path, task_specific_download_dir))
+
+    config = DeezerConfig(cookie_arl=arl_cookie, download_folder=task_specific_download_dir,
+                          max_workers=TRACK_WORKERS, decrypt_processes=DECRYPT_PROCESSES,
+                          download_segments=TRACK_SEGMENTS if content_type_val == 'track' else 1)
+    client = DeezerClient(config=config, redis_manager=redis_manager, task_id=task_id,
+                          metadata_cache=metadata_cache, track_store=track_store, session_pool=session_pool,
+                          on_track_downloaded=record_track)
+
+    download_actions = {
+        'track': client.download_track,
+        'album': client.download_album,
+        'playlist': client.download_playlist,
+    }
+    action = download_actions.get(content_type_val)
+
+    succeeded = False
+    try:
+        if not action:
+            err_msg = f'Unsupported content type in thread: {content_type_val}'
+            logger.error(err_msg)
+            redis_manager.update_task_progress(task_id, **{FIELD_ERROR: err_msg, FIELD_FINISHED: True})
+            return
+
+        client.initialize()
+        downloaded_file_paths = action(content_id_val)
+
+        if not downloaded_file_paths:
+            logger.info(
+                f"Task {task_id}: No files were downloaded by the client (e.g., empty playlist or all tracks failed).")
+            redis_manager.update_task_progress(task_id,
+                                               **{FIELD_ERROR: 'No files were downloaded.', FIELD_FINISHED: True})
+            return
+
+        logger.info(f"Task {task_id}: Download client finished. {len(downloaded_file_paths)} items processed.")
+
+        redis_manager.update_task_progress(task_id, **{FIELD_ZIP_READY: True, FIELD_FINISHED: True})
+        logger.info(f"Task {task_id}: Progress updated - zip ready and finished.")
+        succeeded = True
+
+    except DeezerException as e:
+        logger.error(f"DeezerException in background task {task_id}: {str(e)}")
+        redis_manager.update_task_progress(task_id, **{FIELD_ERROR: str(e), FIELD_FINISHED: True})
+    except Exception as e:
+        logger.error(f"Unexpected exception in background task {task_id}: {str(e)}", exc_info=True)
+        redis_manager.update_task_progress(task_id,
+                                           **{FIELD_ERROR: 'An unexpected server error occurred during processing.',
+                                              FIELD_FINISHED: True})
+    finally:
+        if not succeeded and os.path.exists(task_specific_download_dir):
+            try:
+                shutil.rmtree(task_specific_download_dir)
+                logger.info(f"Task {task_id}: Cleaned up source directory {task_specific_download_dir}")
+            except Exception as e:
+                logger.error(
+                    f"Task {task_id}: Error cleaning up source directory {task_specific_download_dir}: {e}")
+
+
+def resolve_sound_format(arl_cookie):
+    """
+    Sound format the downloads of an account get, from its pooled session: a Deezer call only if the
+    session was not initialized in the last session_max_age seconds.
+
+    Raises:
+        Deezer403Exception: If the ARL cookie is not logged in to an account
+        DeezerException: If the account could not be looked up
+    """
+    config = DeezerConfig(cookie_arl=arl_cookie)
+    session = session_pool.get(config)
+    session.ensure_initialized(config.session_max_age)
+    return session.sound_format
+
+
+def download_content_key(content_type, content_id, sound_format):
+    """Key under which identical downloads share one task: the content and the sound format it is downloaded in."""
+    return f"{content_type}/{content_id}/{sound_format}"
+
+
+def open_track_stream(arl_cookie, track_id):
+    """
+    Starts passing a single track through to the caller, decrypted on the fly: no task, no file on disk.
+
+    Returns:
+        Tuple of the track's file name, its size in bytes if known, and an iterator over its content
+
+    Raises:
+        DeezerException: If the track cannot be found or its download cannot be started
+    """
+    config = DeezerConfig(cookie_arl=arl_cookie, download_folder=DOWNLOADS_DIR)
+    client = DeezerClient(config=config, redis_manager=redis_manager, task_id=None,
+                          metadata_cache=metadata_cache, session_pool=session_pool)
+    client.initialize()
+    return client.stream_track(track_id)
+
+
+def run_download_job(task_id, payload):
+    """Job handler of download_queue: payload holds the arguments of execute_download."""
+    execute_download(payload['arl_cookie'], payload['content_type'], payload['content_id'], task_id)
+
+
+def fail_abandoned_downloads(task_ids):
+    """Marks tasks the queue gave up re-delivering as failed."""
+    for task_id in task_ids:
+        logger.error(f"Task {task_id}: giving up after its workers stopped {download_queue.MAX_DELIVERIES} times")
+        redis_manager.update_task_progress(task_id, **{FIELD_ERROR: 'The download was interrupted repeatedly.',
+                                                       FIELD_FINISHED: True})
@@ -0,0 +1,177 @@
+# conftest.py
+
+# Shared fixtures: a local fake CDN serving encrypted tracks, Redis backed by fakeredis and
+# DeezerClient instances wired to both. Run the tests from the repository root with `python -m pytest`.
+
+import atexit
+import os
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set
+
+import pytest
+
+# The app modules (redis_manager, progress_tracker, ...) are imported from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deezer_downloader.client import DeezerClient  # noqa: E402
+from deezer_downloader.config import DeezerConfig  # noqa: E402
+
+
+class FakeCdn:
+    """
+    HTTP server standing in for the audio CDN: serves payloads by path, honours Range requests
+    and can cut a response short to simulate an interrupted transfer
+    """
+
+    def __init__(self):
+        self.files: Dict[str, bytes] = {}
+        # Per path, bytes of body to send before closing the connection, one entry per response
+        self.cuts: Dict[str, List[int]] = {}
+        # Path and headers of every request received
+        self.requests: List[tuple] = []
+        # Client address of every request received: one per TCP connection used
+        self.clients: Set[tuple] = set()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def add(self, path: str, payload: bytes, cuts: Optional[List[int]] = None):
+        self.files[path] = payload
+        self.cuts[path] = list(cuts or [])
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/{path}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        cdn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.lstrip('/')
+                with cdn._lock:
+                    cdn.requests.append((path, dict(self.headers)))
+                    cdn.clients.add(self.client_address)
+                    cut = cdn.cuts[path].pop(0) if cdn.cuts.get(path) else None
+                payload = cdn.files.get(path)
+                if payload is None:
+                    self.send_error(404)
+                    return
+
+                start, end = 0, len(payload) - 1
+                range_header = self.headers.get('Range')
+                if range_header:
+                    first, _, last = range_header[len('bytes='):].partition('-')
+                    start, end = int(first), int(last) if last else len(payload) - 1
+                    self.send_response(206)
+                    self.send_header('Content-Range', f"bytes {start}-{end}/{len(payload)}")
+                else:
+                    self.send_response(200)
+                body = payload[start:end + 1]
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+
+                if cut is None:
+                    self.wfile.write(body)
+                    return
+                self.wfile.write(body[:cut])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+
+        return Handler
+
+
+class FakeUrlResolver:
+    """TrackUrlResolver resolving every track to its payload on the fake CDN"""
+
+    def __init__(self, cdn: FakeCdn, sound_format: str = 'MP3_128'):
+        self.cdn = cdn
+        self.sound_format = sound_format
+
+    def prefetch(self, tracks):
+        pass
+
+    def resolve(self, track_info):
+        return self.cdn.url(str(track_info['SNG_ID'])), self.sound_format
+
+    def invalidate(self, track_id):
+        pass
+
+
+@pytest.fixture
+def fake_cdn():
+    cdn = FakeCdn()
+    yield cdn
+    cdn.close()
+
+
+@pytest.fixture
+def redis_manager(monkeypatch):
+    """RedisManager over an in-memory fakeredis server, with Lua scripting"""
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    import redis
+    from redis_manager import RedisManager
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url',
+                        classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server,
+                                                                                    decode_responses=True)))
+    return RedisManager('redis://fake')
+
+
+@pytest.fixture
+def make_client(tmp_path, fake_cdn, redis_manager):
+    """
+    Factory of DeezerClient instances downloading from the fake CDN, by default into tmp_path for
+    a new task
+    """
+    def make(task_id: Optional[str] = None, download_folder: Optional[str] = None, on_track_downloaded=None,
+             **config_fields) -> DeezerClient:
+        config_fields.setdefault('retry_backoff', 0)
+        config = DeezerConfig(cookie_arl='arl', download_folder=download_folder or str(tmp_path), **config_fields)
+        client = DeezerClient(config=config, redis_manager=redis_manager,
+                              task_id=task_id or redis_manager.create_task(),
+                              on_track_downloaded=on_track_downloaded)
+        client.url_resolver = FakeUrlResolver(fake_cdn)
+        return client
+
+    return make
+
+
+@pytest.fixture
+def web_app(tmp_path, monkeypatch, redis_manager):
+    """The app module, its TaskManager using redis_manager and tmp_path as data directory"""
+    # Only read by the first test importing app, which must not touch the repository's dl/ directory
+    monkeypatch.setenv('DATA_DIR', str(tmp_path))
+    import app
+    from job_queue import JobQueue
+    from progress_hub import ProgressHub
+
+    if app.task_manager._cleanup_thread.is_alive():
+        # Its scans are not needed here, and at exit it would log to streams pytest has closed
+        app.task_manager.stop_cleanup_thread()
+        atexit.unregister(app.task_manager.stop_cleanup_thread)
+
+    downloads_dir = tmp_path / 'downloads'
+    downloads_dir.mkdir(exist_ok=True)
+    monkeypatch.setattr(app, 'DOWNLOADS_DIR', str(downloads_dir))
+    monkeypatch.setattr(app.task_manager, 'redis_manager', redis_manager)
+    monkeypatch.setattr(app.task_manager, 'job_queue', JobQueue(redis_manager, 20))
+    monkeypatch.setattr(app.task_manager, 'progress_hub', ProgressHub(redis_manager, 2))
+    monkeypatch.setattr(app.task_manager, 'stream_poll_seconds', 0.01)
+    return app
@@ -0,0 +1,274 @@
+import io
+import json
+import os
+import threading
+import zipfile
+
+import pytest
+
+from deezer_downloader.crypto import DeezerCrypto
+from deezer_downloader.exceptions import Deezer403Exception
+from job_queue import JobQueue, QueueFullError
+from progress_tracker import FIELD_ERROR, FIELD_FINISHED, FIELD_QUEUE_POSITION, FIELD_ZIP_READY
+from test_client import album_tracks, plaintext_of
+
+
+class FakeSession:
+    """Pooled session of an account, with the sound format the account gets"""
+
+    def __init__(self, arl_cookie: str):
+        self.arl_cookie = arl_cookie
+        self.sound_format = 'FLAC' if arl_cookie.startswith('hifi') else 'MP3_128'
+
+    def ensure_initialized(self, max_age):
+        if self.arl_cookie == 'loggedout':
+            raise Deezer403Exception("Not logged in to Deezer, check the ARL cookie")
+
+
+@pytest.fixture
+def accounts(monkeypatch):
+    """Deezer accounts looked up by the web requests, without calling Deezer"""
+    import tasks
+    looked_up = []
+
+    def get(config):
+        looked_up.append(config.cookie_arl)
+        return FakeSession(config.cookie_arl)
+    monkeypatch.setattr(tasks.session_pool, 'get', get)
+    return looked_up
+
+
+def test_zip_streamed_while_downloading_holds_every_track_sharing_a_title(web_app, fake_cdn, make_client,
+                                                                         redis_manager):
+    tracks = album_tracks(['Interlude'] * 4 + ['Outro'])
+    payloads = [os.urandom(DeezerCrypto.STRIPE_SIZE * 30 + index) for index in range(len(tracks))]
+    for track, payload in zip(tracks, payloads):
+        fake_cdn.add(track['SNG_ID'], payload)
+
+    task_id = redis_manager.create_task()
+    redis_manager.attach_or_claim_task('album/7/MP3_128', task_id, 'requester')
+    task_dir = os.path.join(web_app.DOWNLOADS_DIR, task_id)
+    client = make_client(task_id=task_id, download_folder=task_dir, max_workers=5,
+                         on_track_downloaded=lambda path: redis_manager.add_task_file(task_id, os.path.basename(path)))
+
+    def run_task():
+        client._download_tracks([tracks], len(tracks))
+        redis_manager.update_task_progress(task_id, **{FIELD_ZIP_READY: True, FIELD_FINISHED: True})
+
+    # The zip is requested before the task has downloaded anything
+    os.makedirs(task_dir)
+    task = threading.Thread(target=run_task)
+    task.start()
+    response = web_app.app.test_client().get(f'/download_zip/{task_id}?requester=requester')
+    task.join()
+
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.testzip() is None
+    assert len(archive.namelist()) == len(tracks)
+    contents = sorted(archive.read(name) for name in archive.namelist())
+    assert contents == sorted(plaintext_of(payload, track['SNG_ID']) for track, payload in zip(tracks, payloads))
+    # Removed once the only requester downloaded the zip
+    assert not os.path.exists(task_dir)
+
+
+def test_identical_requests_share_a_task_when_their_accounts_get_the_same_sound_format(web_app, accounts):
+    task_id, position, requester_id = web_app.task_manager.enqueue_download('arl-1', 'album', '7')
+    shared_task_id, shared_position, other_requester_id = web_app.task_manager.enqueue_download('arl-2', 'album', '7')
+
+    assert (shared_task_id, shared_position) == (task_id, position) == (task_id, 1)
+    assert other_requester_id != requester_id
+    # An account getting another sound format has the content downloaded for it
+    assert web_app.task_manager.enqueue_download('hifi-1', 'album', '7')[:2] != (task_id, 1)
+    assert web_app.task_manager.enqueue_download('arl-1', 'album', '8')[1] == 3
+    assert accounts == ['arl-1', 'arl-2', 'hifi-1', 'arl-1']
+
+
+def test_request_with_an_arl_cookie_that_is_not_logged_in_is_rejected(web_app, redis_manager, accounts):
+    web_app.task_manager.enqueue_download('arl', 'album', '7')
+    keys = redis_manager.redis.keys('*')
+
+    response = web_app.app.test_client().post('/download', data={'url': 'https://www.deezer.com/album/7',
+                                                                   'arl_cookie': 'loggedout'})
+
+    assert response.status_code == 401
+    # It neither created a task nor attached to the one downloading the album
+    assert redis_manager.redis.keys('*') == keys
+
+
+def test_task_data_is_kept_until_every_requester_released_it(web_app, redis_manager, accounts):
+    task_id, _, requester_id = web_app.task_manager.enqueue_download('arl-1', 'album', '7')
+    other_requester_id = web_app.task_manager.enqueue_download('arl-2', 'album', '7')[2]
+    task_dir = os.path.join(web_app.DOWNLOADS_DIR, task_id)
+    os.makedirs(task_dir)
+
+    # A requester downloading its zip twice releases the task once
+    web_app.task_manager.release_task_data(task_id, requester_id)
+    web_app.task_manager.release_task_data(task_id, requester_id)
+    assert os.path.exists(task_dir) and redis_manager.get_task_progress(task_id)
+
+    web_app.task_manager.release_task_data(task_id, other_requester_id)
+    assert not os.path.exists(task_dir) and not redis_manager.get_task_progress(task_id)
+
+
+def test_request_attaching_while_the_queue_rejects_the_task_sees_it_fail(web_app, redis_manager, accounts,
+                                                                         monkeypatch):
+    from tasks import download_content_key
+    task_manager = web_app.task_manager
+    attached = []
+
+    def enqueue_after_another_request_attached(job_id, payload):
+        attached.append(redis_manager.attach_or_claim_task(download_content_key('album', '7', 'MP3_128'),
+                                                           redis_manager.create_task(), 'other-requester'))
+        raise QueueFullError("0 jobs already queued")
+    monkeypatch.setattr(task_manager.job_queue, 'enqueue', enqueue_after_another_request_attached)
+
+    with pytest.raises(QueueFullError):
+        task_manager.enqueue_download('arl', 'album', '7')
+
+    progress = task_manager.get_task_progress(attached[0])
+    assert progress[FIELD_FINISHED] and progress[FIELD_ERROR] == web_app.QUEUE_FULL_MESSAGE
+    # Later requests no longer attach to it
+    monkeypatch.setattr(task_manager, 'job_queue', JobQueue(redis_manager, 20))
+    assert task_manager.enqueue_download('arl', 'album', '7')[0] != attached[0]
+
+
+def test_task_rejected_by_a_full_queue_is_removed(web_app, redis_manager, accounts, monkeypatch):
+    monkeypatch.setattr(web_app.task_manager, 'job_queue', JobQueue(redis_manager, 0))
+
+    with pytest.raises(QueueFullError):
+        web_app.task_manager.enqueue_download('arl', 'album', '7')
+
+    # Neither its progress nor its claim on the content is left behind
+    assert redis_manager.redis.keys('*') == []
+
+
+def test_zip_stream_stops_when_the_task_is_run_again_after_files_were_sent(web_app, redis_manager):
+    task_id = redis_manager.create_task()
+    redis_manager.start_task_run(task_id)
+    redis_manager.add_task_file(task_id, 'one.mp3')
+    files = web_app.task_manager.iter_task_files(task_id)
+    assert os.path.basename(next(files)) == 'one.mp3'
+
+    # Re-delivered after its worker died: the new run downloads the tracks again, in another order
+    redis_manager.start_task_run(task_id)
+    redis_manager.add_task_file(task_id, 'two.mp3')
+    redis_manager.add_task_file(task_id, 'one.mp3')
+    with pytest.raises(RuntimeError, match='run again'):
+        next(files)
+
+
+def test_zip_stream_started_before_a_new_run_sends_the_files_of_that_run(web_app, redis_manager):
+    task_id = redis_manager.create_task()
+    redis_manager.start_task_run(task_id)
+    received = []
+    stream = threading.Thread(target=lambda: received.extend(web_app.task_manager.iter_task_files(task_id)))
+    stream.start()
+
+    redis_manager.start_task_run(task_id)
+    for name in ('one.mp3', 'two.mp3'):
+        redis_manager.add_task_file(task_id, name)
+    redis_manager.update_task_progress(task_id, **{FIELD_ZIP_READY: True, FIELD_FINISHED: True})
+    stream.join(5)
+
+    assert [os.path.basename(path) for path in received] == ['one.mp3', 'two.mp3']
+
+
+def test_progress_stream_sends_the_whole_progress_then_its_changes_until_finished(web_app, redis_manager):
+    task_id = redis_manager.create_task()
+    client = web_app.app.test_client()
+    response = client.get(f'/progress/stream/{task_id}')
+    events = response.iter_encoded()
+
+    assert json.loads(next(events)[len(b'data: '):])[FIELD_FINISHED] is False
+    redis_manager.update_task_progress(task_id, **{FIELD_ZIP_READY: True, FIELD_FINISHED: True})
+    assert json.loads(next(events)[len(b'data: '):]) == {FIELD_ZIP_READY: True, FIELD_FINISHED: True}
+    assert list(events) == []
+    response.close()
+    assert len(web_app.task_manager.progress_hub) == 0
+
+
+def test_progress_stream_past_the_limit_is_refused_so_the_page_polls(web_app, redis_manager):
+    task_id = redis_manager.create_task()
+    client = web_app.app.test_client()
+    streams = [client.get(f'/progress/stream/{task_id}') for _ in range(web_app.task_manager.progress_hub.max_streams)]
+
+    assert client.get(f'/progress/stream/{task_id}').status_code == 503
+    streams[0].close()
+    assert client.get(f'/progress/stream/{task_id}').status_code == 200
+
+
+def test_tracks_streamed_past_the_limit_are_refused_until_one_is_sent(web_app, monkeypatch):
+    import threading as threads
+    monkeypatch.setattr(web_app, 'track_stream_slots', threads.BoundedSemaphore(1))
+    monkeypatch.setattr(web_app, 'open_track_stream', lambda arl_cookie, track_id: ('Artist - One.mp3', 3,
+                                                                                      iter([b'one'])))
+    client = web_app.app.test_client()
+    form = {'url': 'https://www.deezer.com/track/1', 'arl_cookie': 'arl'}
+
+    streaming = client.post('/stream_track', data=form)
+    refused = client.post('/stream_track', data=form)
+    assert (streaming.status_code, refused.status_code) == (200, 429)
+    assert refused.headers['Retry-After'] == str(web_app.QUEUE_RETRY_AFTER_SECONDS)
+
+    assert streaming.get_data() == b'one'
+    streaming.close()
+    assert client.post('/stream_track', data=form).status_code == 200
+
+
+def test_download_request_is_refused_with_429_while_the_queue_is_full(web_app, redis_manager, accounts, monkeypatch):
+    monkeypatch.setattr(web_app.task_manager, 'job_queue', JobQueue(redis_manager, 1))
+    client = web_app.app.test_client()
+
+    accepted = client.post('/download', data={'url': 'https://www.deezer.com/album/7', 'arl_cookie': 'arl'})
+    refused = client.post('/download', data={'url': 'https://www.deezer.com/album/8', 'arl_cookie': 'arl'})
+
+    assert accepted.status_code == 200 and accepted.get_json()['queue_position'] == 1
+    assert refused.status_code == 429
+    assert refused.get_json() == {'error': web_app.QUEUE_FULL_MESSAGE}
+    assert refused.headers['Retry-After'] == str(web_app.QUEUE_RETRY_AFTER_SECONDS)
+
+
+def test_queue_positions_are_published_as_tasks_ahead_start(web_app, redis_manager, accounts, monkeypatch):
+    monkeypatch.setattr(web_app, 'PROGRESS_KEEPALIVE_SECONDS', 0.01)
+    task_manager = web_app.task_manager
+    first_task_id = task_manager.enqueue_download('arl', 'album', '7')[0]
+    task_id = task_manager.enqueue_download('arl', 'album', '8')[0]
+    subscription, updates = task_manager.follow_task_progress(task_id)
+
+    assert next(updates)[FIELD_QUEUE_POSITION] == 2
+    assert web_app.app.test_client().get(f'/progress?task_id={task_id}').get_json()[FIELD_QUEUE_POSITION] == 2
+    assert task_manager.job_queue.reserve()[0] == first_task_id
+    assert next(updates) == {FIELD_QUEUE_POSITION: 1}
+    assert task_manager.job_queue.reserve()[0] == task_id
+    assert next(updates) == {FIELD_QUEUE_POSITION: None}
+    # Once it left the queue, its position is no longer looked up
+    assert next(updates) is None
+    subscription.close()
+
+
+def test_batch_progress_returns_every_requested_task_and_null_for_unknown_ones(web_app, redis_manager, accounts):
+    task_id, position, _ = web_app.task_manager.enqueue_download('arl', 'album', '7')
+    started_task_id = redis_manager.create_task()
+    redis_manager.update_task_progress(started_task_id, **{FIELD_FINISHED: True, FIELD_ZIP_READY: True})
+    client = web_app.app.test_client()
+
+    response = client.post('/progress/batch', json={'task_ids': [task_id, 'unknown', started_task_id, task_id]})
+
+    assert response.status_code == 200
+    tasks = response.get_json()['tasks']
+    assert sorted(tasks) == sorted([task_id, 'unknown', started_task_id])
+    assert tasks['unknown'] is None
+    assert tasks[task_id][FIELD_QUEUE_POSITION] == position == 1
+    assert tasks[started_task_id][FIELD_ZIP_READY] and tasks[started_task_id][FIELD_QUEUE_POSITION] is None
+
+
+def test_batch_progress_rejects_malformed_and_oversized_requests(web_app, monkeypatch):
+    monkeypatch.setattr(web_app, 'MAX_BATCH_TASKS', 2)
+    client = web_app.app.test_client()
+
+    assert client.post('/progress/batch', json={'task_ids': 'task'}).status_code == 400
+    assert client.post('/progress/batch', json={'task_ids': [1]}).status_code == 400
+    assert client.post('/progress/batch', data='not json').status_code == 400
+    assert client.post('/progress/batch', json={'task_ids': ['a', 'b', 'c']}).status_code == 400
+    assert client.post('/progress/batch', json={'task_ids': []}).get_json() == {'tasks': {}}
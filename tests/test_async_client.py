@@ -0,0 +1,207 @@
+import asyncio
+import json
+import os
+from typing import Any, Dict, List
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from deezer_downloader.async_client import AsyncDeezerClient  # noqa: E402
+from deezer_downloader.config import DeezerConfig  # noqa: E402
+from deezer_downloader.crypto import DeezerCrypto  # noqa: E402
+from progress_tracker import FIELD_CURRENT, FIELD_FAILED, FIELD_FAILED_PAGES  # noqa: E402
+from test_client import album_tracks, plaintext_of  # noqa: E402
+
+
+class FakeDeezer:
+    """
+    aiohttp application standing in for www.deezer.com (gw-light API and album pages),
+    media.deezer.com/v1/get_url and the audio CDN
+    """
+
+    def __init__(self, tracks: List[Dict[str, Any]], payloads: Dict[str, bytes]):
+        self.tracks = tracks
+        self.payloads = payloads
+        # Per track ID, bytes of body to send before closing the connection, one entry per response
+        self.cuts: Dict[str, List[int]] = {}
+        # gw-light methods called, with the api_token they were called with
+        self.gw_calls: List[tuple] = []
+        self.get_url_bodies: List[Dict[str, Any]] = []
+        self.cdn_ranges: List[tuple] = []
+        # The first gw-light call made with this token is answered as if it had expired
+        self.expired_token = 'token-1'
+        # Offsets of the playlist pages answered with an error
+        self.failing_pages: List[int] = []
+        self._tokens_issued = 0
+        self.server = None
+
+        self.app = web.Application()
+        self.app.router.add_route('*', '/ajax/gw-light.php', self.gw_light)
+        self.app.router.add_get('/{market}/album/{album_id}', self.album_page)
+        self.app.router.add_post('/v1/get_url', self.get_url)
+        self.app.router.add_get('/cdn/{track_id}', self.cdn)
+
+    def url(self, path: str = '') -> str:
+        return str(self.server.make_url(path))
+
+    async def gw_light(self, request: web.Request) -> web.Response:
+        method = request.query['method']
+        token = request.query['api_token']
+        self.gw_calls.append((method, token))
+        if method == 'deezer.getUserData':
+            self._tokens_issued += 1
+            return web.json_response({'results': {
+                'checkForm': f"token-{self._tokens_issued}",
+                'USER': {'USER_ID': 1,
+                         'OPTIONS': {'license_token': 'license', 'web_sound_quality': {'lossless': False}}}
+            }})
+
+        if token == self.expired_token:
+            self.expired_token = None
+            return web.json_response({'error': {'VALID_TOKEN_REQUIRED': "Invalid CSRF token"}, 'results': {}})
+        payload = await request.json()
+        assert method == 'deezer.pagePlaylist' and payload['playlist_id'] == 42
+        if payload['start'] in self.failing_pages:
+            return web.json_response({'error': {'QUOTA_ERROR': "Quota limit exceeded"}, 'results': {}})
+        page = self.tracks[payload['start']:payload['start'] + payload['nb']]
+        return web.json_response({'results': {
+            'DATA': {'TITLE': 'Playlist'},
+            'SONGS': {'data': page, 'total': len(self.tracks)}
+        }})
+
+    async def album_page(self, request: web.Request) -> web.Response:
+        state = {'DATA': {'__TYPE__': 'album', 'ALB_TITLE': 'Album'},
+                 'SONGS': {'data': [dict(track, ALB_TITLE='Album', MD5_ORIGIN='md5') for track in self.tracks]}}
+        return web.Response(text=f"<html><script>window.__DZR_APP_STATE__ = {json.dumps(state)}</script></html>",
+                            content_type='text/html')
+
+    async def get_url(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.get_url_bodies.append(body)
+        entries = []
+        for track_token in body['track_tokens']:
+            track_id = track_token[len('token-'):]
+            if track_id not in self.payloads:
+                entries.append({'errors': [{'message': "Track not available"}]})
+                continue
+            entries.append({'media': [{'format': 'MP3_128', 'sources': [{'url': self.url(f"/cdn/{track_id}")}]}]})
+        return web.json_response({'data': entries})
+
+    async def cdn(self, request: web.Request) -> web.StreamResponse:
+        track_id = request.match_info['track_id']
+        payload = self.payloads[track_id]
+        self.cdn_ranges.append((track_id, request.headers.get('Range'), request.headers.get('Accept-Encoding')))
+        start = int(request.headers['Range'][len('bytes='):].rstrip('-')) if 'Range' in request.headers else 0
+        body = payload[start:]
+
+        response = web.StreamResponse(status=206 if start else 200)
+        response.content_length = len(body)
+        if start:
+            response.headers['Content-Range'] = f"bytes {start}-{len(payload) - 1}/{len(payload)}"
+        await response.prepare(request)
+
+        cuts = self.cuts.get(track_id)
+        if cuts:
+            await response.write(body[:cuts.pop(0)])
+            request.transport.close()
+            return response
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+
+def run_against(fake: FakeDeezer, tmp_path, download, **client_args):
+    """Run download(client) with an AsyncDeezerClient talking to the fake Deezer"""
+    async def run():
+        async with TestServer(fake.app) as server:
+            fake.server = server
+            config = DeezerConfig(cookie_arl='arl', download_folder=str(tmp_path), retry_backoff=0, max_workers=3)
+            client = AsyncDeezerClient(config, **client_args)
+            client.session.WWW_URL = fake.url()
+            client.GET_URL_ENDPOINT = fake.url('/v1/get_url')
+            async with client:
+                return await download(client)
+
+    return asyncio.run(run())
+
+
+def make_tracks(count: int):
+    tracks = album_tracks([f"Title {index}" for index in range(count)])
+    for track in tracks:
+        track['TRACK_TOKEN'] = f"token-{track['SNG_ID']}"
+    payloads = {track['SNG_ID']: os.urandom(DeezerCrypto.STRIPE_SIZE * 20 + int(track['SNG_ID']))
+                for track in tracks}
+    return tracks, payloads
+
+
+def assert_downloaded(paths, tracks, payloads):
+    assert [os.path.basename(path) for path in paths] == [f"Artist - {track['SNG_TITLE']}.mp3" for track in tracks]
+    for track, path in zip(tracks, paths):
+        with open(path, 'rb') as track_file:
+            assert track_file.read() == plaintext_of(payloads[track['SNG_ID']], track['SNG_ID'])
+
+
+def test_album_is_resolved_in_one_get_url_request_and_downloaded(tmp_path):
+    tracks, payloads = make_tracks(4)
+    fake = FakeDeezer(tracks, payloads)
+    fake.cuts[tracks[1]['SNG_ID']] = [10_000]
+
+    paths = run_against(fake, tmp_path, lambda client: client.download_album('7'))
+
+    assert_downloaded(paths, tracks, payloads)
+    assert fake.get_url_bodies == [{
+        'license_token': 'license',
+        'media': [{'type': 'FULL', 'formats': [{'cipher': 'BF_CBC_STRIPE', 'format': 'MP3_128'}]}],
+        'track_tokens': [track['TRACK_TOKEN'] for track in tracks]
+    }]
+    # The interrupted track resumed after the whole blocks it had received
+    assert (tracks[1]['SNG_ID'], 'bytes=8192-', 'identity') in fake.cdn_ranges
+    assert all(encoding == 'identity' for _, _, encoding in fake.cdn_ranges)
+
+
+def test_playlist_is_paged_with_a_refreshed_csrf_token(tmp_path, monkeypatch):
+    tracks, payloads = make_tracks(5)
+    fake = FakeDeezer(tracks, payloads)
+    monkeypatch.setattr(AsyncDeezerClient, 'PLAYLIST_PAGE_SIZE', 2)
+
+    paths = run_against(fake, tmp_path, lambda client: client.download_playlist('https://www.deezer.com/playlist/42'))
+
+    assert_downloaded(paths, tracks, payloads)
+    # The token from the session start was rejected once; pages were then fetched with a new one
+    assert fake.gw_calls == [('deezer.getUserData', ''), ('deezer.pagePlaylist', 'token-1'),
+                             ('deezer.getUserData', ''), ('deezer.pagePlaylist', 'token-2'),
+                             ('deezer.pagePlaylist', 'token-2'), ('deezer.pagePlaylist', 'token-2')]
+    assert [body['track_tokens'] for body in fake.get_url_bodies] == [
+        [track['TRACK_TOKEN'] for track in tracks[start:start + 2]] for start in (0, 2, 4)]
+
+
+def test_track_without_a_url_is_skipped_and_counted_as_failed(tmp_path, redis_manager):
+    tracks, payloads = make_tracks(3)
+    del payloads[tracks[1]['SNG_ID']]
+    fake = FakeDeezer(tracks, payloads)
+    task_id = redis_manager.create_task()
+
+    paths = run_against(fake, tmp_path, lambda client: client.download_album('7'), redis_manager=redis_manager,
+                        task_id=task_id)
+
+    assert_downloaded(paths, [tracks[0], tracks[2]], payloads)
+    progress = redis_manager.get_task_progress(task_id)
+    assert (progress[FIELD_CURRENT], progress[FIELD_FAILED]) == (2, 1)
+
+
+def test_playlist_page_that_cannot_be_fetched_is_skipped(tmp_path, redis_manager, monkeypatch):
+    tracks, payloads = make_tracks(5)
+    fake = FakeDeezer(tracks, payloads)
+    fake.failing_pages = [2]
+    monkeypatch.setattr(AsyncDeezerClient, 'PLAYLIST_PAGE_SIZE', 2)
+    task_id = redis_manager.create_task()
+
+    paths = run_against(fake, tmp_path, lambda client: client.download_playlist('42'), redis_manager=redis_manager,
+                        task_id=task_id)
+
+    assert_downloaded(paths, [tracks[0], tracks[1], tracks[4]], payloads)
+    progress = redis_manager.get_task_progress(task_id)
+    assert (progress[FIELD_CURRENT], progress[FIELD_FAILED], progress[FIELD_FAILED_PAGES]) == (3, 2, 1)
@@ -0,0 +1,90 @@
+import io
+import os
+
+from benchmarks.decrypt_benchmark import FakeResponse, legacy_decrypt_file
+from deezer_downloader.crypto import DeezerCrypto
+from deezer_downloader.exceptions import DeezerApiException
+from progress_tracker import FIELD_CURRENT, FIELD_FAILED, FIELD_FAILED_PAGES
+
+
+def plaintext_of(payload: bytes, track_id: str) -> bytes:
+    """Track content as decrypted by the original implementation"""
+    output = io.BytesIO()
+    legacy_decrypt_file(FakeResponse(payload), DeezerCrypto.calc_blowfish_key(track_id), output)
+    return output.getvalue()
+
+
+def album_tracks(titles):
+    return [{'SNG_ID': str(1000 + index), 'SNG_TITLE': title, 'ART_NAME': 'Artist', 'TRACK_TOKEN': 'token'}
+            for index, title in enumerate(titles)]
+
+
+def test_tracks_sharing_a_title_are_downloaded_to_their_own_files(fake_cdn, make_client):
+    tracks = album_tracks(['Interlude'] * 5 + ['interlude'])
+    payloads = {}
+    for index, track in enumerate(tracks):
+        payloads[track['SNG_ID']] = os.urandom(DeezerCrypto.STRIPE_SIZE * 40 + 100 * index)
+        fake_cdn.add(track['SNG_ID'], payloads[track['SNG_ID']])
+
+    client = make_client(max_workers=6)
+    paths = client._download_tracks([tracks], len(tracks))
+
+    assert [os.path.basename(path) for path in paths] == [
+        'Artist - Interlude.mp3', 'Artist - Interlude (2).mp3', 'Artist - Interlude (3).mp3',
+        'Artist - Interlude (4).mp3', 'Artist - Interlude (5).mp3', 'Artist - interlude (6).mp3']
+    for track, path in zip(tracks, paths):
+        with open(path, 'rb') as track_file:
+            assert track_file.read() == plaintext_of(payloads[track['SNG_ID']], track['SNG_ID'])
+    assert not [name for name in os.listdir(client.config.download_folder) if name.endswith('.part')]
+
+
+def test_failed_tracks_are_counted_apart_from_downloaded_ones(fake_cdn, make_client, redis_manager):
+    tracks = album_tracks(['One', 'Missing', 'Three'])
+    for track in tracks[::2]:
+        fake_cdn.add(track['SNG_ID'], os.urandom(DeezerCrypto.STRIPE_SIZE * 3))
+
+    client = make_client()
+    paths = client._download_tracks([tracks], len(tracks))
+
+    assert [os.path.basename(path) for path in paths] == ['Artist - One.mp3', 'Artist - Three.mp3']
+    progress = redis_manager.get_task_progress(client.task_id)
+    assert (progress[FIELD_CURRENT], progress[FIELD_FAILED]) == (2, 1)
+
+
+def test_playlist_page_that_cannot_be_fetched_is_skipped(fake_cdn, make_client, redis_manager):
+    tracks = album_tracks([f"Title {index}" for index in range(5)])
+    for track in tracks:
+        fake_cdn.add(track['SNG_ID'], os.urandom(DeezerCrypto.STRIPE_SIZE * 3))
+
+    def page_playlist(method, payload, error_message):
+        if payload['start'] == 2:
+            raise DeezerApiException(f"{error_message}: rate limited")
+        return {'DATA': {'TITLE': 'Playlist'},
+                'SONGS': {'data': tracks[payload['start']:payload['start'] + payload['nb']], 'total': len(tracks)}}
+
+    client = make_client()
+    client.PLAYLIST_PAGE_SIZE = 2
+    client._call_gw_api = page_playlist
+    paths = client.download_playlist('42')
+
+    assert [os.path.basename(path) for path in paths] == ['Artist - Title 0.mp3', 'Artist - Title 1.mp3',
+                                                          'Artist - Title 4.mp3']
+    progress = redis_manager.get_task_progress(client.task_id)
+    assert (progress[FIELD_CURRENT], progress[FIELD_FAILED], progress[FIELD_FAILED_PAGES]) == (3, 2, 1)
+
+
+def test_streamed_track_resumes_after_the_last_byte_received(fake_cdn, make_client):
+    track = album_tracks(['Single'])[0]
+    payload = os.urandom(DeezerCrypto.STRIPE_SIZE * 40 + 7)
+    fake_cdn.add(track['SNG_ID'], payload)
+    client = make_client()
+    # Cut after two whole chunks of the stream
+    fake_cdn.cuts[track['SNG_ID']] = [client.STREAM_CHUNK_SIZE * 2]
+    client._get_track_info = lambda track_id: track
+    file_name, size, chunks = client.stream_track(track['SNG_ID'])
+
+    assert (file_name, size) == ('Artist - Single.mp3', len(payload))
+    assert b''.join(chunks) == plaintext_of(payload, track['SNG_ID'])
+    # What was received had already been passed on, so the transfer resumed right after it
+    assert [headers.get('Range') for _, headers in fake_cdn.requests] == [
+        None, f"bytes={client.STREAM_CHUNK_SIZE * 2}-"]
@@ -0,0 +1,72 @@
+import io
+import os
+
+import pytest
+
+from benchmarks.decrypt_benchmark import FakeResponse, legacy_decrypt_file
+from deezer_downloader.crypto import DeezerCrypto, StripeDecryptor
+from deezer_downloader.decrypt_pool import SEGMENT_SIZE, SpooledDecryption
+
+KEY = DeezerCrypto.calc_blowfish_key('3135556')
+BLOCK = DeezerCrypto.BLOCK_SIZE
+
+
+def legacy_plaintext(payload: bytes) -> bytes:
+    output = io.BytesIO()
+    legacy_decrypt_file(FakeResponse(payload), KEY, output)
+    return output.getvalue()
+
+
+# Empty, shorter than a block, whole stripes, and ending on a short block at each stripe phase
+SIZES = [0, 100, BLOCK, DeezerCrypto.STRIPE_SIZE * 5, BLOCK * 7 + 1, BLOCK * 8 + 1000, BLOCK * 9 + 2047,
+         DeezerCrypto.DEFAULT_BUFFER_SIZE * 2 + 1234]
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_decrypt_stripes_matches_the_legacy_decryptor(size):
+    payload = os.urandom(size)
+    buffer = bytearray(payload)
+    DeezerCrypto.decrypt_stripes(buffer, KEY)
+    assert bytes(buffer) == legacy_plaintext(payload)
+
+
+@pytest.mark.parametrize('first_block', [0, 1, 2, 3, 7])
+def test_decrypt_stripes_of_a_buffer_from_mid_stream_matches_the_legacy_decryptor(first_block):
+    payload = os.urandom(BLOCK * 20 + 300)
+    buffer = bytearray(payload[first_block * BLOCK:])
+    DeezerCrypto.decrypt_stripes(buffer, KEY, first_block)
+    assert bytes(buffer) == legacy_plaintext(payload)[first_block * BLOCK:]
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('buffer_size', [BLOCK, DeezerCrypto.STRIPE_SIZE * 2 + 5, DeezerCrypto.DEFAULT_BUFFER_SIZE])
+def test_decrypt_file_matches_the_legacy_decryptor(size, buffer_size):
+    payload = os.urandom(size)
+    output = io.BytesIO()
+    progress = []
+
+    written = DeezerCrypto.decrypt_file(FakeResponse(payload), KEY, output, buffer_size=buffer_size,
+                                        on_progress=progress.append)
+
+    assert output.getvalue() == legacy_plaintext(payload)
+    assert written == size and (not size or progress[-1] == size)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 1000, BLOCK, 5000, 65536])
+def test_stripe_decryptor_fed_any_chunks_matches_the_legacy_decryptor(chunk_size):
+    payload = os.urandom(BLOCK * 30 + 1500)
+    decryptor = StripeDecryptor(KEY)
+    output = b''.join(decryptor.update(payload[start:start + chunk_size])
+                      for start in range(0, len(payload), chunk_size)) + decryptor.finish()
+    assert output == legacy_plaintext(payload)
+    assert decryptor.received == len(payload)
+
+
+def test_spooled_decryption_matches_the_legacy_decryptor(tmp_path):
+    payload = os.urandom(SEGMENT_SIZE * 2 + 4321)
+    output_path = str(tmp_path / 'track.mp3')
+    sink = SpooledDecryption(KEY, output_path, 2)
+    sink.write_from(FakeResponse(payload), 0)
+    sink.finish()
+    with open(output_path, 'rb') as track_file:
+        assert track_file.read() == legacy_plaintext(payload)
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from job_queue import JobQueue, QueueFullError
+
+
+@pytest.fixture
+def job_queue(redis_manager):
+    return JobQueue(redis_manager, 10)
+
+
+def expire_reserved_jobs(job_queue: JobQueue):
+    """Pass the deadline of every reserved job, as if its worker had stopped heartbeating"""
+    for job_id in job_queue.redis.zrange(job_queue.processing_key, 0, -1):
+        job_queue.redis.zadd(job_queue.processing_key, {job_id: 0})
+
+
+def test_jobs_are_reserved_in_order_and_past_the_limit_refused(redis_manager):
+    job_queue = JobQueue(redis_manager, 2)
+    assert [job_queue.enqueue(job_id, {'n': index}) for index, job_id in enumerate(['a', 'b'])] == [1, 2]
+
+    with pytest.raises(QueueFullError):
+        job_queue.enqueue('c', {})
+    assert job_queue.reserve() == ('a', {'n': 0})
+    assert job_queue.positions(['a', 'b']) == {'a': None, 'b': 1}
+    assert job_queue.enqueue('c', {}) == 2
+
+
+def test_job_of_a_worker_that_stopped_heartbeating_is_delivered_again_first(job_queue):
+    job_queue.enqueue('crashed', {'n': 1})
+    job_queue.enqueue('waiting', {'n': 2})
+    assert job_queue.reserve()[0] == 'crashed'
+
+    # Not before its deadline
+    assert job_queue.requeue_expired() == []
+    assert job_queue.position('crashed') is None
+    expire_reserved_jobs(job_queue)
+
+    assert job_queue.requeue_expired() == []
+    assert job_queue.reserve() == ('crashed', {'n': 1})
+
+
+def test_heartbeat_keeps_a_job_from_being_delivered_again(job_queue):
+    job_queue.enqueue('running', {})
+    job_queue.reserve()
+    expire_reserved_jobs(job_queue)
+
+    job_queue.extend('running')
+
+    assert job_queue.requeue_expired() == []
+    assert job_queue.reserve() is None
+
+
+def test_job_is_given_up_on_after_max_deliveries(job_queue):
+    job_queue.enqueue('poison', {})
+    for _ in range(job_queue.MAX_DELIVERIES - 1):
+        assert job_queue.reserve()[0] == 'poison'
+        expire_reserved_jobs(job_queue)
+        assert job_queue.requeue_expired() == []
+
+    assert job_queue.reserve()[0] == 'poison'
+    expire_reserved_jobs(job_queue)
+    assert job_queue.requeue_expired() == ['poison']
+    assert job_queue.reserve() is None
+    # Nothing of it is left behind, its payload included
+    assert job_queue.redis.keys('*') == []
+
+
+def test_worker_completes_jobs_whether_their_handler_succeeds_or_not(job_queue):
+    job_queue.enqueue('ok', {'n': 1})
+    job_queue.enqueue('failing', {'n': 2})
+    handled = []
+    stop_event = threading.Event()
+
+    def handler(job_id, payload):
+        handled.append((job_id, payload))
+        if job_id == 'failing':
+            stop_event.set()
+            raise RuntimeError("Download failed")
+
+    job_queue.work(handler, stop_event)
+
+    assert handled == [('ok', {'n': 1}), ('failing', {'n': 2})]
+    assert job_queue.redis.keys('*') == []
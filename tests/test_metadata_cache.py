@@ -0,0 +1,73 @@
+import json
+import time
+
+import redis
+
+from deezer_downloader.metadata_cache import MetadataCache
+
+
+def album(track_token_expire=None):
+    track = {'SNG_ID': '1000', 'SNG_TITLE': 'One', 'TRACK_TOKEN': 'token'}
+    if track_token_expire is not None:
+        track['TRACK_TOKEN_EXPIRE'] = track_token_expire
+    return {'DATA': {'ALB_TITLE': 'Album'}, 'SONGS': {'data': [track]}}
+
+
+def test_least_recently_used_entries_are_evicted_from_the_process():
+    cache = MetadataCache(None, max_entries=2)
+    cache.set('track', '1', 'en', 'account', {'SNG_ID': '1'})
+    cache.set('track', '2', 'en', 'account', {'SNG_ID': '2'})
+    assert cache.get('track', '1', 'en', 'account') == {'SNG_ID': '1'}
+
+    cache.set('track', '3', 'en', 'account', {'SNG_ID': '3'})
+
+    assert cache.get('track', '2', 'en', 'account') is None
+    assert [cache.get('track', track_id, 'en', 'account') for track_id in ('1', '3')] == [
+        {'SNG_ID': '1'}, {'SNG_ID': '3'}]
+
+
+def test_entries_missing_from_the_process_are_read_from_redis_and_kept(redis_manager):
+    cache, other_worker = MetadataCache(redis_manager, max_entries=1), MetadataCache(redis_manager)
+    cache.set('track', '1', 'en', 'account', {'SNG_ID': '1'})
+    cache.set('track', '2', 'en', 'account', {'SNG_ID': '2'})
+
+    # Evicted from this process, and never seen by the other one
+    assert cache.get('track', '1', 'en', 'account') == {'SNG_ID': '1'}
+    assert other_worker.get('track', '2', 'en', 'account') == {'SNG_ID': '2'}
+
+    # Kept in the process, until the TTL the entry had in Redis
+    redis_manager.redis.flushall()
+    assert other_worker.get('track', '2', 'en', 'account') == {'SNG_ID': '2'}
+
+
+def test_track_tokens_are_cached_per_account_apart_from_the_shared_metadata(redis_manager):
+    cache = MetadataCache(redis_manager)
+    cache.set('album', '7', 'en', 'account', album(track_token_expire=int(time.time()) + 3600))
+
+    shared = json.loads(redis_manager.redis.get(cache._metadata_key('album', '7', 'en')))
+    assert shared == {'DATA': {'ALB_TITLE': 'Album'}, 'SONGS': {'data': [{'SNG_ID': '1000', 'SNG_TITLE': 'One'}]}}
+    assert cache.get('album', '7', 'en', 'account')['SONGS']['data'][0]['TRACK_TOKEN'] == 'token'
+    assert MetadataCache.missing_tokens(cache.get('album', '7', 'en', 'other-account')) == ['1000']
+
+
+def test_track_token_about_to_expire_is_not_cached(redis_manager):
+    cache = MetadataCache(redis_manager)
+    cache.set('album', '7', 'en', 'account', album(track_token_expire=int(time.time()) + 30))
+
+    assert MetadataCache.missing_tokens(cache.get('album', '7', 'en', 'account')) == ['1000']
+
+
+def test_lookups_fall_back_to_the_process_when_redis_is_unavailable(redis_manager, monkeypatch):
+    cache = MetadataCache(redis_manager, max_entries=1)
+    cache.set('track', '1', 'en', 'account', {'SNG_ID': '1'})
+    cache.set('track', '2', 'en', 'account', {'SNG_ID': '2'})
+
+    def unavailable(*args, **kwargs):
+        raise redis.ConnectionError("Connection refused")
+    monkeypatch.setattr(cache.redis, 'pipeline', unavailable)
+    monkeypatch.setattr(cache.redis, 'set', unavailable)
+
+    assert cache.get('track', '1', 'en', 'account') is None
+    assert cache.get('track', '2', 'en', 'account') == {'SNG_ID': '2'}
+    cache.set('track', '3', 'en', 'account', {'SNG_ID': '3'})
+    assert cache.get('track', '3', 'en', 'account') == {'SNG_ID': '3'}
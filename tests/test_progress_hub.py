@@ -0,0 +1,50 @@
+import pytest
+
+from progress_hub import ProgressHub, StreamLimitError
+from progress_tracker import FIELD_CURRENT, FIELD_FINISHED, FIELD_TOTAL
+
+
+def test_updates_of_a_task_reach_every_subscription_to_it_through_one_connection(redis_manager):
+    hub = ProgressHub(redis_manager, 10)
+    task_id, other_task_id = redis_manager.create_task(), redis_manager.create_task()
+    first, second = iter(hub.subscribe(task_id, 5)), iter(hub.subscribe(task_id, 5))
+    other = iter(hub.subscribe(other_task_id, 0.01))
+    assert [next(first)[FIELD_CURRENT], next(second)[FIELD_CURRENT], next(other)[FIELD_CURRENT]] == [0, 0, 0]
+
+    redis_manager.increment_task_progress(task_id, **{FIELD_TOTAL: 3})
+
+    assert next(first) == next(second) == {FIELD_CURRENT: 1, FIELD_TOTAL: 3}
+    assert next(other) is None
+    # A single pattern subscription serves all the streams of the process
+    assert redis_manager.redis.pubsub_numpat() == 1
+
+
+def test_subscription_is_resynced_with_the_whole_progress_after_the_listener_reconnects(redis_manager):
+    hub = ProgressHub(redis_manager, 10)
+    task_id = redis_manager.create_task()
+    updates = iter(hub.subscribe(task_id, 5))
+    next(updates)
+
+    # An update made while the listener was not subscribed never reaches it
+    redis_manager.redis.hset(redis_manager._get_key(task_id), FIELD_TOTAL, 3)
+    hub._resync = True
+    hub._on_subscribed()
+
+    resynced = next(updates)
+    assert resynced[FIELD_TOTAL] == 3 and not resynced[FIELD_FINISHED]
+
+
+def test_subscriptions_past_the_limit_are_refused_until_one_is_closed(redis_manager):
+    hub = ProgressHub(redis_manager, 2)
+    task_id = redis_manager.create_task()
+    first = hub.subscribe(task_id, 5)
+    hub.subscribe(task_id, 5)
+
+    with pytest.raises(StreamLimitError):
+        hub.subscribe(task_id, 5)
+
+    first.close()
+    first.close()
+    assert len(hub) == 1
+    hub.subscribe(task_id, 5)
+    assert len(hub) == 2
@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import pytest
+
+from progress_tracker import FIELD_BYTES_DONE, FIELD_BYTES_TOTAL, FIELD_ETA, FIELD_RATE, ProgressAggregator
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Monotonic clock of the aggregators, moved forward by the tests"""
+    now = [100.0]
+    monkeypatch.setattr('progress_tracker.time', SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def writes(redis_manager, monkeypatch):
+    """Progress updates written to Redis"""
+    written = []
+    update_task_progress = redis_manager.update_task_progress
+
+    def record(task_id, **updates):
+        written.append(updates)
+        return update_task_progress(task_id, **updates)
+    monkeypatch.setattr(redis_manager, 'update_task_progress', record)
+    return written
+
+
+def test_updates_are_written_at_most_once_per_interval(redis_manager, clock, writes):
+    progress = ProgressAggregator(redis_manager, redis_manager.create_task(), interval=0.5)
+
+    progress.update('a', 100, 1000)
+    for done in (200, 300, 400):
+        clock[0] += 0.1
+        progress.update('a', done)
+    assert [write[FIELD_BYTES_DONE] for write in writes] == [100]
+
+    clock[0] += 0.3
+    progress.update('b', 50, 500)
+    assert writes[-1][FIELD_BYTES_DONE] == 450 and writes[-1][FIELD_BYTES_TOTAL] == 1500
+
+    # Flushing, e.g. once the task is done, writes whatever is pending right away
+    progress.update('a', 1000)
+    progress.flush()
+    assert [write[FIELD_BYTES_DONE] for write in writes] == [100, 450, 1050]
+
+
+def test_resumed_transfer_is_not_counted_twice(redis_manager, clock, writes):
+    progress = ProgressAggregator(redis_manager, redis_manager.create_task(), interval=0)
+
+    progress.update('a', 600, 1000)
+    # Interrupted, then resumed after the whole blocks it had received
+    progress.update('a', 512)
+    progress.update('a', 1000)
+
+    assert [write[FIELD_BYTES_DONE] for write in writes] == [600, 512, 1000]
+    assert writes[-1][FIELD_BYTES_TOTAL] == 1000
+
+
+def test_eta_counts_the_transfers_not_started_yet_at_the_smoothed_rate(redis_manager, clock, writes):
+    task_id = redis_manager.create_task()
+    progress = ProgressAggregator(redis_manager, task_id, interval=0.5)
+    progress.expect(4)
+
+    progress.update('a', 0, 1000)
+    assert writes[-1][FIELD_ETA] is None
+    clock[0] += 1
+    progress.update('a', 500)
+    # 500 of an estimated 4 * 1000 bytes, at 500 bytes per second
+    assert (writes[-1][FIELD_RATE], writes[-1][FIELD_ETA]) == (500, 7)
+
+    clock[0] += 1
+    progress.update('a', 1000)
+    progress.update('b', 700, 1000)
+    clock[0] += 1
+    progress.update('b', 1000)
+    # Measured 1000 bytes per second since the last write, smoothed with the 500 before
+    assert writes[-1][FIELD_RATE] == round(0.3 * 1000 + 0.7 * 500)
+    assert redis_manager.get_task_progress(task_id)[FIELD_ETA] == round(2000 / writes[-1][FIELD_RATE])
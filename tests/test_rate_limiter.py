@@ -0,0 +1,94 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from deezer_downloader.rate_limiter import EndpointLimit, RateLimiter
+
+
+@pytest.fixture
+def waits(monkeypatch):
+    """Seconds the rate limiters were told to wait, instead of waiting"""
+    waited = []
+    monkeypatch.setattr('deezer_downloader.rate_limiter.time', SimpleNamespace(sleep=waited.append))
+    return waited
+
+
+def make_limiter(redis_manager, rate=10, burst=3):
+    return RateLimiter(redis_manager, {'gw': EndpointLimit(rate=rate, burst=burst)})
+
+
+def bucket(limiter: RateLimiter, endpoint: str = 'gw'):
+    return {field: float(value) for field, value in limiter.redis.hgetall(f"{limiter.namespace}{endpoint}").items()}
+
+
+def test_burst_is_shared_by_all_limiters_then_requests_are_spaced_at_the_rate(redis_manager, waits):
+    limiters = [make_limiter(redis_manager), make_limiter(redis_manager)]
+
+    for index in range(3):
+        limiters[index % 2].acquire('gw')
+    assert waits == []
+
+    limiters[1].acquire('gw')
+    limiters[0].acquire('gw')
+    assert waits[0] == pytest.approx(0.1, abs=0.02)
+    assert waits[1] == pytest.approx(0.2, abs=0.02)
+
+
+def test_tokens_are_refilled_at_the_rate_up_to_the_burst(redis_manager, waits):
+    limiter = make_limiter(redis_manager)
+    for _ in range(3):
+        limiter.acquire('gw')
+
+    time.sleep(0.25)
+    limiter.acquire('gw')
+    limiter.acquire('gw')
+    assert waits == []
+    assert bucket(limiter)['tokens'] == pytest.approx(0.5, abs=0.2)
+
+    # Never more than the burst, however long the endpoint was idle
+    time.sleep(0.5)
+    limiter.acquire('gw')
+    assert bucket(limiter)['tokens'] == pytest.approx(2, abs=0.01)
+
+
+def test_push_back_halves_the_rate_once_per_cooldown_and_drops_the_burst(redis_manager, waits):
+    limiter = make_limiter(redis_manager)
+
+    limiter.penalize('gw')
+    limiter.penalize('gw')
+
+    assert bucket(limiter)['rate'] == pytest.approx(5, abs=0.01)
+    limiter.acquire('gw')
+    assert waits == [pytest.approx(0.2, abs=0.02)]
+
+
+def test_lowered_rate_recovers_linearly_to_its_maximum(redis_manager, waits):
+    limiter = make_limiter(redis_manager)
+    limiter.RECOVERY_SECONDS = 1
+    limiter.penalize('gw')
+
+    time.sleep(0.2)
+    limiter.acquire('gw')
+    assert bucket(limiter)['rate'] == pytest.approx(7, abs=0.5)
+
+    time.sleep(0.4)
+    limiter.acquire('gw')
+    assert bucket(limiter)['rate'] == 10
+
+
+def test_requests_are_not_limited_without_redis(waits):
+    limiter = RateLimiter(None, {'gw': EndpointLimit(rate=1, burst=1)})
+
+    for _ in range(5):
+        limiter.acquire('gw')
+    limiter.penalize('gw')
+
+    assert waits == []
+
+
+def test_only_deezer_endpoints_are_limited():
+    assert RateLimiter.classify('https://www.deezer.com/ajax/gw-light.php?method=deezer.getUserData') == 'gw'
+    assert RateLimiter.classify('https://www.deezer.com/en/album/7') == 'page'
+    assert RateLimiter.classify('https://media.deezer.com/v1/get_url') == 'get_url'
+    assert RateLimiter.classify('https://e-cdns-proxy-1.dzcdn.net/mobile/1/track') is None
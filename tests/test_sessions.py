@@ -0,0 +1,32 @@
+import json
+
+from deezer_downloader.config import DeezerConfig
+from deezer_downloader.sessions import DeezerSession
+
+
+def test_connection_stats_since_an_earlier_snapshot_count_only_later_requests(fake_cdn):
+    fake_cdn.add('track', b'x' * 100)
+    session = DeezerSession(DeezerConfig(cookie_arl='arl'))
+    for _ in range(3):
+        session.get(fake_cdn.url('track')).content
+
+    snapshot = session.connection_stats()
+    assert snapshot['127.0.0.1'] == {'connections': 1, 'requests': 3, 'reused': 2}
+    assert session.connection_stats(snapshot) == {}
+
+    for _ in range(2):
+        session.get(fake_cdn.url('track')).content
+    assert session.connection_stats(snapshot) == {'127.0.0.1': {'connections': 0, 'requests': 2, 'reused': 2}}
+
+
+def test_page_connection_is_reused_after_the_app_state_is_found(fake_cdn, make_client):
+    state = {'DATA': {'__TYPE__': 'album', 'MD5_ORIGIN': 'md5'}, 'SONGS': {'data': []}}
+    page = f"<script>window.__DZR_APP_STATE__ = {json.dumps(state)}</script>".encode() + b' ' * 500_000
+    fake_cdn.add('us/album/7', page)
+    client = make_client()
+    client.session.WWW_URL = fake_cdn.url('').rstrip('/')
+
+    for _ in range(3):
+        assert client._get_page_state('album', '7') == state
+    # A connection left with part of its response unread is closed rather than reused
+    assert len(fake_cdn.clients) == 1
@@ -0,0 +1,62 @@
+import os
+
+from deezer_downloader.crypto import DeezerCrypto
+from deezer_downloader.track_store import TrackStore
+from test_client import album_tracks, plaintext_of
+
+
+def test_track_downloaded_once_is_hardlinked_into_later_tasks(tmp_path, fake_cdn, make_client):
+    track = album_tracks(['One'])[0]
+    payload = os.urandom(DeezerCrypto.STRIPE_SIZE * 10)
+    fake_cdn.add(track['SNG_ID'], payload)
+    store = TrackStore(str(tmp_path / 'store'), 10 * 1024 * 1024)
+    paths = []
+    for task in ('first', 'second'):
+        os.makedirs(tmp_path / task)
+        client = make_client(download_folder=str(tmp_path / task))
+        client.track_store = store
+        client._get_track_info = lambda track_id: track
+        paths.append(client.download_track(track['SNG_ID']))
+
+    # Only the first task downloaded it; the second got the same file, not a copy
+    assert len(fake_cdn.requests) == 1
+    assert os.path.samefile(paths[0], paths[1])
+    with open(paths[1], 'rb') as track_file:
+        assert track_file.read() == plaintext_of(payload, track['SNG_ID'])
+    assert os.stat(paths[1]).st_nlink == 3
+
+
+def test_track_downloaded_again_is_not_written_through_its_stored_hardlink(tmp_path, fake_cdn, make_client):
+    track = album_tracks(['One'])[0]
+    fake_cdn.add(track['SNG_ID'], os.urandom(DeezerCrypto.STRIPE_SIZE * 10))
+    store = TrackStore(str(tmp_path / 'store'), 10 * 1024 * 1024)
+    client = make_client()
+    client.track_store = store
+    client._get_track_info = lambda track_id: track
+    path = client.download_track(track['SNG_ID'])
+    stored_path, _ = store.find(track['SNG_ID'], 'MP3_128')
+
+    # Downloaded over the stored copy, e.g. after the store was given up on for this task
+    client.track_store = None
+    fake_cdn.add(track['SNG_ID'], os.urandom(DeezerCrypto.STRIPE_SIZE * 10))
+    client.download_track(track['SNG_ID'])
+
+    assert not os.path.samefile(path, stored_path)
+
+
+def test_least_recently_used_tracks_are_evicted_past_the_size_limit(tmp_path):
+    store = TrackStore(str(tmp_path / 'store'), 300)
+    for index, track_id in enumerate(['1', '2', '3']):
+        source = tmp_path / f"{track_id}.mp3"
+        source.write_bytes(b'x' * 100)
+        store.add(track_id, 'MP3_128', 'MP3_128', str(source))
+        os.utime(store.find(track_id, 'MP3_128')[0], (index, index))
+    # Handing a track out makes it the most recently used
+    assert store.link(store.find('1', 'MP3_128')[0], str(tmp_path / 'linked.mp3'))
+
+    source = tmp_path / '4.mp3'
+    source.write_bytes(b'x' * 100)
+    store.add('4', 'MP3_128', 'MP3_128', str(source))
+
+    assert [store.find(track_id, 'MP3_128') is not None for track_id in ['1', '2', '3', '4']] == [
+        True, False, False, True]
@@ -0,0 +1,95 @@
+import io
+import os
+
+import pytest
+
+from benchmarks.decrypt_benchmark import FakeResponse
+from deezer_downloader.crypto import DeezerCrypto
+from deezer_downloader.transfer import PartFileDecryption
+from test_client import album_tracks, plaintext_of
+
+BLOCK = DeezerCrypto.BLOCK_SIZE
+
+
+class BrokenStream(io.RawIOBase):
+    """Response body whose connection breaks after limit bytes"""
+
+    def __init__(self, payload: bytes, limit: int):
+        self.raw = self
+        self._data = io.BytesIO(payload[:limit])
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self._data.readinto(buffer)
+        if not count:
+            raise ConnectionResetError("Connection broken")
+        return count
+
+
+@pytest.mark.parametrize('limit', [0, 1000, BLOCK, BLOCK * 4 + 10, BLOCK * 5, DeezerCrypto.DEFAULT_BUFFER_SIZE + 3000])
+def test_part_file_resumes_on_the_block_boundary_before_the_break(tmp_path, limit):
+    payload = os.urandom(DeezerCrypto.DEFAULT_BUFFER_SIZE * 2 + 999)
+    track_id = '1000'
+    sink = PartFileDecryption(DeezerCrypto.calc_blowfish_key(track_id), str(tmp_path / 'track.mp3'))
+
+    with pytest.raises(ConnectionResetError):
+        sink.write_from(BrokenStream(payload, limit), 0)
+    assert sink.offset == limit - limit % BLOCK
+
+    offset = sink.offset
+    sink.write_from(FakeResponse(payload[offset:]), offset)
+    sink.finish()
+    with open(tmp_path / 'track.mp3', 'rb') as track_file:
+        assert track_file.read() == plaintext_of(payload, track_id)
+    assert not os.path.exists(sink.part_path)
+
+
+def test_part_file_write_blocks_replaces_what_follows_the_offset(tmp_path):
+    payload = os.urandom(BLOCK * 10 + 5)
+    track_id = '1000'
+    sink = PartFileDecryption(DeezerCrypto.calc_blowfish_key(track_id), str(tmp_path / 'track.mp3'))
+
+    sink.write_blocks(bytearray(payload[:BLOCK * 6]), 0)
+    # Resuming from an earlier block boundary overwrites the blocks after it
+    sink.write_blocks(bytearray(payload[BLOCK * 4:]), BLOCK * 4)
+    sink.finish()
+    with open(tmp_path / 'track.mp3', 'rb') as track_file:
+        assert track_file.read() == plaintext_of(payload, track_id)
+
+
+def test_interrupted_download_resumes_after_the_whole_blocks_received(fake_cdn, make_client):
+    track = album_tracks(['Title'])[0]
+    payload = os.urandom(DeezerCrypto.DEFAULT_BUFFER_SIZE + 5000)
+    fake_cdn.add(track['SNG_ID'], payload, cuts=[100_000])
+
+    path = make_client().download_track(track['SNG_ID'], track_info=track)
+
+    with open(path, 'rb') as track_file:
+        assert track_file.read() == plaintext_of(payload, track['SNG_ID'])
+    # The connection broke inside the first read buffer: its whole blocks were kept
+    assert [headers.get('Range') for _, headers in fake_cdn.requests] == [None, 'bytes=98304-']
+    assert all(headers.get('Accept-Encoding') == 'identity' for _, headers in fake_cdn.requests)
+
+
+def test_segmented_download_resumes_an_interrupted_segment(fake_cdn, make_client):
+    track = album_tracks(['Title'])[0]
+    payload = os.urandom(DeezerCrypto.STRIPE_SIZE * 100 + 777)
+    track['FILESIZE_MP3_128'] = str(len(payload))
+    fake_cdn.add(track['SNG_ID'], payload, cuts=[50_000])
+
+    client = make_client(download_segments=3, segment_min_size=0)
+    path = client.download_track(track['SNG_ID'], track_info=track)
+
+    with open(path, 'rb') as track_file:
+        assert track_file.read() == plaintext_of(payload, track['SNG_ID'])
+    # Three segments of 34 stripes; whichever was requested first was cut short, and resumed after
+    # the whole blocks it had received
+    segments = [(0, 208896), (208896, 417792), (417792, len(payload))]
+    initial = [f"bytes={start}-{end - 1}" for start, end in segments]
+    ranges = [headers['Range'] for _, headers in fake_cdn.requests]
+    resumed = [requested for requested in ranges if requested not in initial]
+    assert sorted(set(ranges) - set(resumed)) == sorted(initial) and len(ranges) == 4
+    assert resumed[0] in [f"bytes={start + 49152}-{end - 1}" for start, end in segments]
+    assert all(headers.get('Accept-Encoding') == 'identity' for _, headers in fake_cdn.requests)
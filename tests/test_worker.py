@@ -0,0 +1,15 @@
+import pytest
+
+
+def test_worker_refuses_to_start_without_a_shared_data_dir(tmp_path, monkeypatch):
+    # Only read by the first test importing tasks, which must not touch the repository's dl/ directory
+    monkeypatch.setenv('DATA_DIR', str(tmp_path))
+    import worker
+
+    started = []
+    monkeypatch.setattr(worker, 'SHARED_DATA_DIR', False)
+    monkeypatch.setattr(worker, 'start_workers', lambda *args: started.append(args) or [])
+
+    with pytest.raises(SystemExit) as exit_info:
+        worker.main()
+    assert exit_info.value.code == 1 and not started
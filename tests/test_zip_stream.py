@@ -0,0 +1,54 @@
+import io
+import os
+import zipfile
+
+from deezer_downloader.crypto import DeezerCrypto
+from zip_stream import stream_zip
+from test_client import album_tracks, plaintext_of
+
+
+def read_zip(chunks) -> zipfile.ZipFile:
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+    assert archive.testzip() is None
+    return archive
+
+
+def test_entries_are_stored_in_order_under_their_file_names(tmp_path):
+    contents = {'a.mp3': os.urandom(100_000), 'b.flac': b'', 'c.mp3': os.urandom(10)}
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+
+    archive = read_zip(stream_zip([str(tmp_path / name) for name in contents], chunk_size=4096))
+
+    assert archive.namelist() == list(contents)
+    assert all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist())
+    for name, data in contents.items():
+        assert archive.read(name) == data
+
+
+def test_files_with_the_same_name_in_different_directories_are_numbered(tmp_path):
+    paths = []
+    for directory in ('one', 'two', 'three'):
+        (tmp_path / directory).mkdir()
+        path = tmp_path / directory / 'Artist - Title.mp3'
+        path.write_bytes(directory.encode())
+        paths.append(str(path))
+
+    archive = read_zip(stream_zip(paths))
+
+    assert archive.namelist() == ['Artist - Title.mp3', 'Artist - Title (2).mp3', 'Artist - Title (3).mp3']
+    assert [archive.read(name) for name in archive.namelist()] == [b'one', b'two', b'three']
+
+
+def test_tracks_sharing_a_title_keep_their_own_content_in_the_archive(fake_cdn, make_client):
+    tracks = album_tracks(['Interlude'] * 5)
+    payloads = [os.urandom(DeezerCrypto.STRIPE_SIZE * 20 + index) for index in range(len(tracks))]
+    for track, payload in zip(tracks, payloads):
+        fake_cdn.add(track['SNG_ID'], payload)
+
+    client = make_client(max_workers=5)
+    archive = read_zip(stream_zip(client._download_tracks([tracks], len(tracks))))
+
+    assert len(set(archive.namelist())) == len(tracks)
+    assert [archive.read(name) for name in archive.namelist()] == [
+        plaintext_of(payload, track['SNG_ID']) for track, payload in zip(tracks, payloads)]
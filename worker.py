@@ -0,0 +1,71 @@
+# worker.py
+
+# Download worker: runs the download tasks queued by the web app. Start any number of them with
+# `python worker.py`, on any node sharing Redis and the data directory (DATA_DIR, required) with the
+# web app.
+
+import signal
+import sys
+import threading
+from typing import List
+import redis
+from deezer_downloader import decrypt_pool
+from tasks import download_queue, run_download_job, fail_abandoned_downloads, DOWNLOAD_WORKERS, DECRYPT_PROCESSES, \
+    SHARED_DATA_DIR
+from logging_config import logger
+
+# Seconds between scans for jobs of crashed workers to re-deliver
+REQUEUE_INTERVAL_SECONDS = 15
+
+
+def start_workers(count: int, stop_event: threading.Event) -> List[threading.Thread]:
+    """Starts count threads running queued download tasks until stop_event is set."""
+    if DECRYPT_PROCESSES > 0:
+        # Before any download thread exists, rather than on the first track of a task
+        decrypt_pool.start_executor(DECRYPT_PROCESSES)
+    threads = [threading.Thread(target=download_queue.work, args=(run_download_job, stop_event),
+                                name=f"download-worker-{i}", daemon=True)
+               for i in range(count)]
+    threads.append(threading.Thread(target=requeue_expired_jobs, args=(stop_event,),
+                                    name="download-requeue", daemon=True))
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def requeue_expired_jobs(stop_event: threading.Event):
+    """Periodically re-delivers the jobs of workers that stopped heartbeating."""
+    while not stop_event.wait(REQUEUE_INTERVAL_SECONDS):
+        try:
+            fail_abandoned_downloads(download_queue.requeue_expired())
+        except redis.RedisError as e:
+            logger.warning(f"Failed to re-deliver expired jobs: {e}")
+
+
+def main():
+    if not SHARED_DATA_DIR:
+        # The web app would not find the tracks written to this process' own data directory
+        logger.error("DATA_DIR is not set: a separate download worker needs the data directory it shares with "
+                     "the web app. Set DATA_DIR on both, or leave downloads to the web process (EMBEDDED_WORKERS).")
+        sys.exit(1)
+
+    stop_event = threading.Event()
+
+    def stop(signum, frame):
+        # Running tasks are not interrupted; if the process is killed before they finish,
+        # their jobs are re-delivered to another worker
+        logger.info(f"Received signal {signum}, finishing running tasks...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info(f"Download worker started with {DOWNLOAD_WORKERS} threads.")
+    threads = start_workers(DOWNLOAD_WORKERS, stop_event)
+    for thread in threads:
+        thread.join()
+    logger.info("Download worker stopped.")
+
+
+if __name__ == '__main__':
+    main()
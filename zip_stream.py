@@ -0,0 +1,76 @@
+# zip_stream.py
+
+# Zip archives written as a stream, so that tracks reach the client while their task is still downloading.
+
+import os
+import zipfile
+from typing import Iterable, Iterator, List, Set
+
+# Bytes read from a file for each chunk of the stream
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkBuffer:
+    """Unseekable file for ZipFile, holding what it writes until the stream yields it"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(file_paths: Iterable[str], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Stream a zip archive of files as they are produced
+
+    Entries are stored uncompressed (audio does not compress) and, since the stream cannot seek
+    back to their local headers, are each followed by a data descriptor; zip64 records are used
+    where sizes require them. file_paths may block until the next file is ready, and the central
+    directory is written once it is exhausted, so only one chunk is ever held in memory.
+
+    Args:
+        file_paths: Paths of the files to archive, stored under their file names
+        chunk_size: Bytes read from a file per chunk
+
+    Returns:
+        Iterator over consecutive chunks of the archive
+    """
+    buffer = _ChunkBuffer()
+    names: Set[str] = set()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for file_path in file_paths:
+            # from_file records the size up front, which decides whether the entry needs zip64
+            info = zipfile.ZipInfo.from_file(file_path, arcname=_unique_name(names, os.path.basename(file_path)))
+            with open(file_path, 'rb') as source, archive.open(info, 'w') as entry:
+                while True:
+                    data = source.read(chunk_size)
+                    if not data:
+                        break
+                    entry.write(data)
+                    yield buffer.drain()
+    # Data descriptor of the last entry and central directory
+    yield buffer.drain()
+
+
+def _unique_name(names: Set[str], name: str) -> str:
+    """
+    Number names already in the archive, as a safety net: the files of a task already have unique
+    names (see DeezerClient._unique_file_stem), but paths from different directories may not
+    """
+    stem, extension = os.path.splitext(name)
+    unique_name, number = name, 1
+    while unique_name in names:
+        number += 1
+        unique_name = f"{stem} ({number}){extension}"
+    names.add(unique_name)
+    return unique_name